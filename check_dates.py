@@ -5,6 +5,8 @@ import requests
 import os
 import argparse
 import csv
+import json
+import sqlite3
 import yaml
 
 
@@ -13,6 +15,8 @@ parser = argparse.ArgumentParser()
 parser.add_argument("--startdate", required=True)
 parser.add_argument("--enddate", required=True)
 parser.add_argument("--config", default="config.yaml")
+parser.add_argument("--offline", action="store_true", help="No consultar el catálogo remoto: solo la caché local")
+parser.add_argument("--refresh", action="store_true", help="Volver a consultar todo el rango aunque esté en la caché")
 args = parser.parse_args()
 
 start_date = datetime.strptime(args.startdate, "%Y-%m-%d")
@@ -23,6 +27,9 @@ with open(args.config, "r") as f:
 
 date_dir = cfg.get('available_dates_dir')
 area_of_interest = cfg.get("area_of_interest")
+# Caché local del catálogo (SQLite) y días tras la adquisición en los que el catálogo aún puede cambiar
+catalog_cache = cfg.get("catalog_cache") or os.path.join(date_dir, "catalog_cache.sqlite")
+catalog_staleness_days = cfg.get("catalog_staleness_days", 30)
 
 ## Function to retrieve access token
 def get_access_token(username: str, password: str) -> str:
@@ -47,18 +54,26 @@ def get_access_token(username: str, password: str) -> str:
         return None
 
 
-CLIENT_ID = os.getenv("CDS_ID")
-CLIENT_SECRET = os.getenv("CDS_SECRET")
+def sh_config():
+    """Configuración de SentinelHub para CDSE (solo hace falta si se consulta el catálogo remoto)."""
+    CLIENT_ID = os.getenv("CDS_ID")
+    CLIENT_SECRET = os.getenv("CDS_SECRET")
 
-config = SHConfig()
-config.sh_client_id = CLIENT_ID
-config.sh_client_secret = CLIENT_SECRET
-config.sh_token_url = "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token" # Is it required?
-config.sh_base_url = "https://sh.dataspace.copernicus.eu"
-config.save("cdse")
-config = SHConfig("cdse")
+    config = SHConfig()
+    config.sh_client_id = CLIENT_ID
+    config.sh_client_secret = CLIENT_SECRET
+    config.sh_token_url = "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token" # Is it required?
+    config.sh_base_url = "https://sh.dataspace.copernicus.eu"
+    config.save("cdse")
+    return SHConfig("cdse")
 
-def check_cloud_cover(time_interval, aoi, config): 
+def check_cloud_cover(time_interval, aoi, config):
+    """
+    Productos Sentinel-2 L1C del catálogo remoto que cortan el AOI en time_interval (fechas inclusive).
+
+    Returns:
+        lista de dicts con id, acquisition_id, date, tile, cloud_cover y platform, en el orden del catálogo
+    """
     # Definir el área de interés
     aoi_bbox = BBox(bbox=aoi, crs=CRS.WGS84)
 
@@ -73,55 +88,141 @@ def check_cloud_cover(time_interval, aoi, config):
         time=date_range,
         fields={"include": ["id", "properties.eo:cloud_cover", "properties.platform"], "exclude": ["properties.datetime"]},
     )
-    results = list(search_iterator)
-
-    # Filtrar resultados únicos por ID
-    unique_results = {}
-    for item in results:
-        acquisition_id = item['id'].split('_T')[0]
-        if acquisition_id not in unique_results:
-            unique_results[acquisition_id] = item
-
 
     item_data = []
-    # Mostrar la nubosidad por fecha
-    for item in unique_results.values():
+    for item in search_iterator:
+        # S2A_MSIL1C_20220714T105631_N0400_R094_T30SXG_20220714T145047.SAFE
         image_id = item['id']
-        date = datetime.strptime(image_id.split('_')[2][:8], "%Y%m%d").date()
-        cloud_cover = item["properties"]["eo:cloud_cover"]
+        parts = image_id.split('_')
+        date = datetime.strptime(parts[2][:8], "%Y%m%d").date()
 
         item_data.append({
+            "id": image_id,
+            "acquisition_id": image_id.split('_T')[0],
             "date": date.strftime("%Y-%m-%d"),
-            "cloud_cover": cloud_cover,
+            "tile": parts[5] if len(parts) > 5 else "",
+            "cloud_cover": item["properties"]["eo:cloud_cover"],
             "platform": item["properties"].get("platform", "UNKNOWN")
-
         })
     return item_data
 
 
-slots = []
-current_start = start_date
-
-while current_start <= end_date:
-    current_end = min(current_start + timedelta(days=1), end_date)
-    slots.append((
-        current_start.strftime("%Y-%m-%d"),
-        current_end.strftime("%Y-%m-%d")
-    ))
-    current_start = current_end + timedelta(days=1)
-
-
-csv_data = []
-for time_interval in slots: 
-
-    csv_data.append(check_cloud_cover(
-        time_interval=time_interval,
-        aoi= area_of_interest,  # Example coordinates (W, S, E, N) # Whole tile is [-1.862, 36.935, -0.645, 37.942] || Our AOI: [-0.86, 37.65, -0.74, 37.8]
-        config=config
-    ))
+# === Caché local del catálogo ===
+# items: productos por AOI; coverage: rangos de fechas ya consultados para cada AOI y cuándo se consultaron.
+# Un día está cubierto si algún rango lo incluye y se consultó al menos catalog_staleness_days después de esa
+# fecha (antes, el catálogo aún puede añadir productos o cambiar la nubosidad).
+
+def aoi_key(aoi) -> str:
+    """Clave del AOI en la caché: colección y bbox redondeado a 1e-6 grados."""
+    return json.dumps(["SENTINEL2_L1C"] + [round(float(v), 6) for v in aoi])
+
+
+def open_catalog_cache(path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    con = sqlite3.connect(path)
+    con.executescript("""
+        CREATE TABLE IF NOT EXISTS items (
+            aoi TEXT NOT NULL,
+            id TEXT NOT NULL,
+            acquisition_id TEXT NOT NULL,
+            date TEXT NOT NULL,
+            tile TEXT,
+            cloud_cover REAL,
+            platform TEXT,
+            PRIMARY KEY (aoi, id)
+        );
+        CREATE INDEX IF NOT EXISTS items_aoi_date ON items (aoi, date);
+        CREATE TABLE IF NOT EXISTS coverage (
+            aoi TEXT NOT NULL,
+            start_date TEXT NOT NULL,
+            end_date TEXT NOT NULL,
+            fetched_at TEXT NOT NULL
+        );
+    """)
+    return con
+
+
+def uncovered_ranges(con, aoi, start, end, staleness_days):
+    """
+    Rangos (inicio, fin) de fechas (datetime, inclusive) entre start y end que no están en la caché o cuya
+    consulta es demasiado reciente respecto a la fecha (ver arriba).
+    """
+    rows = con.execute("SELECT start_date, end_date, fetched_at FROM coverage "
+                       "WHERE aoi = ? AND start_date <= ? AND end_date >= ?",
+                       (aoi, end.strftime("%Y-%m-%d"), start.strftime("%Y-%m-%d"))).fetchall()
+    coverage = [(datetime.strptime(s, "%Y-%m-%d"), datetime.strptime(e, "%Y-%m-%d"), datetime.fromisoformat(f))
+                for s, e, f in rows]
+
+    ranges = []
+    day = start
+    while day <= end:
+        covered = any(s <= day <= e and f - day >= timedelta(days=staleness_days) for s, e, f in coverage)
+        if not covered:
+            if ranges and ranges[-1][1] == day - timedelta(days=1):
+                ranges[-1] = (ranges[-1][0], day)
+            else:
+                ranges.append((day, day))
+        day += timedelta(days=1)
+    return ranges
+
+
+def store_range(con, aoi, start, end, items, now):
+    """Sustituye en la caché los productos del rango y lo marca como consultado en now."""
+    s, e = start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+    with con:
+        con.execute("DELETE FROM items WHERE aoi = ? AND date BETWEEN ? AND ?", (aoi, s, e))
+        con.executemany(
+            "INSERT OR REPLACE INTO items (aoi, id, acquisition_id, date, tile, cloud_cover, platform) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(aoi, i["id"], i["acquisition_id"], i["date"], i["tile"], i["cloud_cover"], i["platform"]) for i in items])
+        # Los rangos anteriores contenidos en este quedan sustituidos
+        con.execute("DELETE FROM coverage WHERE aoi = ? AND start_date >= ? AND end_date <= ?", (aoi, s, e))
+        con.execute("INSERT INTO coverage (aoi, start_date, end_date, fetched_at) VALUES (?, ?, ?, ?)",
+                    (aoi, s, e, now.isoformat(timespec="seconds")))
+
+
+def cached_dates(con, aoi, start, end):
+    """Una fila por adquisición (date, cloud_cover, platform) entre start y end, como available_dates.csv."""
+    rows = con.execute(
+        "SELECT acquisition_id, date, cloud_cover, platform FROM items WHERE aoi = ? AND date BETWEEN ? AND ? "
+        "ORDER BY date, rowid",
+        (aoi, start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"))).fetchall()
+
+    # Filtrar resultados únicos por adquisición (una fila aunque el AOI corte varios tiles)
+    unique_results = {}
+    for acquisition_id, date, cloud_cover, platform in rows:
+        if acquisition_id not in unique_results:
+            unique_results[acquisition_id] = {"date": date, "cloud_cover": cloud_cover, "platform": platform}
+    return list(unique_results.values())
+
+
+now = datetime.now()
+aoi = aoi_key(area_of_interest)
+con = open_catalog_cache(catalog_cache)
+
+if args.refresh:
+    missing = [(start_date, end_date)]
+else:
+    missing = uncovered_ranges(con, aoi, start_date, end_date, catalog_staleness_days)
+
+if missing and args.offline:
+    print("Modo offline: rangos sin consultar en la caché: " +
+          ", ".join(f"[{s.date()} - {e.date()}]" for s, e in missing))
+elif missing:
+    config = sh_config()
+    for range_start, range_end in missing:
+        print(f"Consultando el catálogo para [{range_start.date()} - {range_end.date()}]")
+        items = check_cloud_cover(
+            time_interval=(range_start.strftime("%Y-%m-%d"), range_end.strftime("%Y-%m-%d")),
+            aoi= area_of_interest,  # Example coordinates (W, S, E, N) # Whole tile is [-1.862, 36.935, -0.645, 37.942] || Our AOI: [-0.86, 37.65, -0.74, 37.8]
+            config=config
+        )
+        store_range(con, aoi, range_start, range_end, items, now)
+else:
+    print("Rango completo en la caché del catálogo")
 
-# Aplanar la lista de listas (eliminar niveles intermedios)
-csv_data = [item for sublist in csv_data for item in sublist if sublist]
+csv_data = cached_dates(con, aoi, start_date, end_date)
+con.close()
 
 # Guardar los resultados en CSV
 csv_path = os.path.join(date_dir, 'available_dates.csv')
@@ -135,4 +236,4 @@ with open(csv_path, 'w', newline='') as csvfile:
 
 print(f"\nFechas disponibles para el periodo [{start_date.date()} - {end_date.date()}]:\n")
 for d in csv_data:
-    print(f"{d['date']} - Cloud cover: {d['cloud_cover']}%")
\ No newline at end of file
+    print(f"{d['date']} - Cloud cover: {d['cloud_cover']}%")
@@ -4,177 +4,194 @@ import sys
 import yaml
 import subprocess
 
-# ========================
-# === Argumentos ========
-# ========================
-
-if len(sys.argv) != 4:
-    print("Uso: python snap_batch_application.py <fecha> <input_dir> <output_dir>")
-    sys.exit(1)
-
-FECHA = sys.argv[1]
-INPUT_DIR = sys.argv[2]
-OUTPUT_DIR = sys.argv[3]
-
 # ================================
 # === Cargar config.yaml ========
 # ================================
 
 CONFIG_FILE = "/app/config.yaml"
 
-with open(CONFIG_FILE, "r") as f:
-    cfg = yaml.safe_load(f)
 
-GRAPH_XML = cfg["batch_template"]["graph_xml"]
-TEMPLATE_PARAMS = cfg["batch_template"]["template_params"]
-GPT = cfg["batch_template"]["gpt_bin"]
-output_format = cfg["batch_template"]["output_format"]
-resample_resolution = cfg["batch_template"]["resampleResolution"]
-geo_region = cfg["batch_template"]["geoRegion"]
-salinity = cfg["batch_template"]["salinity"]
-temperature = cfg["batch_template"]["temperature"]
-net = cfg["batch_template"]["netSet"]
-output_rtoa = cfg["batch_template"]["outputRtoa"]
-output_ac_reflectance = cfg["batch_template"]["outputAcReflectance"]
-output_rhown = cfg["batch_template"]["outputRhown"]
-band_subset = cfg["batch_template"]["bandSubset"]
+def run_snap(fecha, input_dir, output_dir, cfg=None, config_file=CONFIG_FILE):
+    """
+    Aplica el grafo de SNAP (gpt) a los .SAFE.zip de input_dir de la fecha indicada y deja los TIFFs en
+    output_dir. cfg es el config.yaml ya cargado; si no se pasa se lee de config_file.
+
+    Returns:
+        lista de ficheros de salida generados
+    """
+    if cfg is None:
+        with open(config_file, "r") as f:
+            cfg = yaml.safe_load(f)
+
+    GRAPH_XML = cfg["batch_template"]["graph_xml"]
+    TEMPLATE_PARAMS = cfg["batch_template"]["template_params"]
+    GPT = cfg["batch_template"]["gpt_bin"]
+    output_format = cfg["batch_template"]["output_format"]
+    resample_resolution = cfg["batch_template"]["resampleResolution"]
+    geo_region = cfg["batch_template"]["geoRegion"]
+    salinity = cfg["batch_template"]["salinity"]
+    temperature = cfg["batch_template"]["temperature"]
+    net = cfg["batch_template"]["netSet"]
+    output_rtoa = cfg["batch_template"]["outputRtoa"]
+    output_ac_reflectance = cfg["batch_template"]["outputAcReflectance"]
+    output_rhown = cfg["batch_template"]["outputRhown"]
+    band_subset = cfg["batch_template"]["bandSubset"]
+
+    INPUT_DIR = input_dir
+    OUTPUT_DIR = output_dir
+
+    # ========================
+    # === Validaciones ======
+    # ========================
+
+    if not os.path.isdir(INPUT_DIR):
+        raise FileNotFoundError(f"No se encuentra el directorio de entrada: {INPUT_DIR}")
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    # ================================
+    # === Información inicial ========
+    # ================================
+
+    print(f"=== Ejecutando SNAP para la fecha: {fecha} ===")
+    print(f"Input:  {INPUT_DIR}")
+    print(f"Output: {OUTPUT_DIR}")
+    print(f"Usando GPT en: {GPT}")
+
+    # ================================
+    # === Filtrado de productos ======
+    # ================================
+
+    FILTER_DATE = fecha.replace("-", "")  # 2022-07-14 -> 20220714
+    FILTER_DATES = [FILTER_DATE]
+
+    if FILTER_DATES:
+        print(f"Procesando las fechas: {FILTER_DATES}")
+    else:
+        print("Procesando todos los archivos disponibles")
 
+    # ===============================
+    # === Procesar archivos SAFE ====
+    # ===============================
 
+    output_files = []
+    for filename in sorted(os.listdir(INPUT_DIR)):
 
-# ========================
-# === Validaciones ======
-# ========================
+        if not filename.endswith(".SAFE.zip"):
+            continue
+        print(f"Nombre: {filename}")
+        input_file = os.path.join(INPUT_DIR, filename)
 
-if not os.path.isdir(INPUT_DIR):
-    print(f"No se encuentra el directorio de entrada: {INPUT_DIR}")
-    sys.exit(1)
+        parts = filename.split("_")
+        if len(parts) < 3:
+            print(f"Formato inesperado: {filename}, saltando...")
+            continue
 
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+        datecode = parts[2][:8]
+        base_name = filename.replace(".SAFE.zip", "")
 
-# ================================
-# === Información inicial ========
-# ================================
+        print(f"\n\n{filename}\n")
 
-print(f"=== Ejecutando SNAP para la fecha: {FECHA} ===")
-print(f"Input:  {INPUT_DIR}")
-print(f"Output: {OUTPUT_DIR}")
-print(f"Usando GPT en: {GPT}")
+        # Filtrar por fecha
+        if FILTER_DATES and datecode not in FILTER_DATES:
+            print(f"Saltando {filename} (fecha {datecode} no en filtro)")
+            continue
 
-# ================================
-# === Filtrado de productos ======
-# ================================
+        # Selección de red
+        if net == "C2X-COMPLEX-Nets":
+            suffix = "C2XComplexNets"
+        elif net == "C2X-Nets":
+            suffix = "C2XNets"
+        else:
+            suffix = "C2RCCNets"
 
-FILTER_DATE = FECHA.replace("-", "")  # 2022-07-14 -> 20220714
-FILTER_DATES = [FILTER_DATE]
+        output_file = os.path.join(
+            OUTPUT_DIR,
+            f"{base_name}_{suffix}_10m.{output_format}"
+        )
 
-if FILTER_DATES:
-    print(f"Procesando las fechas: {FILTER_DATES}")
-else:
-    print("Procesando todos los archivos disponibles")
+        # ===========================
+        # === Crear param file ======
+        # ===========================
 
-# ===============================
-# === Procesar archivos SAFE ====
-# ===============================
+        param_file = f"/tmp/params_{datecode}.params"
 
-for filename in sorted(os.listdir(INPUT_DIR)):
+        with open(TEMPLATE_PARAMS, "r") as f:
+            template_lines = f.readlines()
 
-    if not filename.endswith(".SAFE.zip"):
-        continue
-    print(f"Nombre: {filename}")
-    input_file = os.path.join(INPUT_DIR, filename)
+        new_lines = []
+        for line in template_lines:
+            if line.startswith("inputFile="):
+                new_lines.append(f"inputFile={input_file}\n")
 
-    parts = filename.split("_")
-    if len(parts) < 3:
-        print(f"Formato inesperado: {filename}, saltando...")
-        continue
+            elif line.startswith("outputFile="):
+                new_lines.append(f"outputFile={output_file}\n")
 
-    datecode = parts[2][:8]
-    base_name = filename.replace(".SAFE.zip", "")
+            elif line.startswith("outputFormat="):
+                new_lines.append(f"outputFormat={output_format}\n")
 
-    print(f"\n\n{filename}\n")
+            elif line.startswith("resampleResolution="):
+                new_lines.append(f"resampleResolution={resample_resolution}\n")
 
-    # Filtrar por fecha
-    if FILTER_DATES and datecode not in FILTER_DATES:
-        print(f"Saltando {filename} (fecha {datecode} no en filtro)")
-        continue
+            elif line.startswith("geoRegion="):
+                new_lines.append(f"geoRegion={geo_region}\n")
 
-    # Selección de red
-    if net == "C2X-COMPLEX-Nets":
-        suffix = "C2XComplexNets"
-    elif net == "C2X-Nets":
-        suffix = "C2XNets"
-    else:
-        suffix = "C2RCCNets"
-
-    output_file = os.path.join(
-        OUTPUT_DIR,
-        f"{base_name}_{suffix}_10m.{output_format}"
-    )
-
-    # ===========================
-    # === Crear param file ======
-    # ===========================
-
-    param_file = f"/tmp/params_{datecode}.params"
-
-    with open(TEMPLATE_PARAMS, "r") as f:
-        template_lines = f.readlines()
-
-    new_lines = []
-    for line in template_lines:
-        if line.startswith("inputFile="):
-            new_lines.append(f"inputFile={input_file}\n")
-            
-        elif line.startswith("outputFile="):
-            new_lines.append(f"outputFile={output_file}\n")
-            
-        elif line.startswith("outputFormat="):
-            new_lines.append(f"outputFormat={output_format}\n")
-            
-        elif line.startswith("resampleResolution="):
-            new_lines.append(f"resampleResolution={resample_resolution}\n")
-            
-        elif line.startswith("geoRegion="):
-            new_lines.append(f"geoRegion={geo_region}\n")
-            
-        elif line.startswith("salinity="):
-            new_lines.append(f"salinity={salinity}\n")
-            
-        elif line.startswith("temperature="):
-            new_lines.append(f"temperature={temperature}\n")
-            
-        elif line.startswith("netSet="):
-            new_lines.append(f"netSet={net}\n")
-            
-        elif line.startswith("outputRtoa="):
-            new_lines.append(f"outputRtoa={output_rtoa}\n")
-            
-        elif line.startswith("outputAcReflectance="):
-            new_lines.append(f"outputAcReflectance={output_ac_reflectance}\n")
-            
-        elif line.startswith("outputRhown="):
-            new_lines.append(f"outputRhown={output_rhown}\n")
-            
-        elif line.startswith("bandSubset="):
-            new_lines.append(f"bandSubset={band_subset}\n")
-        
-        else:
-            new_lines.append(line)
+            elif line.startswith("salinity="):
+                new_lines.append(f"salinity={salinity}\n")
+
+            elif line.startswith("temperature="):
+                new_lines.append(f"temperature={temperature}\n")
+
+            elif line.startswith("netSet="):
+                new_lines.append(f"netSet={net}\n")
+
+            elif line.startswith("outputRtoa="):
+                new_lines.append(f"outputRtoa={output_rtoa}\n")
+
+            elif line.startswith("outputAcReflectance="):
+                new_lines.append(f"outputAcReflectance={output_ac_reflectance}\n")
+
+            elif line.startswith("outputRhown="):
+                new_lines.append(f"outputRhown={output_rhown}\n")
+
+            elif line.startswith("bandSubset="):
+                new_lines.append(f"bandSubset={band_subset}\n")
+
+            else:
+                new_lines.append(line)
 
-    with open(param_file, "w") as f:
-        f.writelines(new_lines)
+        with open(param_file, "w") as f:
+            f.writelines(new_lines)
 
-    # ===========================
-    # === Ejecutar GPT ==========
-    # ===========================
+        # ===========================
+        # === Ejecutar GPT ==========
+        # ===========================
 
-    print(f"Procesando {filename} → {output_file}")
-    print(f"param_file")
-    print(f"GPT")
-    print(f"GRAPH_XML")
+        print(f"Procesando {filename} → {output_file}")
+        print(f"param_file")
+        print(f"GPT")
+        print(f"GRAPH_XML")
+
+        subprocess.run(
+            [GPT, GRAPH_XML, "-p", param_file],
+            check=True
+        )
+        output_files.append(output_file)
+
+    return output_files
+
+
+# ========================
+# === Argumentos ========
+# ========================
 
-    subprocess.run(
-        [GPT, GRAPH_XML, "-p", param_file],
-        check=True
-    )
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print("Uso: python snap_batch_application.py <fecha> <input_dir> <output_dir>")
+        sys.exit(1)
 
+    try:
+        run_snap(sys.argv[1], sys.argv[2], sys.argv[3])
+    except FileNotFoundError as e:
+        print(e)
+        sys.exit(1)
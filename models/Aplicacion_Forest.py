@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import tempfile
+import numpy as np
+from Aplicacion_utils import *
+
+# Exporta los modelos de árboles (XGBoost, CatBoost, RandomForest de scikit-learn) a bosques compilados
+# {stem}_forest.npz, que Aplicacion_utils.CompiledForest evalúa solo con NumPy. Antes de guardar cada bosque
+# se comparan sus predicciones con las de la librería original sobre una matriz de comprobación.
+
+
+def _assemble(trees, base_score=0.0, scale=1.0, strict_less=False, n_features=None, source=""):
+    """
+    Une los árboles en un único CompiledForest. Cada árbol es un dict con arrays locales
+    feature, threshold, left, right, value y default_left (left/right = -1 en las hojas).
+    """
+    fields = {name: [] for name in CompiledForest.FIELDS if name != "roots"}
+    roots = []
+    offset = 0
+    for tree in trees:
+        n_nodes = len(tree["feature"])
+        leaf = np.asarray(tree["left"]) < 0
+        local = np.arange(n_nodes)
+
+        # Las hojas apuntan a sí mismas y comparan con la columna 0 (el resultado da igual)
+        fields["feature"].append(np.where(leaf, 0, tree["feature"]))
+        fields["threshold"].append(np.where(leaf, 0.0, tree["threshold"]))
+        fields["left"].append(np.where(leaf, local, tree["left"]) + offset)
+        fields["right"].append(np.where(leaf, local, tree["right"]) + offset)
+        fields["value"].append(np.where(leaf, tree["value"], 0.0))
+        fields["default_left"].append(np.asarray(tree["default_left"], dtype=bool))
+        roots.append(offset)
+        offset += n_nodes
+
+    arrays = {name: np.concatenate(values) for name, values in fields.items()}
+    return CompiledForest(roots=np.asarray(roots), base_score=base_score, scale=scale, strict_less=strict_less,
+                          n_features=n_features, source=source, **arrays)
+
+
+def _xgb_forest(model):
+    """
+    XGBRegressor (gbtree): va a la izquierda si x < split_condition; los NaN siguen default_left.
+    Solo objetivos de regresión con enlace identidad.
+    """
+    booster = model.get_booster()
+    learner = json.loads(booster.save_raw("json"))["learner"]
+
+    objective = learner["objective"]["name"]
+    if objective not in ("reg:squarederror", "reg:linear", "reg:absoluteerror", "reg:pseudohubererror"):
+        raise ValueError(f"Objetivo de XGBoost no soportado: {objective}")
+    gbm = learner["gradient_booster"]
+    if gbm["name"] != "gbtree":
+        raise ValueError(f"Booster de XGBoost no soportado: {gbm['name']}")
+
+    trees = gbm["model"]["trees"]
+    try:
+        # mismo rango de árboles que predict_array (iteration_range hasta best_iteration)
+        n_parallel = int(gbm["model"]["gbtree_model_param"].get("num_parallel_tree", 1))
+        trees = trees[:(model.best_iteration + 1) * n_parallel]
+    except AttributeError:
+        pass
+
+    compiled = []
+    for tree in trees:
+        if any(int(t) != 0 for t in tree.get("split_type", [])):
+            raise ValueError("Los splits categóricos de XGBoost no están soportados")
+        left = np.asarray(tree["left_children"], dtype=np.int64)
+        compiled.append({
+            "feature": np.asarray(tree["split_indices"], dtype=np.int64),
+            # los umbrales y las hojas son float32 en XGBoost
+            "threshold": np.asarray(tree["split_conditions"], dtype=np.float32).astype(np.float64),
+            "left": left,
+            "right": np.asarray(tree["right_children"], dtype=np.int64),
+            "value": np.asarray(tree["split_conditions"], dtype=np.float32).astype(np.float64),
+            "default_left": np.asarray(tree["default_left"], dtype=bool),
+        })
+
+    # base_score es '1.94E0' o '[1.94E0]' según la versión de XGBoost
+    base_score = float(learner["learner_model_param"]["base_score"].strip("[]"))
+    return _assemble(compiled, base_score=base_score, strict_less=True,
+                     n_features=int(learner["learner_model_param"]["num_feature"]), source="xgboost")
+
+
+def _catboost_forest(model):
+    """
+    CatBoostRegressor con árboles simétricos: en cada nivel el bit i es x > border del split i y la hoja es
+    sum(bit_i << i). Se convierte a árbol binario completo (va a la izquierda si x <= border).
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_path = os.path.join(tmp_dir, "model.json")
+        model.save_model(json_path, format="json")
+        with open(json_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+    if "oblivious_trees" not in data:
+        raise ValueError("Solo se soportan modelos de CatBoost con árboles simétricos")
+    float_features = data["features_info"].get("float_features", [])
+    if set(data["features_info"]) - {"float_features"}:
+        raise ValueError("Solo se soportan modelos de CatBoost con variables numéricas")
+
+    flat_index = {f["feature_index"]: f["flat_feature_index"] for f in float_features}
+    # Con NaN 'AsTrue' el bit vale 1 (derecha); con 'AsIs'/'AsFalse' vale 0 (izquierda)
+    nan_left = {f["feature_index"]: f.get("nan_value_treatment") != "AsTrue" for f in float_features}
+
+    compiled = []
+    for tree in data["oblivious_trees"]:
+        splits = tree["splits"]
+        depth = len(splits)
+        if len(tree["leaf_values"]) != 1 << depth:
+            raise ValueError("Solo se soportan modelos de CatBoost con una dimensión de salida")
+        if any(split["split_type"] != "FloatFeature" for split in splits):
+            raise ValueError("Solo se soportan splits de CatBoost sobre variables numéricas")
+
+        # Nodos por niveles: el nodo k del nivel l está en (2^l - 1) + k y su camino son los bits 0..l-1
+        n_nodes = (1 << (depth + 1)) - 1
+        tree_arrays = {
+            "feature": np.zeros(n_nodes, dtype=np.int64),
+            "threshold": np.zeros(n_nodes),
+            "left": np.full(n_nodes, -1, dtype=np.int64),
+            "right": np.full(n_nodes, -1, dtype=np.int64),
+            "value": np.zeros(n_nodes),
+            "default_left": np.ones(n_nodes, dtype=bool),
+        }
+        for level, split in enumerate(splits):
+            first = (1 << level) - 1
+            for k in range(1 << level):
+                node = first + k
+                tree_arrays["feature"][node] = flat_index[split["float_feature_index"]]
+                tree_arrays["threshold"][node] = np.float32(split["border"])
+                tree_arrays["default_left"][node] = nan_left[split["float_feature_index"]]
+                # izquierda: bit 0; derecha: bit 1 en la posición 'level'
+                tree_arrays["left"][node] = (1 << (level + 1)) - 1 + k
+                tree_arrays["right"][node] = (1 << (level + 1)) - 1 + k + (1 << level)
+        first_leaf = (1 << depth) - 1
+        tree_arrays["value"][first_leaf:] = tree["leaf_values"]
+        compiled.append(tree_arrays)
+
+    scale, bias = data.get("scale_and_bias", [1.0, [0.0]])
+    bias = bias[0] if isinstance(bias, list) else bias
+    return _assemble(compiled, base_score=bias, scale=scale, n_features=len(float_features), source="catboost")
+
+
+def _sklearn_forest(model):
+    """
+    RandomForestRegressor / ExtraTreesRegressor / DecisionTreeRegressor: va a la izquierda si
+    x <= threshold (x en float32 y umbral en float64, como scikit-learn). Promedio de los árboles.
+    """
+    estimators = getattr(model, "estimators_", None) or [model]
+    compiled = []
+    for estimator in estimators:
+        tree = estimator.tree_
+        if tree.n_outputs != 1:
+            raise ValueError("Solo se soportan árboles de scikit-learn con una salida")
+        left = tree.children_left.astype(np.int64)
+        compiled.append({
+            "feature": np.where(left < 0, 0, tree.feature).astype(np.int64),
+            "threshold": tree.threshold.astype(np.float64),
+            "left": left,
+            "right": tree.children_right.astype(np.int64),
+            "value": tree.value[:, 0, 0].astype(np.float64),
+            "default_left": getattr(tree, "missing_go_to_left", np.ones(len(left))).astype(bool),
+        })
+    return _assemble(compiled, scale=1.0 / len(compiled), n_features=model.n_features_in_, source="sklearn")
+
+
+def compile_forest(model) -> CompiledForest:
+    """
+    Convierte un modelo de árboles ya cargado en CompiledForest.
+    """
+    name = type(model).__name__
+    if name.startswith("XGB"):
+        return _xgb_forest(model)
+    if name.startswith("CatBoost"):
+        return _catboost_forest(model)
+    if name in ("RandomForestRegressor", "ExtraTreesRegressor", "DecisionTreeRegressor", "ExtraTreeRegressor"):
+        return _sklearn_forest(model)
+    raise ValueError(f"Modelo no soportado para compilar: {name}")
+
+
+def check_matrix(forest: CompiledForest, n_rows: int = 5000, seed: int = 0):
+    """
+    Matriz float32 de comprobación: cada columna toma valores de los umbrales del bosque para esa variable,
+    exactos o desplazados un ulp arriba o abajo, de modo que se prueban las dos ramas y los empates.
+    """
+    rng = np.random.default_rng(seed)
+    X = np.zeros((n_rows, forest.n_features), dtype=np.float32)
+    internal = forest.left != np.arange(len(forest.left))
+    for j in range(forest.n_features):
+        thresholds = forest.threshold[internal & (forest.feature == j)].astype(np.float32)
+        if not len(thresholds):
+            continue
+        values = rng.choice(thresholds, size=n_rows)
+        shift = rng.integers(-1, 2, size=n_rows)
+        values = np.where(shift > 0, np.nextafter(values, np.float32(np.inf)), values)
+        values = np.where(shift < 0, np.nextafter(values, np.float32(-np.inf)), values)
+        X[:, j] = values
+    return X
+
+
+def export_forest(registry: ModelRegistry, dataset_name: str, model_name: str, n_check: int = 5000,
+                  tol: float = 1e-4):
+    """
+    Compila el modelo dataset_name/model_name del registro, comprueba que predice lo mismo que la librería
+    (|diferencia| <= tol * (1 + |y|)) y lo guarda como {stem}_forest.npz junto al resto de artefactos.
+
+    Returns:
+        (ruta del npz, máxima diferencia absoluta)
+    """
+    entry = registry.entry(dataset_name, model_name)
+    model = load_model_for_entry(dataset_name, model_name, entry)
+    forest = compile_forest(model)
+
+    X = check_matrix(forest, n_rows=n_check)
+    y_ref = np.asarray(predict_array(model, X), dtype=np.float64).ravel()
+    y_hat = forest.predict(X)
+    max_diff = float(np.max(np.abs(y_hat - y_ref))) if len(X) else 0.0
+    if not np.all(np.abs(y_hat - y_ref) <= tol * (1 + np.abs(y_ref))):
+        raise ValueError(f"El bosque compilado no coincide con {forest.source} (máxima diferencia {max_diff:.3g})")
+
+    forest_path = os.path.join(registry.models_dir, f"{dataset_name}_{model_name}_forest.npz")
+    tmp_path = f"{forest_path}.tmp.npz"
+    np.savez_compressed(tmp_path, checked_rows=len(X), max_abs_diff=max_diff, **forest.to_arrays())
+    os.replace(tmp_path, forest_path)
+    return forest_path, max_diff
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", required=True, help="Directorio donde están los modelos para cada profundidad")
+    parser.add_argument("--check-rows", default=5000, type=int, help="Filas de la matriz de comprobación")
+    parser.add_argument("--tol", default=1e-4, type=float, help="Tolerancia relativa frente a la librería original")
+    args = parser.parse_args()
+
+    registry = ModelRegistry(args.models)
+    for dataset_name, entries in sorted(registry.artifacts.items()):
+        for model_name in sorted(entries):
+            if not any(k in entries[model_name] for k in ("model_path", "model_path_json", "model_path_cbm")):
+                continue
+            try:
+                forest_path, max_diff = export_forest(registry, dataset_name, model_name,
+                                                      n_check=args.check_rows, tol=args.tol)
+                print(f"{dataset_name}/{model_name}: {forest_path} (máxima diferencia {max_diff:.3g})")
+            except ValueError as e:
+                print(f"{dataset_name}/{model_name}: no se compila ({e})")
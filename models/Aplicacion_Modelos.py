@@ -1,100 +1,390 @@
 import pandas as pd
 import os
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from Aplicacion_utils import *
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--date", required=True, type=str, help="Fecha del producto a descargar (YYYY-MM-DD)")
-parser.add_argument("--input", required=True, help="Directorio donde está el .tif procesado por SNAP")
-parser.add_argument("--models", required=True, help="Directorio donde están los modelos para cada profundidad")
-parser.add_argument("--pred", required=True, help="Directorio dondese guarda el csv con las predicciones")
-parser.add_argument("--geojson", required=True, help="Fichero con geojson del Mar Menor")
-args = parser.parse_args()
-
-folder_path =args.input
-polygon_path=args.geojson
-# Hacer las fechas de una en una porque pesan mucho
-date_str = str(args.date)
-target_dates = [
-    date_str
-]
+# Modelo usado para cada profundidad
+selection = {
+    'C2X-Complex_rhow_9x9_depth_in_0_1': 'XGB',
+    'C2X-Complex_rhow_9x9_depth_in_1_2': 'CAT',
+    #'TOA_9x9_depth_in_2_3': 'KNN',
+    'C2X-Complex_rhow_5x5_depth_in_2_3': 'CAT',
+    'C2X-Complex_rhow_5x5_depth_in_3_4': 'RF',
+}
 
 groupings = ["5x5", "9x9"]
 net_set = ["C2X-Complex"]
 
-for grouping in groupings:
+PRED_COLUMNS = PIXEL_COLUMNS + ["Chl_pred_0_1", "Chl_pred_1_2", "Chl_pred_2_3", "Chl_pred_3_4"]
+
+
+def input_frame_name(dataset):
+    """
+    DataFrame de entrada de un dataset: 'C2X-Complex_rhow_9x9_depth_in_0_1' -> 'df_tifs_C2X-Complex_rhow_9x9',
+    'TOA_9x9_depth_in_2_3' -> 'df_tifs_TOA_9x9'.
+    """
+    return f"df_tifs_{dataset.split('_depth_in_')[0]}"
+
+
+def has_date_tiffs(folder_path, date):
+    """Hay TIFF de SNAP de la fecha para todos los conjuntos de redes de net_set."""
+    return all(find_date_tiff(folder_path, list_net_tiffs(folder_path, net), str(date)) is not None
+               for net in net_set)
+
+
+def require_date_tiffs(folder_path, date):
+    """Error claro si falta el TIFF de SNAP de la fecha (en lugar de unas predicciones vacías)."""
+    if not has_date_tiffs(folder_path, date):
+        raise FileNotFoundError(f"No hay TIFF de SNAP ({', '.join(net_set)}) para la fecha {date} en {folder_path}")
+
+
+def build_feature_frames(date, folder_path, polygon_path, carpeta_modelos, mask_cache_dir=None, fmt="parquet",
+                         export_tables=False):
+    """
+    Extrae los píxeles del TIFF de SNAP de una fecha y construye los DataFrames con las variables
+    que necesitan los modelos de 'selection', sin pasar por disco. Con export_tables las reflectancias
+    se guardan además en folder_path como df_tifs_{net}_{grouping}_{date} en el formato intermedio 'fmt'
+    (parquet, npy o csv).
+
+    Returns:
+        dict {nombre: DataFrame} (df_tifs_C2X-Complex_rhow_5x5, df_tifs_C2X-Complex_rhow_9x9, df_tifs_TOA_9x9)
+    """
+    # Hacer las fechas de una en una porque pesan mucho
+    target_dates = [
+        str(date)
+    ]
+
+    # Tablas de los tifs, con el nombre del archivo sin la fecha
+    dfs_tifs = {}
     for net in net_set:
-        df_tiffs = extract_pixels_in_marmenor(folder_path, target_dates, grouping, net, polygon_path)
-        df_tiffs["Date"] = pd.to_datetime(df_tiffs["Date"])
-        df_tiffs.to_csv(f"{folder_path}/df_tifs_{net}_{grouping}_{target_dates[0]}.csv", index=False)
-
-print("DataFrames con reflectancias cargados")
-
-# Cargamos los csv de los tifs
-path = folder_path
-dfs_tifs = {}
-for archivo in os.listdir(path):
-    if archivo.startswith("df_tifs_") and archivo.endswith(f"{target_dates[0]}.csv") and "planet" not in archivo:
-        nombre_sin_extension = os.path.splitext(archivo)[0]  # sin .csv
-        ruta_completa = os.path.join(path, archivo)
-        # Guardamos el nombre del archivo sin la fecha
-        dfs_tifs[nombre_sin_extension[:-11]] = pd.read_csv(ruta_completa)
-
-# Limpiamos nulos
-for nombre_df, df in dfs_tifs.items():
-    for band_set in ["rhow", "rhown","rtoa"]:
+        # Una sola lectura del TIFF de SNAP para todos los agrupamientos
+        dfs_groupings = extract_pixels_in_marmenor_groupings(folder_path, target_dates, groupings, net, polygon_path,
+                                                             mask_cache_dir=mask_cache_dir)
+        for grouping, df_tiffs in dfs_groupings.items():
+            df_tiffs["Date"] = pd.to_datetime(df_tiffs["Date"])
+            if export_tables:
+                write_table(df_tiffs, f"{folder_path}/df_tifs_{net}_{grouping}_{target_dates[0]}", fmt)
+            dfs_tifs[f"df_tifs_{net}_{grouping}"] = df_tiffs
+
+    print("DataFrames con reflectancias cargados")
+
+    # Limpiamos nulos
+    for nombre_df, df in dfs_tifs.items():
         dfs_tifs[nombre_df] = df.dropna()
 
-        # Dataframes con procesado C2X 5x5, C2X 9x9 y TOA 9x9
-dfs_tifs_all = create_processed_dfs(dfs_tifs)
+    # Dataframes con procesado C2X 5x5, C2X 9x9 y TOA 9x9
+    dfs_tifs_all = create_processed_dfs(dfs_tifs)
 
-dfs = add_band_combinations(dfs_tifs_all)
+    # Solo se calculan los índices de bandas que usan los modelos seleccionados, ya con su nombre final
+    features = required_features(carpeta_modelos, selection)
+    dfs = add_band_combinations(dfs_tifs_all, features=features)
 
-for nombre_df, df in dfs.items():
-    dfs[nombre_df] = compactar_prefijos_columnas(df)
+    dfs = add_season(dfs)
 
-dfs = add_season(dfs)
+    print("Dataframes con combinaciones de bandas y procesados")
+    return dfs
 
-print("Dataframes con combinaciones de bandas y procesados")
 
-carpeta_modelos = args.models
+def default_workers():
+    """Un hilo por profundidad, sin pasar del número de núcleos."""
+    return max(1, min(len(selection), os.cpu_count() or 1))
+
+
+def predict_depths(dfs, carpeta_modelos, registry=None, workers=1, threads_per_model=None):
+    """
+    Aplica el modelo de cada profundidad de 'selection' a su DataFrame de entrada.
+
+    Con workers > 1 los modelos se ejecutan a la vez en hilos (XGBoost y CatBoost liberan el GIL al
+    predecir y RF usa hilos de joblib). threads_per_model limita los hilos internos de cada modelo para
+    no sobresuscribir los núcleos; por defecto se reparten los núcleos entre los workers.
+
+    Returns:
+        pd.DataFrame con Date, Latitude, Longitude, row, col y Chl_pred_* por píxel
+    """
+    registry = registry or get_registry(carpeta_modelos)
+    if workers > 1 and threads_per_model is None:
+        threads_per_model = max(1, (os.cpu_count() or 1) // workers)
+
+    df_in = dfs["df_tifs_C2X-Complex_rhow_9x9"]
+    df_out = pd.DataFrame(df_in.loc[:, [c for c in PIXEL_COLUMNS if c in df_in.columns]])
+
+    # Matrices de features construidas antes de lanzar los hilos; los modelos con el mismo DataFrame y
+    # la misma lista de features comparten matriz
+    matrix_cache = {}
+    for dataset, model_name in selection.items():
+        build_feature_matrix(dfs[input_frame_name(dataset)], registry.get_features(dataset, model_name),
+                             cache=matrix_cache)
+
+    def predict_depth(dataset, model_name):
+        print(dataset, model_name)
+        return predict_with_model(
+                    df=dfs[input_frame_name(dataset)],
+                    models_dir=carpeta_modelos,
+                    dataset_name=dataset,
+                    model_name=model_name,
+                    clip_min=0.2,
+                    strict=True,
+                    registry=registry,
+                    n_threads=threads_per_model,
+                    matrix_cache=matrix_cache
+                )
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {dataset: executor.submit(predict_depth, dataset, model_name)
+                       for dataset, model_name in selection.items()}
+            predictions = {dataset: future.result() for dataset, future in futures.items()}
+    else:
+        predictions = {dataset: predict_depth(dataset, model_name) for dataset, model_name in selection.items()}
+
+    # Las columnas se escriben siempre en el orden de 'selection'
+    for dataset in selection:
+        depth = dataset[-3:]
+        df_out[f"Chl_pred_{depth}"] = predictions[dataset]
+
+    return df_out.loc[:, [c for c in PRED_COLUMNS if c in df_out.columns]]
+
+
+def pred_writers(pred_dir, date, fmt="parquet", export_csv=False, folder_path=None):
+    """
+    TableWriter de {pred_dir}/{date}_pred en el formato intermedio y, si export_csv, también en csv.
+    Si se indica folder_path se guarda además la rejilla del TIFF de SNAP ({date}_pred_grid.json) para
+    escribir los mapas directamente sobre ella con las columnas row/col.
+    """
+    base = os.path.join(pred_dir, f"{date}_pred")
+    grid = snap_grid(folder_path, str(date), net_set[0]) if folder_path else None
+    if grid is not None:
+        write_grid_info(base, grid)
+    writers = [TableWriter(base, fmt)]
+    if export_csv and fmt != "csv":
+        writers.append(TableWriter(base, "csv"))
+    return writers
+
+
+def run_inference(date, folder_path, carpeta_modelos, pred_dir, polygon_path, mask_cache_dir=None, registry=None,
+                  workers=1, threads_per_model=None, fmt="parquet", export_csv=False, export_tables=False):
+    """
+    Predicciones de todas las profundidades para una fecha; se guardan en {pred_dir}/{date}_pred en el
+    formato intermedio 'fmt' (y en {date}_pred.csv si export_csv). Con export_tables se guardan también
+    las reflectancias extraídas (df_tifs_*, ver build_feature_frames).
+
+    Returns:
+        pd.DataFrame con las predicciones
+    """
+    require_date_tiffs(folder_path, date)
+    mask_cache_dir = mask_cache_dir or os.path.join(folder_path, "mask_cache")
+    dfs = build_feature_frames(date, folder_path, polygon_path, carpeta_modelos, mask_cache_dir=mask_cache_dir,
+                               fmt=fmt, export_tables=export_tables)
+    df_out = predict_depths(dfs, carpeta_modelos, registry=registry, workers=workers,
+                            threads_per_model=threads_per_model)
+    for writer in pred_writers(pred_dir, date, fmt, export_csv, folder_path=folder_path):
+        writer.append(df_out)
+        writer.close()
+    return df_out
+
+
+SEASONS = ['Invierno', 'Primavera', 'Verano', 'Otoño']
+
+
+def add_season_streaming(dfs, carry):
+    """
+    add_season por bloques: se antepone la última fila ya rellenada del bloque anterior para que el
+    ffill continúe entre bloques igual que sobre el DataFrame completo. 'carry' se actualiza en el sitio.
+    """
+    for nombre_df, df in dfs.items():
+        prev = carry.get(nombre_df)
+        n_prev = 0 if prev is None else len(prev)
+        if n_prev:
+            df = pd.concat([prev, df])
+
+        df = add_season({nombre_df: df})[nombre_df].iloc[n_prev:]
+        if len(df):
+            carry[nombre_df] = df.drop(columns=SEASONS).tail(1)
+        dfs[nombre_df] = df
+    return dfs
+
+
+def iter_feature_chunks(date, folder_path, polygon_path, features, chunk_size, mask_cache_dir=None):
+    """
+    Recorre los píxeles de una fecha por bloques (iter_pixel_chunks) y devuelve, para cada bloque, los
+    DataFrames con las variables de los modelos, igual que build_feature_frames pero sin csv intermedios.
+
+    Yields:
+        dict {nombre: DataFrame} por bloque
+    """
+    carry = {}
+
+    # Un generador por conjunto de redes; todos recorren los mismos píxeles en el mismo orden
+    chunk_iterators = [
+        iter_pixel_chunks(folder_path, str(date), groupings, net, polygon_path, chunk_size=chunk_size,
+                          mask_cache_dir=mask_cache_dir)
+        for net in net_set
+    ]
+    for chunks in zip(*chunk_iterators):
+        dfs_tifs = {}
+        for net, chunk in zip(net_set, chunks):
+            for grouping, df in chunk.items():
+                # Limpiamos nulos
+                dfs_tifs[f"df_tifs_{net}_{grouping}"] = df.dropna()
+
+        dfs = add_band_combinations(create_processed_dfs(dfs_tifs), features=features)
+        yield add_season_streaming(dfs, carry)
+
+
+def run_inference_streaming(date, folder_path, carpeta_modelos, pred_dir, polygon_path, mask_cache_dir=None,
+                            registry=None, workers=1, threads_per_model=None, max_memory_mb=1024, chunk_size=None,
+                            fmt="parquet", export_csv=False):
+    """
+    Igual que run_inference pero extrayendo, calculando variables y prediciendo por bloques de píxeles
+    (iter_pixel_chunks), de modo que el pico de memoria no depende del tamaño del AOI. Las predicciones
+    se van añadiendo a {pred_dir}/{date}_pred según se calculan, sin pasar por las tablas intermedias de
+    reflectancias.
+
+    Args:
+        max_memory_mb: memoria aproximada por bloque, usada para calcular chunk_size si no se indica
+        chunk_size: píxeles por bloque
+
+    Returns:
+        número de píxeles con predicción
+    """
+    require_date_tiffs(folder_path, date)
+    mask_cache_dir = mask_cache_dir or os.path.join(folder_path, "mask_cache")
+    registry = registry or get_registry(carpeta_modelos)
+    features = required_features(carpeta_modelos, selection)
+    if chunk_size is None:
+        chunk_size = estimate_chunk_size(max_memory_mb, groupings, n_features=len(features))
+
+    writers = pred_writers(pred_dir, date, fmt, export_csv, folder_path=folder_path)
+
+    for dfs in iter_feature_chunks(date, folder_path, polygon_path, features, chunk_size, mask_cache_dir):
+        df_out = predict_depths(dfs, carpeta_modelos, registry=registry, workers=workers,
+                                threads_per_model=threads_per_model)
+        for writer in writers:
+            writer.append(df_out)
+
+    for writer in writers:
+        pred_file = writer.close(columns=PRED_COLUMNS)
+        print(f"Predicciones guardadas en {pred_file} ({writer.n_rows} píxeles)")
+    return writers[0].n_rows
+
+
+# Separación entre los índices de píxel de fechas distintas dentro de un mismo lote
+DATE_INDEX_STRIDE = 1 << 32
+
+
+def run_inference_batch(dates, folder_path, carpeta_modelos, pred_dir, polygon_path, mask_cache_dir=None,
+                        registry=None, workers=1, threads_per_model=None, max_memory_mb=1024, chunk_size=None,
+                        fmt="parquet", export_csv=False):
+    """
+    Predicciones para varias fechas juntando los píxeles de todas en lotes de chunk_size filas, de modo
+    que cada modelo hace una llamada a predict por lote y no una por fecha. Se escribe un
+    {pred_dir}/{date}_pred por fecha, con las mismas filas y en el mismo orden que run_inference. Las fechas
+    sin TIFF de SNAP se saltan con un aviso.
+
+    Args:
+        dates: lista de fechas (YYYY-MM-DD)
+        max_memory_mb: memoria aproximada por lote, usada para calcular chunk_size si no se indica
+        chunk_size: filas por lote
+
+    Returns:
+        dict {fecha: número de píxeles con predicción}
+    """
+    dates = [str(date) for date in dates]
+    missing = [date for date in dates if not has_date_tiffs(folder_path, date)]
+    for date in missing:
+        print(f"AVISO: no hay TIFF de SNAP para la fecha {date} en {folder_path}; se salta")
+    dates = [date for date in dates if date not in missing]
+    mask_cache_dir = mask_cache_dir or os.path.join(folder_path, "mask_cache")
+    registry = registry or get_registry(carpeta_modelos)
+    features = required_features(carpeta_modelos, selection)
+    if chunk_size is None:
+        chunk_size = estimate_chunk_size(max_memory_mb, groupings, n_features=len(features))
+
+    writers = {date: pred_writers(pred_dir, date, fmt, export_csv, folder_path=folder_path) for date in dates}
+    batch = []
+
+    def flush():
+        # Un único DataFrame por entrada de modelo con los bloques de todas las fechas del lote
+        dfs = {nombre_df: pd.concat([dfs_chunk[nombre_df] for dfs_chunk in batch]) for nombre_df in batch[0]}
+        batch.clear()
+        df_out = predict_depths(dfs, carpeta_modelos, registry=registry, workers=workers,
+                                threads_per_model=threads_per_model)
+
+        # El índice codifica la fecha (posición en dates) y el píxel
+        date_positions = df_out.index.to_numpy() // DATE_INDEX_STRIDE
+        for k in np.unique(date_positions):
+            df_date = df_out[date_positions == k]
+            for writer in writers[dates[k]]:
+                writer.append(df_date)
+
+    batch_rows = 0
+    for k, date in enumerate(dates):
+        for dfs in iter_feature_chunks(date, folder_path, polygon_path, features, chunk_size, mask_cache_dir):
+            for df in dfs.values():
+                df.index = df.index + k * DATE_INDEX_STRIDE
+            chunk_rows = len(dfs["df_tifs_C2X-Complex_rhow_9x9"])
+            # Se vacía el lote antes de pasarse de chunk_size filas (cada bloque tiene como mucho chunk_size)
+            if batch and batch_rows + chunk_rows > chunk_size:
+                flush()
+                batch_rows = 0
+            batch.append(dfs)
+            batch_rows += chunk_rows
+    if batch:
+        flush()
+
+    n_rows = {}
+    for date in dates:
+        for writer in writers[date]:
+            pred_file = writer.close(columns=PRED_COLUMNS)
+            print(f"Predicciones guardadas en {pred_file} ({writer.n_rows} píxeles)")
+        n_rows[date] = writers[date][0].n_rows
+    return n_rows
 
-selection = {
-    'C2X-Complex_rhow_9x9_depth_in_0_1': 'XGB',
-    'C2X-Complex_rhow_9x9_depth_in_1_2': 'CAT',
-    #'TOA_9x9_depth_in_2_3': 'KNN',
-    'C2X-Complex_rhow_5x5_depth_in_2_3': 'CAT',
-    'C2X-Complex_rhow_5x5_depth_in_3_4': 'RF',
-}
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--date", default=None, type=str, help="Fecha del producto a descargar (YYYY-MM-DD)")
+    parser.add_argument("--dates", nargs="+", default=None, help="Varias fechas (YYYY-MM-DD) predichas en lotes compartidos")
+    parser.add_argument("--start", default=None, help="Primera fecha (YYYY-MM-DD) de los TIFF de --input a predecir en lotes")
+    parser.add_argument("--end", default=None, help="Última fecha (YYYY-MM-DD) de los TIFF de --input a predecir en lotes")
+    parser.add_argument("--input", required=True, help="Directorio donde está el .tif procesado por SNAP")
+    parser.add_argument("--models", required=True, help="Directorio donde están los modelos para cada profundidad")
+    parser.add_argument("--pred", required=True, help="Directorio donde se guardan las predicciones ({date}_pred en el formato de --format)")
+    parser.add_argument("--geojson", required=True, help="Fichero con geojson del Mar Menor")
+    parser.add_argument("--cache", default=None, help="Directorio para la caché de máscaras del polígono (por defecto <input>/mask_cache)")
+    parser.add_argument("--workers", default=None, type=int, help="Modelos de profundidad ejecutados a la vez (por defecto uno por profundidad)")
+    parser.add_argument("--threads", default=None, type=int, help="Hilos por modelo (por defecto núcleos / workers)")
+    parser.add_argument("--forest", action="store_true", help="Usar los bosques compilados (*_forest.npz) generados con Aplicacion_Forest.py")
+    parser.add_argument("--format", default="parquet", choices=list(INTERMEDIATE_FORMATS), help="Formato de las tablas intermedias y de las predicciones")
+    parser.add_argument("--export-csv", action="store_true", help="Guardar también las predicciones en {date}_pred.csv")
+    parser.add_argument("--export-tables", action="store_true", help="Guardar también las reflectancias extraídas (df_tifs_*) en --input")
+    parser.add_argument("--stream", action="store_true", help="Procesar los píxeles por bloques con memoria acotada")
+    parser.add_argument("--max-memory", default=1024, type=float, help="Memoria aproximada por bloque en MB (con --stream o varias fechas)")
+    parser.add_argument("--chunk-size", default=None, type=int, help="Píxeles por bloque (con --stream o varias fechas; por defecto según --max-memory)")
+    args = parser.parse_args()
+    registry = get_registry(args.models, use_forest=args.forest)
 
-df_out = pd.DataFrame(dfs["df_tifs_C2X-Complex_rhow_9x9"].loc[:, ["Date", "Latitude", "Longitude"]])
-
-for dataset, model_name in selection.items():
-    if model_name == "XGB":
-        df_in = dfs["df_tifs_C2X-Complex_rhow_9x9"]
-    
-    elif model_name == "CAT" and dataset == "C2X-Complex_rhow_5x5_depth_in_2_3":
-        df_in = dfs["df_tifs_C2X-Complex_rhow_5x5"]
-
-    elif model_name == "CAT" and dataset == "C2X-Complex_rhow_9x9_depth_in_1_2":
-        df_in = dfs["df_tifs_C2X-Complex_rhow_9x9"]
-
-    elif model_name == "KNN":
-        df_in = dfs["df_tifs_TOA_9x9"]
-
-    elif model_name == "RF":
-        df_in = dfs["df_tifs_C2X-Complex_rhow_5x5"]
-
-    print(dataset, model_name)
-    depth = dataset[-3:]
-    df_out[f"Chl_pred_{depth}"] = predict_with_model(
-                                    df=df_in,
-                                    models_dir=carpeta_modelos,
-                                    dataset_name=dataset,
-                                    model_name=model_name,
-                                    clip_min=0.2,
-                                    strict=True
-                                )
-    
-df_out.loc[:,["Date", "Latitude", "Longitude", "Chl_pred_0_1", "Chl_pred_1_2", "Chl_pred_2_3", "Chl_pred_3_4"]].to_csv(f"{args.pred}/{target_dates[0]}_pred.csv", index = False)
\ No newline at end of file
+    if args.dates or args.start or args.end:
+        dates = args.dates or []
+        if args.start or args.end:
+            for net in net_set:
+                dates += available_tiff_dates(args.input, net, start=args.start, end=args.end)
+        dates = sorted(set(dates))
+        if not dates:
+            parser.error("No hay fechas que predecir")
+        run_inference_batch(dates, args.input, args.models, args.pred, args.geojson, mask_cache_dir=args.cache,
+                            registry=registry, workers=args.workers or default_workers(), threads_per_model=args.threads,
+                            max_memory_mb=args.max_memory, chunk_size=args.chunk_size,
+                            fmt=args.format, export_csv=args.export_csv)
+    elif args.date is None:
+        parser.error("Hay que indicar --date, --dates o --start/--end")
+    elif args.stream:
+        run_inference_streaming(args.date, args.input, args.models, args.pred, args.geojson, mask_cache_dir=args.cache,
+                                registry=registry, workers=args.workers or default_workers(), threads_per_model=args.threads,
+                                max_memory_mb=args.max_memory, chunk_size=args.chunk_size,
+                                fmt=args.format, export_csv=args.export_csv)
+    else:
+        run_inference(args.date, args.input, args.models, args.pred, args.geojson, mask_cache_dir=args.cache,
+                      registry=registry, workers=args.workers or default_workers(), threads_per_model=args.threads,
+                      fmt=args.format, export_csv=args.export_csv, export_tables=args.export_tables)
@@ -1,80 +1,86 @@
-import rasterio
-import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap, BoundaryNorm
-import argparse
-
-parser = argparse.ArgumentParser()
-parser.add_argument("--date", required=True, type=str, help="Fecha del producto a descargar (YYYY-MM-DD)")
-parser.add_argument("--input", required=True, help="Directorio donde están los TIFFs generados a partir de CSVs")
-parser.add_argument("--output", required=True, help="Directorio donde se guardan los png generados")
-parser.add_argument("--colormap", required=True, help="Fichero con el colormap a utulizar")
-args = parser.parse_args()
-
-date = args.date
-
-# Leer y parsear el archivo del colormap
-colormap_path = args.colormap
-
-depths = ["0_1", "1_2", "2_3", "3_4"]
-for depth in depths:
-
-    colors = []
-    boundaries = []
-    labels = ["0.3", "0.4", "0.5", "0.6", "0.7", "0.8", "0.9", "1.0", "1.2", "1.4", "1.6", "1.8", "2.0", "2.4", "2.8", "3.2", "3.6", "4.0", "4.5", "5.0", "6.0", "8.0", "10.0", "12.0", "15.0", "18.0", "24.0", "30.0"]
-
-    with open(colormap_path, "r") as f:
-        for line in f:
-            if line.startswith("#") or "INTERPOLATION" in line:
-                continue
-
-            parts = line.strip().split(",")
-            if len(parts) < 6:
-                continue
-
-            value = float(parts[0])
-            r, g, b, a = [int(p) for p in parts[1:5]]
-            label = parts[5].strip()
-
-            boundaries.append(value)
-            colors.append((r / 255, g / 255, b / 255, a / 255))
-            #labels.append(label)
-
-    # Crear colormap y norm
-    custom_cmap = ListedColormap(colors)
-    norm = BoundaryNorm(boundaries, custom_cmap.N)
-
-    # Calcular ubicación de los ticks como puntos medios entre boundaries
-    tick_locs = [(boundaries[i] + boundaries[i + 1]) / 2 for i in range(len(boundaries) - 1)]
-    tick_labels = labels[:-1]  # Último valor ("inf") normalmente no se etiqueta
-    # print(tick_locs)
-    # print(tick_labels)
-
-    with rasterio.open(f'{args.input}{date}_chl_map_{depth}.tif') as src:
-        data = src.read(1)
-
-    # === Crear figura ===
-    fig, ax = plt.subplots(figsize=(8, 6))  # Tamaño ajustado para un solo plot
-
-    # === Mostrar la imagen con colormap personalizado ===
-    im = ax.imshow(data, cmap=custom_cmap, norm=norm)
-    #ax.set_title('chl_pred_0_1')
-
-    # Para que el colorbar solamente se vea en la última figura y no se repita cuatro veces
-    if depth == "3_4":
-        # === Añadir colorbar ===
-        cb = plt.colorbar(im, ax=ax, fraction=0.046, pad=0.04)
-        cb.set_ticks(tick_locs)
-        cb.set_ticklabels(tick_labels)
-        cb.ax.tick_params(labelsize=13)
-
-        # === Título encima del colorbar ===
-        cb.ax.text(0.5, 1.02, "Chl mg/m³", fontsize=14, ha='center', va='bottom', transform=cb.ax.transAxes)
-
-    # === Ocultar ejes ===
-    ax.axis('off')
-
-    # === Mostrar y guardar ===
-    plt.tight_layout()
-    plt.savefig(f'{args.output}{date}_chl_map_{depth}.png', dpi=300, bbox_inches='tight')
-    plt.show()
+import argparse
+from Aplicacion_utils import load_qgis_colormap, read_chl_maps, CHL_LABELS, MAP_RENDERERS
+
+depths = ["0_1", "1_2", "2_3", "3_4"]
+
+
+def plot_depth_map(data, depth, path, colormap):
+    """
+    png de una profundidad con matplotlib (figura de 8x6 a 300 dpi); la leyenda solo en la profundidad 3_4.
+
+    Args:
+        colormap: (cmap, norm, boundaries) leído con load_qgis_colormap
+    """
+    import matplotlib.pyplot as plt
+
+    custom_cmap, norm, boundaries = colormap
+
+    # Calcular ubicación de los ticks como puntos medios entre boundaries
+    tick_locs = [(boundaries[i] + boundaries[i + 1]) / 2 for i in range(len(boundaries) - 1)]
+    tick_labels = CHL_LABELS[:-1]  # Último valor ("inf") normalmente no se etiqueta
+
+    # === Crear figura ===
+    fig, ax = plt.subplots(figsize=(8, 6))  # Tamaño ajustado para un solo plot
+
+    # === Mostrar la imagen con colormap personalizado ===
+    im = ax.imshow(data, cmap=custom_cmap, norm=norm)
+    #ax.set_title('chl_pred_0_1')
+
+    # Para que el colorbar solamente se vea en la última figura y no se repita cuatro veces
+    if depth == "3_4":
+        # === Añadir colorbar ===
+        cb = plt.colorbar(im, ax=ax, fraction=0.046, pad=0.04)
+        cb.set_ticks(tick_locs)
+        cb.set_ticklabels(tick_labels)
+        cb.ax.tick_params(labelsize=13)
+
+        # === Título encima del colorbar ===
+        cb.ax.text(0.5, 1.02, "Chl mg/m³", fontsize=14, ha='center', va='bottom', transform=cb.ax.transAxes)
+
+    # === Ocultar ejes ===
+    ax.axis('off')
+
+    # === Guardar ===
+    plt.tight_layout()
+    plt.savefig(path, dpi=300, bbox_inches='tight')
+    plt.close(fig)
+
+
+def plot_depth_maps(date, input_dir, output_dir, colormap_path=None, colormap=None, grids=None, renderer="lut",
+                    palette=None):
+    """
+    Un png por profundidad ({output_dir}{date}_chl_map_{depth}.png); la leyenda solo en la última.
+
+    Args:
+        colormap: (cmap, norm, boundaries) ya leído con load_qgis_colormap; si no, se lee de colormap_path
+        grids: dict {depth: array o (array, transform)} en memoria; si no, se leen los mapas de input_dir
+            (COG o TIFFs por profundidad, ver read_chl_maps)
+        renderer: "lut" o "matplotlib"
+        palette: paleta ya leída con Aplicacion_Render.load_palette (renderer "lut"); si no, de colormap_path
+    """
+    if renderer == "lut":
+        from Aplicacion_Render import load_palette, render_depth_pngs
+        render_depth_pngs(date, input_dir, output_dir, palette or load_palette(colormap_path), grids=grids)
+        return
+
+    # Leer y parsear el archivo del colormap
+    colormap = colormap or load_qgis_colormap(colormap_path)
+
+    if grids is None:
+        grids = read_chl_maps(input_dir, date, depths)
+
+    for depth in depths:
+        data = grids[depth][0] if isinstance(grids[depth], tuple) else grids[depth]
+        plot_depth_map(data, depth, f'{output_dir}{date}_chl_map_{depth}.png', colormap)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--date", required=True, type=str, help="Fecha del producto a descargar (YYYY-MM-DD)")
+    parser.add_argument("--input", required=True, help="Directorio donde están los TIFFs generados a partir de CSVs")
+    parser.add_argument("--output", required=True, help="Directorio donde se guardan los png generados")
+    parser.add_argument("--colormap", required=True, help="Fichero con el colormap a utulizar")
+    parser.add_argument("--renderer", default="lut", choices=list(MAP_RENDERERS), help="Renderizado con paleta (lut) o con matplotlib")
+    args = parser.parse_args()
+
+    plot_depth_maps(args.date, args.input, args.output, colormap_path=args.colormap, renderer=args.renderer)
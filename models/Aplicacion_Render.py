@@ -0,0 +1,238 @@
+import argparse
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from Aplicacion_utils import read_qgis_colormap, read_chl_maps, CHL_LABELS
+
+# Renderizado de los mapas de Chl sin matplotlib: los valores se clasifican con np.digitize contra los límites
+# del colormap (misma regla que BoundaryNorm + ListedColormap) y cada píxel pasa a ser un índice de una paleta.
+# Los png y los fotogramas del GIF son imágenes con paleta (modo P); la leyenda se dibuja una vez por tamaño.
+
+depths = ["0_1", "1_2", "2_3", "3_4"]
+
+# Tamaño de los mapas: cada píxel del ráster ocupa scale x scale píxeles de la imagen
+PNG_SCALE = 4
+GIF_SCALE = 2
+
+# Leyendas ya dibujadas, por paleta y altura
+_LEGEND_CACHE = {}
+
+
+def load_palette(colormap_path):
+    """
+    Paleta del colormap de QGIS. Índices 0..N-1: colores del colormap; N: NaN (transparente en los png,
+    blanco en el GIF); N+1: fondo blanco; N+2: texto negro.
+
+    Returns:
+        dict con boundaries, bin_index (color de cada resultado de np.digitize), rgba (N+3, 4) uint8 y los
+        índices nan, background y text
+    """
+    boundaries, colors = read_qgis_colormap(colormap_path)
+    n_colors = len(colors)
+    n_regions = len(boundaries) - 1
+
+    # Como BoundaryNorm(boundaries, ncolors=n_colors): las regiones se estiran al rango completo de colores;
+    # por debajo del primer límite el color de 'under' (el primero) y desde el último el de 'over' (el último)
+    if not n_regions <= n_colors <= 253:
+        raise ValueError(f"Colormap no soportado: {n_colors} colores para {n_regions} intervalos")
+    regions = np.arange(n_regions)
+    if n_colors > n_regions > 1:
+        regions = ((n_colors - 1) / (n_regions - 1) * regions).astype(np.int16)
+    elif n_colors > n_regions:
+        regions = np.full(n_regions, (n_colors - 1) // 2)
+    bin_index = np.concatenate([[0], regions, [n_colors - 1]]).astype(np.uint8)
+
+    rgba = np.array(list(colors) + [(255, 255, 255, 0), (255, 255, 255, 255), (0, 0, 0, 255)], dtype=np.uint8)
+    return {
+        "boundaries": np.asarray(boundaries, dtype=np.float64),
+        "bin_index": bin_index,
+        "rgba": rgba,
+        "nan": n_colors,
+        "background": n_colors + 1,
+        "text": n_colors + 2,
+    }
+
+
+def classify(data, palette):
+    """
+    Índice de la paleta de cada píxel (uint8, misma forma que data); los NaN van al índice transparente.
+    """
+    data = np.asarray(data)
+    indices = palette["bin_index"][np.digitize(data, palette["boundaries"])]
+    indices[np.isnan(data)] = palette["nan"]
+    return indices
+
+
+def _font(size):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        # Pillow < 10.1: fuente de mapa de bits de tamaño fijo
+        return ImageFont.load_default()
+
+
+def _draw(indices, palette):
+    """Imagen P sobre la que dibujar con los índices de la paleta (sin antialiasing, para no crear colores)."""
+    image = Image.fromarray(indices, mode="P")
+    draw = ImageDraw.Draw(image)
+    draw.fontmode = "1"
+    return image, draw
+
+
+def render_legend(palette, height):
+    """
+    Leyenda vertical (título, una caja por intervalo y sus etiquetas) como array de índices de la paleta.
+    Se dibuja una sola vez por paleta y altura.
+    """
+    key = (palette["rgba"].tobytes(), palette["boundaries"].tobytes(), height)
+    if key in _LEGEND_CACHE:
+        return _LEGEND_CACHE[key]
+
+    boundaries = palette["boundaries"]
+    n_bins = len(boundaries) - 1
+    labels = CHL_LABELS[:n_bins]
+    title_height = max(14, height // 20)
+    bin_height = max(1, (height - title_height) // n_bins)
+    font = _font(max(8, min(int(bin_height * 0.7), title_height - 4)))
+    superscript = _font(max(6, int(font.size * 0.6)) if hasattr(font, "size") else 6)
+
+    # Ancho según el texto más largo (etiquetas a la derecha de la barra o título)
+    bar_left, bar_width = 6, 18
+    labels_left = bar_left + bar_width + 6
+    title_width = font.getlength("Chl mg/m") + superscript.getlength("3")
+    width = int(max(labels_left + max(font.getlength(label) for label in labels), bar_left + title_width)) + 6
+    legend = np.full((title_height + n_bins * bin_height, width), palette["background"], dtype=np.uint8)
+
+    # Un intervalo por caja, de menor (abajo) a mayor (arriba), con el color de su punto medio
+    midpoints = (boundaries[:-1] + boundaries[1:]) / 2
+    colors = classify(midpoints, palette)
+    for k in range(n_bins):
+        top = title_height + (n_bins - 1 - k) * bin_height
+        legend[top:top + bin_height, bar_left:bar_left + bar_width] = colors[k]
+
+    # Título "Chl mg/m³" (el ³ como superíndice: la fuente por defecto no tiene el carácter)
+    image, draw = _draw(legend, palette)
+    draw.text((bar_left, title_height // 2), "Chl mg/m", fill=palette["text"], font=font, anchor="lm")
+    draw.text((bar_left + font.getlength("Chl mg/m"), title_height // 2), "3", fill=palette["text"],
+              font=superscript, anchor="lb")
+    draw.rectangle([bar_left, title_height, bar_left + bar_width - 1, legend.shape[0] - 1], outline=palette["text"])
+    for k, label in enumerate(labels):
+        y = title_height + (n_bins - 1 - k) * bin_height + bin_height // 2
+        draw.line([bar_left + bar_width, y, bar_left + bar_width + 3, y], fill=palette["text"])
+        draw.text((labels_left, y), label, fill=palette["text"], font=font, anchor="lm")
+
+    legend = np.asarray(image)
+    _LEGEND_CACHE[key] = legend
+    return legend
+
+
+def compose_frame(data, palette, scale=PNG_SCALE, legend=False, label=None):
+    """
+    Mapa clasificado y ampliado scale veces (vecino más próximo), con la leyenda a la derecha y, si se
+    indica, un rótulo en la esquina superior izquierda.
+
+    Returns:
+        np.ndarray uint8 de índices de la paleta
+    """
+    indices = classify(data, palette)
+    if scale > 1:
+        indices = np.repeat(np.repeat(indices, scale, axis=0), scale, axis=1)
+
+    if legend:
+        legend_indices = render_legend(palette, indices.shape[0])
+        height = max(indices.shape[0], legend_indices.shape[0])
+        frame = np.full((height, indices.shape[1] + legend_indices.shape[1]), palette["background"], dtype=np.uint8)
+        frame[:indices.shape[0], :indices.shape[1]] = indices
+        frame[:legend_indices.shape[0], indices.shape[1]:] = legend_indices
+        indices = frame
+
+    if label:
+        image, draw = _draw(np.ascontiguousarray(indices), palette)
+        font = _font(max(12, indices.shape[0] // 25))
+        box = draw.textbbox((8, 8), label, font=font)
+        draw.rectangle([box[0] - 4, box[1] - 4, box[2] + 4, box[3] + 4], fill=palette["text"])
+        draw.text((8, 8), label, fill=palette["background"], font=font)
+        indices = np.asarray(image)
+    return indices
+
+
+def to_image(indices, palette, transparent=True):
+    """
+    Imagen PIL con paleta. Con transparent, el índice de NaN queda transparente (png); si no, se ve blanco.
+    """
+    image = Image.fromarray(np.ascontiguousarray(indices), mode="P")
+    image.putpalette(palette["rgba"][:, :3].tobytes())
+    if transparent:
+        image.info["transparency"] = palette["nan"]
+    return image
+
+
+def render_depth_png(data, depth, path, palette, scale=PNG_SCALE):
+    """png de una profundidad; la leyenda solo en la profundidad 3_4."""
+    indices = compose_frame(data, palette, scale=scale, legend=(depth == "3_4"))
+    to_image(indices, palette).save(path, optimize=False)
+
+
+def render_depth_pngs(date, input_dir, output_dir, palette, grids=None, scale=PNG_SCALE):
+    """
+    Un png por profundidad ({output_dir}{date}_chl_map_{depth}.png); la leyenda solo en la última, como
+    Aplicacion_PlotTIFF.plot_depth_maps.
+
+    Args:
+        grids: dict {depth: array o (array, transform)} en memoria; si no, se leen los mapas de input_dir
+    """
+    if grids is None:
+        grids = read_chl_maps(input_dir, date, depths)
+
+    paths = []
+    for depth in depths:
+        data = grids[depth][0] if isinstance(grids[depth], tuple) else grids[depth]
+        path = f'{output_dir}{date}_chl_map_{depth}.png'
+        render_depth_png(data, depth, path, palette, scale=scale)
+        paths.append(path)
+    return paths
+
+
+def render_gif(date, input_dir, output_dir, palette, grids=None, scale=GIF_SCALE):
+    """
+    GIF con un fotograma por profundidad ({output_dir}{date}_chl_pred_loop.gif): mapa, profundidad y leyenda,
+    como Aplicacion_GenerateGif.generate_gif. Todos los fotogramas comparten la paleta del colormap.
+
+    Returns:
+        ruta del GIF
+    """
+    if grids is None:
+        grids = read_chl_maps(input_dir, date, depths)
+
+    frames = []
+    for depth in depths:
+        data = grids[depth][0] if isinstance(grids[depth], tuple) else grids[depth]
+        indices = compose_frame(data, palette, scale=scale, legend=True, label=f'Depth {depth.replace("_", "-")}')
+        frames.append(to_image(indices, palette, transparent=False))
+
+    gif_path = f'{output_dir}{date}_chl_pred_loop.gif'
+    frames[0].save(
+        gif_path,
+        save_all=True,
+        append_images=frames[1:],
+        duration=1000,
+        loop=0
+    )
+    return gif_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--date", required=True, type=str, help="Fecha de los mapas (YYYY-MM-DD)")
+    parser.add_argument("--input", required=True, help="Directorio donde están los mapas (COG o TIFFs por profundidad)")
+    parser.add_argument("--output", required=True, help="Directorio donde se guardan los png y el gif")
+    parser.add_argument("--colormap", required=True, help="Fichero con el colormap a utilizar")
+    parser.add_argument("--no-png", action="store_true", help="No generar los png por profundidad")
+    parser.add_argument("--no-gif", action="store_true", help="No generar el gif")
+    args = parser.parse_args()
+
+    palette = load_palette(args.colormap)
+    grids = read_chl_maps(args.input, args.date, depths)
+    if not args.no_png:
+        render_depth_pngs(args.date, args.input, args.output, palette, grids=grids)
+    if not args.no_gif:
+        render_gif(args.date, args.input, args.output, palette, grids=grids)
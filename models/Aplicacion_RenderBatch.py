@@ -0,0 +1,152 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from Aplicacion_utils import available_map_dates, chl_map_paths, read_chl_maps, MAP_RENDERERS
+
+# Renderizado en lote de los png y GIF de un rango de fechas (relleno de históricos): una tarea por png
+# (fecha, profundidad) y otra por GIF, repartidas en un pool de procesos con backend de matplotlib sin
+# pantalla (Agg). Las salidas más recientes que sus mapas y que el colormap se saltan.
+
+depths = ["0_1", "1_2", "2_3", "3_4"]
+
+# Estado de cada proceso del pool: renderer, paleta y, con matplotlib, el colormap
+_worker = {}
+
+
+def _init_worker(colormap_path, renderer):
+    """Inicializa un proceso del pool: backend sin pantalla y colormap leído una sola vez."""
+    os.environ["MPLBACKEND"] = "Agg"
+    from Aplicacion_Render import load_palette
+
+    _worker["renderer"] = renderer
+    _worker["palette"] = load_palette(colormap_path)
+    _worker["colormap"] = None
+    if renderer == "matplotlib":
+        import matplotlib
+        matplotlib.use("Agg")
+        from Aplicacion_utils import load_qgis_colormap
+        _worker["colormap"] = load_qgis_colormap(colormap_path)
+
+
+def _render_task(kind, date, depth, map_dir, output_dir):
+    """
+    Renderiza un png (kind "png", una profundidad) o el GIF de una fecha (kind "gif").
+
+    Returns:
+        número de fotogramas renderizados
+    """
+    if kind == "png":
+        data = read_chl_maps(map_dir, date, [depth])[depth][0]
+        path = f'{output_dir}{date}_chl_map_{depth}.png'
+        if _worker["renderer"] == "lut":
+            from Aplicacion_Render import render_depth_png
+            render_depth_png(data, depth, path, _worker["palette"])
+        else:
+            from Aplicacion_PlotTIFF import plot_depth_map
+            plot_depth_map(data, depth, path, _worker["colormap"])
+        return 1
+
+    from Aplicacion_GenerateGif import generate_gif
+    generate_gif(date, map_dir, output_dir, colormap=_worker["colormap"], renderer=_worker["renderer"],
+                 palette=_worker["palette"])
+    return len(depths)
+
+
+def _is_up_to_date(output_path, input_paths):
+    """La salida existe y no es más antigua que ninguna de sus entradas."""
+    if not os.path.exists(output_path):
+        return False
+    output_mtime = os.path.getmtime(output_path)
+    return all(os.path.getmtime(p) <= output_mtime for p in input_paths if os.path.exists(p))
+
+
+def render_tasks(dates, map_dir, output_dir, colormap_path, png=True, gif=True, force=False):
+    """
+    Tareas pendientes (kind, date, depth) del lote y número de salidas que ya están al día.
+    """
+    tasks = []
+    skipped = 0
+    for date in dates:
+        cog_path, tiff_paths = chl_map_paths(map_dir, date, depths)
+        inputs = [cog_path, colormap_path] + list(tiff_paths.values())
+        outputs = []
+        if png:
+            outputs += [("png", depth, f'{output_dir}{date}_chl_map_{depth}.png') for depth in depths]
+        if gif:
+            outputs.append(("gif", None, f'{output_dir}{date}_chl_pred_loop.gif'))
+
+        for kind, depth, path in outputs:
+            if not force and _is_up_to_date(path, inputs):
+                skipped += 1
+                continue
+            tasks.append((kind, date, depth))
+    return tasks, skipped
+
+
+def render_dates(dates, map_dir, output_dir, colormap_path, renderer="lut", workers=None, png=True, gif=True,
+                 force=False):
+    """
+    Renderiza los png por profundidad y/o el GIF de cada fecha en un pool de workers procesos.
+
+    Returns:
+        dict con frames (fotogramas renderizados), skipped (salidas al día), failed (tareas con error),
+        seconds y fps
+    """
+    tasks, skipped = render_tasks(dates, map_dir, output_dir, colormap_path, png=png, gif=gif, force=force)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(tasks) or 1))
+    print(f"{len(dates)} fechas: {len(tasks)} salidas por renderizar, {skipped} al día ({workers} procesos)")
+
+    # El backend se fija antes de crear los procesos, por si importan matplotlib al arrancar
+    os.environ["MPLBACKEND"] = "Agg"
+    frames = 0
+    failed = 0
+    start = time.perf_counter()
+    if workers == 1:
+        _init_worker(colormap_path, renderer)
+        for kind, date, depth in tasks:
+            try:
+                frames += _render_task(kind, date, depth, map_dir, output_dir)
+            except Exception as e:
+                failed += 1
+                print(f"Error renderizando {kind} de {date} {depth or ''}: {e}")
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(colormap_path, renderer)) as executor:
+            futures = {executor.submit(_render_task, kind, date, depth, map_dir, output_dir): (kind, date, depth)
+                       for kind, date, depth in tasks}
+            for future in as_completed(futures):
+                kind, date, depth = futures[future]
+                try:
+                    frames += future.result()
+                except Exception as e:
+                    failed += 1
+                    print(f"Error renderizando {kind} de {date} {depth or ''}: {e}")
+    seconds = time.perf_counter() - start
+
+    fps = frames / seconds if seconds > 0 else 0.0
+    print(f"{frames} fotogramas en {seconds:.2f} s ({fps:.1f} fotogramas/s), {skipped} salidas al día, "
+          f"{failed} con error")
+    return {"frames": frames, "skipped": skipped, "failed": failed, "seconds": seconds, "fps": fps}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dates", nargs="+", default=None, help="Fechas a renderizar (YYYY-MM-DD)")
+    parser.add_argument("--start", default=None, help="Primera fecha (YYYY-MM-DD) con mapas en --input")
+    parser.add_argument("--end", default=None, help="Última fecha (YYYY-MM-DD) con mapas en --input")
+    parser.add_argument("--input", required=True, help="Directorio donde están los mapas (COG o TIFFs por profundidad)")
+    parser.add_argument("--output", required=True, help="Directorio donde se guardan los png y los gif")
+    parser.add_argument("--colormap", required=True, help="Fichero con el colormap a utilizar")
+    parser.add_argument("--renderer", default="lut", choices=list(MAP_RENDERERS), help="Renderizado con paleta (lut) o con matplotlib")
+    parser.add_argument("--workers", default=None, type=int, help="Procesos del pool (por defecto, uno por núcleo)")
+    parser.add_argument("--force", action="store_true", help="Renderizar también las salidas que ya están al día")
+    parser.add_argument("--no-png", action="store_true", help="No generar los png por profundidad")
+    parser.add_argument("--no-gif", action="store_true", help="No generar los gif")
+    args = parser.parse_args()
+
+    dates = args.dates or available_map_dates(args.input, args.start, args.end)
+    stats = render_dates(dates, args.input, args.output, args.colormap, renderer=args.renderer, workers=args.workers,
+                         png=not args.no_png, gif=not args.no_gif, force=args.force)
+    if stats["failed"]:
+        raise SystemExit(1)
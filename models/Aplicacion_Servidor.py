@@ -0,0 +1,150 @@
+import argparse
+import json
+import os
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pandas as pd
+
+from Aplicacion_utils import get_registry, table_path
+import Aplicacion_Modelos as modelos
+
+# Servidor local de inferencia: mantiene cargados los modelos de 'selection' para no pagar el arranque de
+# Python + pandas/geopandas/xgboost/catboost y la carga de modelos en cada fecha.
+#
+#   GET  /health            -> estado y modelos cargados
+#   POST /predict           -> {"date", "input", "pred", "geojson", "cache", "max_memory_mb", "format",
+#                              "export_csv", "export_tables", "models", "forest"}: mismo trabajo que Aplicacion_Modelos.py para
+#                              una fecha (por bloques si max_memory_mb); devuelve la ruta de las predicciones.
+#                              Si "models" o "forest" no son los del servidor responde 409
+#   POST /predict_features  -> {"frames": {nombre_df: {columna: [valores]}}}: DataFrames ya con las
+#                              variables de los modelos; devuelve las predicciones por profundidad
+
+
+def _warm_up(registry):
+    for dataset, model_name in modelos.selection.items():
+        registry.get_model(dataset, model_name)
+        registry.get_features(dataset, model_name)
+
+
+def model_mismatch(payload, carpeta_modelos, use_forest):
+    """Motivo por el que la petición pide otros modelos que los cargados en el servidor, o None."""
+    models = payload.get("models")
+    if models is not None and os.path.realpath(models) != os.path.realpath(carpeta_modelos):
+        return f"el servidor usa los modelos de {carpeta_modelos} y la petición pide los de {models}"
+    forest = payload.get("forest")
+    if forest is not None and bool(forest) != use_forest:
+        return (f"el servidor {'usa' if use_forest else 'no usa'} los bosques compilados (--forest) y la "
+                f"petición {'los pide' if forest else 'no los pide'}")
+    return None
+
+
+def make_handler(carpeta_modelos, registry, workers=1, threads_per_model=None, use_forest=False):
+
+    class InferenceHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_json(self):
+            length = int(self.headers.get("Content-Length", 0))
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def do_GET(self):
+            if self.path != "/health":
+                self._send_json(404, {"error": f"Ruta no encontrada: {self.path}"})
+                return
+            self._send_json(200, {"status": "ok", "models": modelos.selection, "models_dir": carpeta_modelos,
+                                  "forest": use_forest})
+
+        def do_POST(self):
+            try:
+                payload = self._read_json()
+                t0 = time.time()
+
+                if self.path == "/predict":
+                    mismatch = model_mismatch(payload, carpeta_modelos, use_forest)
+                    if mismatch:
+                        self._send_json(409, {"error": mismatch})
+                        return
+                    date = payload["date"]
+                    fmt = payload.get("format", "parquet")
+                    export_csv = bool(payload.get("export_csv", False))
+                    if payload.get("max_memory_mb"):
+                        rows = modelos.run_inference_streaming(
+                            date, payload["input"], carpeta_modelos, payload["pred"], payload["geojson"],
+                            mask_cache_dir=payload.get("cache"), registry=registry, workers=workers,
+                            threads_per_model=threads_per_model, max_memory_mb=float(payload["max_memory_mb"]),
+                            fmt=fmt, export_csv=export_csv
+                        )
+                    else:
+                        rows = len(modelos.run_inference(
+                            date, payload["input"], carpeta_modelos, payload["pred"], payload["geojson"],
+                            mask_cache_dir=payload.get("cache"), registry=registry,
+                            workers=workers, threads_per_model=threads_per_model, fmt=fmt, export_csv=export_csv,
+                            export_tables=bool(payload.get("export_tables", False))
+                        ))
+                    pred_file = table_path(os.path.join(payload["pred"], f"{date}_pred"), fmt)
+                    result = {"date": date, "pred_file": pred_file, "rows": rows}
+
+                elif self.path == "/predict_features":
+                    dfs = {name: pd.DataFrame(columns) for name, columns in payload["frames"].items()}
+                    for df in dfs.values():
+                        if "Date" in df.columns:
+                            df["Date"] = pd.to_datetime(df["Date"])
+                    df_out = modelos.predict_depths(dfs, carpeta_modelos, registry=registry, workers=workers,
+                                                    threads_per_model=threads_per_model)
+                    df_out["Date"] = df_out["Date"].astype(str)
+                    result = {"predictions": df_out.to_dict(orient="list")}
+
+                else:
+                    self._send_json(404, {"error": f"Ruta no encontrada: {self.path}"})
+                    return
+
+                result["seconds"] = round(time.time() - t0, 3)
+                self._send_json(200, result)
+
+            except KeyError as e:
+                self._send_json(400, {"error": f"Falta el campo {e} en la petición"})
+            except Exception as e:
+                traceback.print_exc()
+                self._send_json(500, {"error": str(e)})
+
+    return InferenceHandler
+
+
+def serve(carpeta_modelos, host="127.0.0.1", port=8765, workers=1, threads_per_model=None, use_forest=False):
+    registry = get_registry(carpeta_modelos, use_forest=use_forest)
+    _warm_up(registry)
+
+    # HTTPServer atiende las peticiones de una en una: las fechas se procesan en serie y cada modelo
+    # solo lo usa un hilo a la vez
+    server = HTTPServer((host, port), make_handler(carpeta_modelos, registry, workers, threads_per_model,
+                                                       use_forest))
+    print(f"Servidor de inferencia escuchando en http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", required=True, help="Directorio donde están los modelos para cada profundidad")
+    parser.add_argument("--host", default="127.0.0.1", help="Interfaz en la que escucha el servidor (solo local por defecto)")
+    parser.add_argument("--port", default=8765, type=int, help="Puerto del servidor")
+    parser.add_argument("--workers", default=None, type=int, help="Modelos de profundidad ejecutados a la vez (por defecto uno por profundidad)")
+    parser.add_argument("--threads", default=None, type=int, help="Hilos por modelo (por defecto núcleos / workers)")
+    parser.add_argument("--forest", action="store_true", help="Usar los bosques compilados (*_forest.npz) generados con Aplicacion_Forest.py")
+    args = parser.parse_args()
+
+    serve(args.models, host=args.host, port=args.port, workers=args.workers or modelos.default_workers(),
+          threads_per_model=args.threads, use_forest=args.forest)
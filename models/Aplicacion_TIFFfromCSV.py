@@ -1,53 +1,160 @@
-import pandas as pd
-import numpy as np
-import rasterio
-from rasterio.transform import from_origin
-import os
-import argparse
-
-parser = argparse.ArgumentParser()
-parser.add_argument("--date", required=True, type=str, help="Fecha del producto a descargar (YYYY-MM-DD)")
-parser.add_argument("--input", required=True, help="Directorio donde están las predicciones para la fecha de interés")
-parser.add_argument("--output", required=True, help="Directorio donde se guardan los TIFFs")
-args = parser.parse_args()
-
-path = args.input
-date = args.date
-filename = f"{date}_pred.csv"
-df = pd.read_csv(os.path.join(path, filename))
-
-depths = ["0_1", "1_2", "2_3", "3_4"]
-for depth in depths:
-
-    print(f"Generating TIFF file for {date} in depth {depth}")
-    value_column = f'Chl_pred_{depth}'
-
-    lats = np.sort(df['Latitude'].unique())[::-1]
-    lons = np.sort(df['Longitude'].unique()) 
-
-    data = np.full((len(lats), len(lons)), np.nan, dtype=np.float32)
-
-    lat_idx = {lat: i for i, lat in enumerate(lats)}
-    lon_idx = {lon: i for i, lon in enumerate(lons)}
-    for _, row in df.iterrows():
-        i = lat_idx[row['Latitude']]
-        j = lon_idx[row['Longitude']]
-        data[i, j] = row[value_column]
-
-    pixel_size_lat = abs(lats[1] - lats[0]) if len(lats) > 1 else 0.01
-    pixel_size_lon = abs(lons[1] - lons[0]) if len(lons) > 1 else 0.01
-    transform = from_origin(lons[0] - pixel_size_lon/2, lats[0] + pixel_size_lat/2, pixel_size_lon, pixel_size_lat)
-
-    with rasterio.open(
-        f'{args.output}{date}_chl_map_{depth}.tif',
-        'w',
-        driver='GTiff',
-        height=data.shape[0],
-        width=data.shape[1],
-        count=1,
-        dtype='float32',
-        crs='EPSG:32630',
-        transform=transform,
-        nodata=np.nan
-    ) as dst:
-        dst.write(data, 1)
\ No newline at end of file
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+from affine import Affine
+import os
+import argparse
+from Aplicacion_utils import read_table, read_grid_info, chl_map_paths, INTERMEDIATE_FORMATS, MAP_FORMATS
+
+depths = ["0_1", "1_2", "2_3", "3_4"]
+
+
+def grid_on_snap(df, value_columns, grid):
+    """
+    Coloca los valores de value_columns en la rejilla original del TIFF de SNAP usando las columnas
+    row/col de cada píxel. El ráster cubre el rectángulo de filas y columnas con predicción y su
+    transform es la de SNAP desplazada a ese recorte.
+
+    Returns:
+        (np.ndarray float32 (len(value_columns), filas, columnas) con NaN fuera del polígono, transform)
+    """
+    rows = np.asarray(df['row'], dtype=np.intp)
+    cols = np.asarray(df['col'], dtype=np.intp)
+    row_off, col_off = int(rows.min()), int(cols.min())
+
+    data = np.full((len(value_columns), int(rows.max()) - row_off + 1, int(cols.max()) - col_off + 1), np.nan,
+                   dtype=np.float32)
+    data[:, rows - row_off, cols - col_off] = df[list(value_columns)].to_numpy(dtype=np.float32).T
+
+    transform = Affine(*grid["transform"]) * Affine.translation(col_off, row_off)
+    return data, transform
+
+
+def grid_from_predictions(df, value_columns):
+    """
+    Rejilla reconstruida a partir de las coordenadas, para predicciones sin row/col (csv antiguos):
+    filas = Latitude de mayor a menor, columnas = Longitude, con los valores de value_columns.
+    Las coordenadas se indexan una sola vez (np.unique + inverse) y todas las columnas se colocan en la
+    rejilla con una única asignación.
+
+    Returns:
+        (np.ndarray float32 (len(value_columns), filas, columnas) con NaN fuera del polígono, transform)
+    """
+    lats, lat_inverse = np.unique(np.asarray(df['Latitude']), return_inverse=True)
+    lons, lon_inverse = np.unique(np.asarray(df['Longitude']), return_inverse=True)
+    lats = lats[::-1]
+    rows = len(lats) - 1 - lat_inverse
+
+    data = np.full((len(value_columns), len(lats), len(lons)), np.nan, dtype=np.float32)
+    data[:, rows, lon_inverse] = df[list(value_columns)].to_numpy(dtype=np.float32).T
+
+    pixel_size_lat = abs(lats[1] - lats[0]) if len(lats) > 1 else 0.01
+    pixel_size_lon = abs(lons[1] - lons[0]) if len(lons) > 1 else 0.01
+    transform = from_origin(lons[0] - pixel_size_lon/2, lats[0] + pixel_size_lat/2, pixel_size_lon, pixel_size_lat)
+    return data, transform
+
+
+def write_chl_tiff(path, data, transform, crs='EPSG:32630'):
+    with rasterio.open(
+        path,
+        'w',
+        driver='GTiff',
+        height=data.shape[0],
+        width=data.shape[1],
+        count=1,
+        dtype='float32',
+        crs=crs,
+        transform=transform,
+        nodata=np.nan
+    ) as dst:
+        dst.write(data, 1)
+
+
+def write_chl_cog(path, data, transform, crs='EPSG:32630', descriptions=None, blocksize=256):
+    """
+    Cloud Optimized GeoTIFF con una banda por profundidad: teselado en bloques de blocksize, comprimido
+    (DEFLATE con predictor de coma flotante) y con overviews internos (promedio, ignorando los NaN), de modo
+    que cualquier profundidad o nivel de zoom se lee con pocas lecturas por rango.
+
+    Args:
+        data: np.ndarray float32 (bandas, filas, columnas)
+        descriptions: nombre de cada banda (p. ej. Chl_pred_0_1)
+    """
+    profile = dict(driver='GTiff', height=data.shape[1], width=data.shape[2], count=data.shape[0],
+                   dtype='float32', crs=crs, transform=transform, nodata=np.nan)
+
+    # El driver COG solo escribe por copia: se monta el ráster en memoria y se copia a un fichero temporal
+    tmp_path = f"{path}.part"
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as mem:
+            mem.write(data)
+            for band, description in enumerate(descriptions or [], start=1):
+                mem.set_band_description(band, description)
+        with memfile.open() as mem:
+            rasterio.shutil.copy(mem, tmp_path, driver='COG', BLOCKSIZE=blocksize, COMPRESS='DEFLATE',
+                                 PREDICTOR='YES', OVERVIEWS='AUTO', RESAMPLING='AVERAGE')
+    os.replace(tmp_path, path)
+
+
+def tiffs_from_predictions(date, input_dir, output_dir, fmt=None, df=None, grid=None, map_format="tiff"):
+    """
+    Mapas de Chl de la fecha a partir de sus predicciones. Si se pasa df (p. ej. el devuelto por
+    Aplicacion_Modelos.run_inference) no se leen de disco.
+
+    Con map_format "tiff" se escribe un TIFF por profundidad ({output_dir}{date}_chl_map_{depth}.tif); con
+    "cog" un único COG con las cuatro profundidades como bandas ({output_dir}{date}_chl_map.tif); con "both"
+    los dos.
+
+    Si las predicciones tienen row/col y se conoce la rejilla de SNAP (grid o {date}_pred_grid.json),
+    los mapas se escriben directamente sobre esa rejilla y con su CRS; si no, se reconstruye a partir de
+    Latitude/Longitude.
+
+    Returns:
+        dict {depth: (data, transform)} con las rejillas escritas
+    """
+    if df is None:
+        # {date}_pred en parquet, npy o csv (ver Aplicacion_Modelos.py --format)
+        df = read_table(os.path.join(input_dir, f"{date}_pred"), fmt, mmap=True)
+    if not len(df):
+        raise ValueError(f"No hay predicciones para la fecha {date}: no se pueden generar los mapas")
+
+    value_columns = [f'Chl_pred_{depth}' for depth in depths]
+    if grid is None:
+        grid = read_grid_info(os.path.join(input_dir, f"{date}_pred"))
+
+    # Una sola pasada por las predicciones para las cuatro profundidades
+    crs = 'EPSG:32630'
+    if grid is not None and len(df) and 'row' in df.columns and 'col' in df.columns:
+        data, transform = grid_on_snap(df, value_columns, grid)
+        crs = grid.get("crs") or crs
+    else:
+        data, transform = grid_from_predictions(df, value_columns)
+
+    cog_path, tiff_paths = chl_map_paths(output_dir, date, depths)
+    if map_format in ("cog", "both"):
+        print(f"Generating COG file for {date}")
+        write_chl_cog(cog_path, data, transform, crs=crs, descriptions=value_columns)
+
+    grids = {}
+    for k, depth in enumerate(depths):
+
+        if map_format in ("tiff", "both"):
+            print(f"Generating TIFF file for {date} in depth {depth}")
+            write_chl_tiff(tiff_paths[depth], data[k], transform, crs=crs)
+        grids[depth] = (data[k], transform)
+
+    return grids
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--date", required=True, type=str, help="Fecha del producto a descargar (YYYY-MM-DD)")
+    parser.add_argument("--input", required=True, help="Directorio donde están las predicciones para la fecha de interés")
+    parser.add_argument("--output", required=True, help="Directorio donde se guardan los TIFFs")
+    parser.add_argument("--format", default=None, choices=list(INTERMEDIATE_FORMATS), help="Formato de las predicciones (por defecto el que exista)")
+    parser.add_argument("--map-format", default="tiff", choices=list(MAP_FORMATS), help="Un TIFF por profundidad (tiff), un COG con las profundidades como bandas (cog) o los dos (both)")
+    args = parser.parse_args()
+
+    tiffs_from_predictions(args.date, args.input, args.output, fmt=args.format, map_format=args.map_format)
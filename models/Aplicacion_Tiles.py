@@ -0,0 +1,267 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import rasterio
+from rasterio.transform import from_bounds, array_bounds
+from rasterio.warp import reproject, transform_bounds, Resampling
+from Aplicacion_utils import available_map_dates, chl_map_paths, cog_map_path, read_chl_maps
+from Aplicacion_Render import load_palette, classify, to_image
+
+# Pirámide de teselas XYZ (Web Mercator, EPSG:3857, 256x256, esquema de Google/OSM, válido también como
+# TileMatrixSet GoogleMapsCompatible de WMTS) por fecha y profundidad:
+#   {tiles_dir}{date}/{depth}/{z}/{x}/{y}.png
+# Las teselas se colorean con la paleta del colormap de QGIS (Aplicacion_Render, mismas reglas que
+# load_qgis_colormap), se reparten en un pool de procesos por bloques de teselas de todos los niveles, y un
+# manifiesto con el hash de cada tesela permite no reescribir las que no han cambiado.
+
+depths = ["0_1", "1_2", "2_3", "3_4"]
+
+TILE_SIZE = 256
+WEB_MERCATOR = "EPSG:3857"
+# Semiancho del mundo en EPSG:3857 (m)
+MERCATOR_ORIGIN = 20037508.342789244
+# Teselas por tarea del pool
+TILES_PER_TASK = 64
+# Mapas que guarda cada proceso del pool (las tareas de varias fechas y profundidades se reparten a la vez)
+SOURCES_PER_WORKER = 4
+
+MANIFEST_NAME = "manifest.json"
+
+# Estado de cada proceso del pool: paleta y su hash, leídos una vez en _init_worker
+_worker = {}
+# Mapas ya leídos en cada proceso del pool, del más antiguo al más reciente:
+# {(map_dir, date, depth): (data, transform, crs)}
+_SOURCES = {}
+
+
+def tile_bounds(z, x, y):
+    """Límites (left, bottom, right, top) de la tesela z/x/y en EPSG:3857."""
+    size = 2 * MERCATOR_ORIGIN / (1 << z)
+    left = -MERCATOR_ORIGIN + x * size
+    top = MERCATOR_ORIGIN - y * size
+    return left, top - size, left + size, top
+
+
+def tiles_for_bounds(bounds, z):
+    """Teselas (x, y) del nivel z que cortan los límites (left, bottom, right, top) en EPSG:3857."""
+    size = 2 * MERCATOR_ORIGIN / (1 << z)
+    left, bottom, right, top = bounds
+    last = (1 << z) - 1
+    x0 = max(0, int(math.floor((left + MERCATOR_ORIGIN) / size)))
+    x1 = min(last, int(math.ceil((right + MERCATOR_ORIGIN) / size)) - 1)
+    y0 = max(0, int(math.floor((MERCATOR_ORIGIN - top) / size)))
+    y1 = min(last, int(math.ceil((MERCATOR_ORIGIN - bottom) / size)) - 1)
+    return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def native_zoom(bounds, transform, crs):
+    """Primer nivel cuya resolución es al menos la del mapa (tamaño de píxel en EPSG:3857)."""
+    left, bottom, right, top = transform_bounds(crs, WEB_MERCATOR, *bounds)
+    pixel = (right - left) / max(1.0, (bounds[2] - bounds[0]) / abs(transform.a))
+    return max(0, int(math.ceil(math.log2(2 * MERCATOR_ORIGIN / TILE_SIZE / pixel))))
+
+
+def _map_crs(map_dir, date, depth):
+    path = cog_map_path(map_dir, date, depths) or chl_map_paths(map_dir, date, depths)[1][depth]
+    with rasterio.open(path) as src:
+        return src.crs
+
+
+def _load_source(map_dir, date, depth):
+    """Mapa (data, transform, crs) de la fecha y profundidad; cada proceso guarda los SOURCES_PER_WORKER últimos."""
+    key = (map_dir, date, depth)
+    source = _SOURCES.pop(key, None)
+    if source is None:
+        if len(_SOURCES) >= SOURCES_PER_WORKER:
+            del _SOURCES[next(iter(_SOURCES))]
+        data, transform = read_chl_maps(map_dir, date, [depth])[depth]
+        source = (data, transform, _map_crs(map_dir, date, depth))
+    _SOURCES[key] = source
+    return source
+
+
+def _palette_hash(palette):
+    """Hash de los colores y límites de la paleta."""
+    return hashlib.sha1(palette["rgba"].tobytes() + palette["boundaries"].tobytes()).hexdigest()
+
+
+def _source_hash(data, transform, crs, palette, zooms):
+    """Hash de todo lo que determina la pirámide de una fecha y profundidad."""
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(data).tobytes())
+    digest.update(repr((tuple(transform), str(crs), zooms)).encode())
+    digest.update(_palette_hash(palette).encode())
+    return digest.hexdigest()
+
+
+def _init_worker(colormap_path):
+    """Inicializa un proceso del pool: la paleta se lee una sola vez."""
+    _worker["palette"] = load_palette(colormap_path)
+    _worker["palette_hash"] = _palette_hash(_worker["palette"]).encode()
+
+
+def render_tile(data, transform, crs, palette, z, x, y, resampling=Resampling.nearest):
+    """
+    Tesela z/x/y: el mapa reproyectado a EPSG:3857 sobre 256x256 píxeles y clasificado con la paleta.
+
+    Returns:
+        np.ndarray uint8 de índices de la paleta, o None si la tesela no tiene datos
+    """
+    tile = np.full((TILE_SIZE, TILE_SIZE), np.nan, dtype=np.float32)
+    reproject(source=data, destination=tile, src_transform=transform, src_crs=crs, src_nodata=np.nan,
+              dst_transform=from_bounds(*tile_bounds(z, x, y), TILE_SIZE, TILE_SIZE), dst_crs=WEB_MERCATOR,
+              dst_nodata=np.nan, resampling=resampling)
+    if np.isnan(tile).all():
+        return None
+    return classify(tile, palette)
+
+
+def _render_tiles(map_dir, date, depth, tiles_dir, tiles, max_zoom, previous):
+    """
+    Tarea del pool: renderiza un bloque de teselas [(z, x, y)] de una fecha y profundidad. Las teselas cuyo
+    hash (índices y paleta) coincide con el de previous (solo las del bloque) y siguen en disco no se
+    reescriben.
+
+    Returns:
+        (dict {"z/x/y": hash} de las teselas con datos, teselas escritas, teselas reutilizadas)
+    """
+    data, transform, crs = _load_source(map_dir, date, depth)
+    palette = _worker["palette"]
+
+    hashes = {}
+    written = reused = 0
+    for z, x, y in tiles:
+        # Por debajo de la resolución del mapa se promedian los píxeles; en ella y por encima, vecino más próximo
+        resampling = Resampling.average if z < max_zoom else Resampling.nearest
+        indices = render_tile(data, transform, crs, palette, z, x, y, resampling=resampling)
+        if indices is None:
+            continue
+
+        key = f"{z}/{x}/{y}"
+        hashes[key] = hashlib.sha1(_worker["palette_hash"] + indices.tobytes()).hexdigest()
+        path = os.path.join(tiles_dir, date, depth, str(z), str(x), f"{y}.png")
+        if previous.get(key) == hashes[key] and os.path.exists(path):
+            reused += 1
+            continue
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        to_image(indices, palette).save(f"{path}.part", format="PNG")
+        os.replace(f"{path}.part", path)
+        written += 1
+    return hashes, written, reused
+
+
+def read_manifest(tiles_dir, date, depth):
+    path = os.path.join(tiles_dir, date, depth, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_manifest(tiles_dir, date, depth, manifest):
+    path = os.path.join(tiles_dir, date, depth, MANIFEST_NAME)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.part", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(f"{path}.part", path)
+
+
+def make_tiles(dates, map_dir, tiles_dir, colormap_path, depths_to_tile=depths, min_zoom=8, max_zoom=None,
+               workers=None, force=False):
+    """
+    Pirámide de teselas de cada fecha y profundidad entre min_zoom y max_zoom (por defecto, el primer nivel
+    con la resolución del mapa). Las fechas y profundidades cuyo mapa, colormap y niveles no han cambiado
+    desde la última ejecución se saltan enteras; en el resto solo se reescriben las teselas que cambian y se
+    borran las que se han quedado sin datos.
+
+    Returns:
+        dict con written, reused, removed (teselas), skipped (fechas y profundidades sin cambios) y seconds
+    """
+    palette = load_palette(colormap_path)
+    start = time.perf_counter()
+    stats = {"written": 0, "reused": 0, "removed": 0, "skipped": 0}
+
+    # Trabajos por fecha y profundidad: niveles, manifiesto anterior y bloques de teselas
+    jobs = []
+    for date in dates:
+        for depth in depths_to_tile:
+            data, transform = read_chl_maps(map_dir, date, [depth])[depth]
+            crs = _map_crs(map_dir, date, depth)
+            bounds = array_bounds(data.shape[0], data.shape[1], transform)
+            top_zoom = max_zoom if max_zoom is not None else native_zoom(bounds, transform, crs)
+            zooms = (min_zoom, max(min_zoom, top_zoom))
+
+            manifest = read_manifest(tiles_dir, date, depth)
+            source = _source_hash(data, transform, crs, palette, zooms)
+            if not force and manifest.get("source") == source:
+                stats["skipped"] += 1
+                continue
+
+            mercator_bounds = transform_bounds(crs, WEB_MERCATOR, *bounds)
+            tiles = [(z, x, y) for z in range(zooms[0], zooms[1] + 1) for x, y in tiles_for_bounds(mercator_bounds, z)]
+            chunks = [tiles[i:i + TILES_PER_TASK] for i in range(0, len(tiles), TILES_PER_TASK)]
+            jobs.append((date, depth, zooms, source, {} if force else manifest.get("tiles", {}), chunks))
+
+    n_tasks = sum(len(job[5]) for job in jobs)
+    workers = max(1, min(workers or os.cpu_count() or 1, n_tasks or 1))
+    print(f"{len(jobs)} pirámides por generar ({n_tasks} bloques de hasta {TILES_PER_TASK} teselas), "
+          f"{stats['skipped']} sin cambios ({workers} procesos)")
+
+    results = {(date, depth): {} for date, depth, *_ in jobs}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(colormap_path,)) as executor:
+        futures = {}
+        for date, depth, zooms, _, previous, chunks in jobs:
+            for chunk in chunks:
+                keys = (f"{z}/{x}/{y}" for z, x, y in chunk)
+                chunk_previous = {key: previous[key] for key in keys if key in previous}
+                future = executor.submit(_render_tiles, map_dir, date, depth, tiles_dir, chunk, zooms[1],
+                                         chunk_previous)
+                futures[future] = (date, depth)
+        for future in as_completed(futures):
+            hashes, written, reused = future.result()
+            results[futures[future]].update(hashes)
+            stats["written"] += written
+            stats["reused"] += reused
+
+    # Manifiestos nuevos y limpieza de las teselas que ya no tienen datos
+    for date, depth, zooms, source, previous, _ in jobs:
+        hashes = results[(date, depth)]
+        for key in set(previous) - set(hashes):
+            path = os.path.join(tiles_dir, date, depth, f"{key}.png")
+            if os.path.exists(path):
+                os.remove(path)
+                stats["removed"] += 1
+        write_manifest(tiles_dir, date, depth, {"source": source, "min_zoom": zooms[0], "max_zoom": zooms[1],
+                                                "tiles": hashes})
+
+    stats["seconds"] = time.perf_counter() - start
+    print(f"Teselas: {stats['written']} escritas, {stats['reused']} reutilizadas, {stats['removed']} borradas, "
+          f"{stats['skipped']} pirámides sin cambios en {stats['seconds']:.2f} s")
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dates", nargs="+", default=None, help="Fechas a teselar (YYYY-MM-DD)")
+    parser.add_argument("--start", default=None, help="Primera fecha (YYYY-MM-DD) con mapas en --input")
+    parser.add_argument("--end", default=None, help="Última fecha (YYYY-MM-DD) con mapas en --input")
+    parser.add_argument("--depths", nargs="+", default=depths, choices=depths, help="Profundidades a teselar")
+    parser.add_argument("--input", required=True, help="Directorio donde están los mapas (COG o TIFFs por profundidad)")
+    parser.add_argument("--output", required=True, help="Directorio raíz de las teselas")
+    parser.add_argument("--colormap", required=True, help="Fichero con el colormap a utilizar")
+    parser.add_argument("--min-zoom", default=8, type=int, help="Primer nivel de zoom")
+    parser.add_argument("--max-zoom", default=None, type=int, help="Último nivel de zoom (por defecto, el de la resolución del mapa)")
+    parser.add_argument("--workers", default=None, type=int, help="Procesos del pool (por defecto, uno por núcleo)")
+    parser.add_argument("--force", action="store_true", help="Regenerar aunque el mapa no haya cambiado")
+    args = parser.parse_args()
+
+    dates = args.dates or available_map_dates(args.input, args.start, args.end)
+    make_tiles(dates, args.input, args.output, args.colormap, depths_to_tile=args.depths, min_zoom=args.min_zoom,
+               max_zoom=args.max_zoom, workers=args.workers, force=args.force)
@@ -0,0 +1,350 @@
+import argparse
+import io
+import os
+import struct
+import zlib
+import numpy as np
+import rasterio
+from affine import Affine
+from PIL import Image
+from Aplicacion_utils import available_map_dates, chl_map_paths, cog_map_path, read_chl_maps
+from Aplicacion_Render import load_palette, compose_frame, GIF_SCALE
+
+# Animaciones de una profundidad a lo largo de muchas fechas. Los fotogramas se generan de fecha en fecha y se
+# escriben según se generan (GIF, APNG y WebP se montan directamente en el fichero; MP4 va a ffmpeg por una
+# tubería), así que la memoria no depende del número de fechas. Todos los fotogramas comparten paleta,
+# extensión y leyenda.
+
+depths = ["0_1", "1_2", "2_3", "3_4"]
+
+TIMELAPSE_FORMATS = {"gif": ".gif", "apng": ".png", "webp": ".webp", "mp4": ".mp4"}
+
+
+def _tmp_path(path):
+    """Fichero temporal con la misma extensión (ffmpeg deduce el contenedor de ella)."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.part{ext}"
+
+
+class GifWriter:
+    """
+    GIF animado escrito fotograma a fotograma. Cada fotograma se comprime con el codificador LZW de PIL y
+    su bloque de imagen se copia al fichero, que lleva la paleta como tabla global.
+    """
+
+    def __init__(self, path, width, height, palette, duration, loop=0):
+        self.path = path
+        self.tmp_path = _tmp_path(path)
+        self.delay = max(1, int(round(duration / 10)))  # centésimas de segundo
+
+        colors = palette["rgba"][:, :3]
+        self.bits = max(1, int(np.ceil(np.log2(len(colors)))))
+        table = np.zeros((1 << self.bits, 3), dtype=np.uint8)
+        table[:len(colors)] = colors
+        self.table = table.tobytes()
+        self.pil_palette = colors.tobytes()
+
+        self.file = open(self.tmp_path, "wb")
+        self.file.write(b"GIF89a" + struct.pack("<HHBBB", width, height, 0xF0 | (self.bits - 1),
+                                               palette["background"], 0) + self.table)
+        # Bucle (NETSCAPE2.0); loop = 0 repite siempre
+        self.file.write(b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", loop) + b"\x00")
+        self.n_frames = 0
+
+    def append(self, indices):
+        image = Image.fromarray(np.ascontiguousarray(indices), mode="P")
+        image.putpalette(self.pil_palette)
+        buffer = io.BytesIO()
+        image.save(buffer, format="GIF", optimize=False, interlace=False)
+        data = buffer.getvalue()
+
+        # Cabecera de PIL: tabla global (si la hay) y extensiones hasta el descriptor de imagen (0x2C)
+        flags = data[10]
+        pos = 13
+        pil_table = b""
+        if flags & 0x80:
+            pil_table = data[pos:pos + 3 * (1 << ((flags & 0x07) + 1))]
+            pos += len(pil_table)
+        while data[pos] == 0x21:
+            pos += 2
+            while data[pos]:
+                pos += data[pos] + 1
+            pos += 1
+        if data[pos] != 0x2C:
+            raise ValueError("GIF de PIL inesperado: no se encuentra el descriptor de imagen")
+
+        descriptor = bytearray(data[pos:pos + 10])
+        image_data = data[pos + 10:-1]  # sin el terminador 0x3B
+        # Si PIL ha escrito otra tabla de colores, va como tabla local del fotograma
+        if not descriptor[9] & 0x80 and pil_table and pil_table != self.table:
+            descriptor[9] |= 0x80 | ((flags & 0x07))
+            image_data = pil_table + image_data
+
+        # Graphic Control Extension: duración y fotograma sobre fondo (disposal 1)
+        self.file.write(b"!\xf9\x04\x04" + struct.pack("<H", self.delay) + b"\x00\x00")
+        self.file.write(bytes(descriptor) + image_data)
+        self.n_frames += 1
+
+    def close(self):
+        self.file.write(b";")
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp_path)
+
+
+class ApngWriter:
+    """
+    PNG animado (APNG) con paleta, escrito fotograma a fotograma. El número de fotogramas de acTL se
+    corrige al cerrar.
+    """
+
+    def __init__(self, path, width, height, palette, duration, loop=0):
+        self.path = path
+        self.tmp_path = _tmp_path(path)
+        self.width, self.height = width, height
+        self.duration = int(duration)
+        self.sequence = 0
+        self.n_frames = 0
+
+        self.file = open(self.tmp_path, "wb")
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0))
+        self._chunk(b"PLTE", palette["rgba"][:, :3].tobytes())
+        self.actl_offset = self.file.tell()
+        self._chunk(b"acTL", struct.pack(">II", 0, loop))
+        self.loop = loop
+
+    def _chunk(self, kind, data):
+        self.file.write(struct.pack(">I", len(data)) + kind + data +
+                        struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+    def append(self, indices):
+        # Filas con el byte de filtro 0 (None) delante
+        raw = np.zeros((self.height, self.width + 1), dtype=np.uint8)
+        raw[:, 1:] = indices
+        compressed = zlib.compress(raw.tobytes(), 6)
+
+        self._chunk(b"fcTL", struct.pack(">IIIIIHHBB", self.sequence, self.width, self.height, 0, 0,
+                                         self.duration, 1000, 0, 0))
+        self.sequence += 1
+        if self.n_frames == 0:
+            self._chunk(b"IDAT", compressed)
+        else:
+            self._chunk(b"fdAT", struct.pack(">I", self.sequence) + compressed)
+            self.sequence += 1
+        self.n_frames += 1
+
+    def close(self):
+        self._chunk(b"IEND", b"")
+        self.file.seek(self.actl_offset)
+        self._chunk(b"acTL", struct.pack(">II", self.n_frames, self.loop))
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp_path)
+
+
+class WebpWriter:
+    """
+    WebP animado escrito fotograma a fotograma: cada fotograma se codifica con PIL (sin pérdidas) y su
+    bitstream va en un chunk ANMF. El tamaño del RIFF se corrige al cerrar.
+    """
+
+    def __init__(self, path, width, height, palette, duration, loop=0):
+        self.path = path
+        self.tmp_path = _tmp_path(path)
+        self.duration = int(duration)
+        self.rgb = palette["rgba"][:, :3]
+        self.n_frames = 0
+
+        self.file = open(self.tmp_path, "wb")
+        self.file.write(b"RIFF\x00\x00\x00\x00WEBP")
+        # VP8X: animación, lienzo de width x height
+        self._chunk(b"VP8X", struct.pack("<I", 0x02) + (width - 1).to_bytes(3, "little") +
+                    (height - 1).to_bytes(3, "little"))
+        self._chunk(b"ANIM", struct.pack("<IH", 0xFFFFFFFF, loop))
+
+    def _chunk(self, kind, data):
+        self.file.write(kind + struct.pack("<I", len(data)) + data + (b"\x00" if len(data) % 2 else b""))
+
+    def append(self, indices):
+        height, width = indices.shape
+        buffer = io.BytesIO()
+        Image.fromarray(self.rgb[indices]).save(buffer, format="WEBP", lossless=True)
+        data = buffer.getvalue()
+
+        # Chunks del bitstream del fotograma (ALPH, VP8 o VP8L), sin la cabecera RIFF ni VP8X/metadatos
+        frame = b""
+        pos = 12
+        while pos + 8 <= len(data):
+            kind = data[pos:pos + 4]
+            size = struct.unpack("<I", data[pos + 4:pos + 8])[0]
+            end = pos + 8 + size + (size % 2)
+            if kind in (b"ALPH", b"VP8 ", b"VP8L"):
+                frame += data[pos:end]
+            pos = end
+
+        header = (0).to_bytes(3, "little") * 2 + (width - 1).to_bytes(3, "little") + \
+            (height - 1).to_bytes(3, "little") + self.duration.to_bytes(3, "little") + b"\x02"
+        self._chunk(b"ANMF", header + frame)
+        self.n_frames += 1
+
+    def close(self):
+        size = self.file.tell() - 8
+        self.file.seek(4)
+        self.file.write(struct.pack("<I", size))
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp_path)
+
+
+class Mp4Writer:
+    """
+    MP4 (H.264) enviando cada fotograma RGB a ffmpeg por una tubería. Requiere imageio-ffmpeg.
+    """
+
+    def __init__(self, path, width, height, palette, duration, loop=0):
+        try:
+            import imageio_ffmpeg
+        except ImportError:
+            raise ImportError("El formato mp4 requiere imageio-ffmpeg (pip install imageio-ffmpeg)")
+
+        self.path = path
+        self.tmp_path = _tmp_path(path)
+        self.rgb = palette["rgba"][:, :3]
+        # yuv420p necesita dimensiones pares
+        self.width, self.height = width + width % 2, height + height % 2
+        self.background = palette["background"]
+        self.n_frames = 0
+
+        self.writer = imageio_ffmpeg.write_frames(self.tmp_path, (self.width, self.height), fps=1000.0 / duration,
+                                                  codec="libx264", pix_fmt_in="rgb24", macro_block_size=1)
+        self.writer.send(None)
+
+    def append(self, indices):
+        padded = np.full((self.height, self.width), self.background, dtype=np.uint8)
+        padded[:indices.shape[0], :indices.shape[1]] = indices
+        self.writer.send(np.ascontiguousarray(self.rgb[padded]))
+        self.n_frames += 1
+
+    def close(self):
+        self.writer.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.writer.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+WRITERS = {"gif": GifWriter, "apng": ApngWriter, "webp": WebpWriter, "mp4": Mp4Writer}
+
+
+def common_extent(map_dir, dates, depth):
+    """
+    Extensión común de los mapas de una profundidad en todas las fechas, leyendo solo las cabeceras.
+    Los mapas deben compartir resolución y rejilla (los de SNAP sobre el mismo AOI).
+
+    Returns:
+        (transform de la extensión común, filas, columnas, dict {date: (fila, columna) de su esquina})
+    """
+    headers = {}
+    for date in dates:
+        path = cog_map_path(map_dir, date, depths) or chl_map_paths(map_dir, date, depths)[1][depth]
+        with rasterio.open(path) as src:
+            headers[date] = (src.transform, src.height, src.width)
+
+    transform = headers[dates[0]][0]
+    if any(abs(t.a - transform.a) > 1e-9 or abs(t.e - transform.e) > 1e-9 for t, _, _ in headers.values()):
+        raise ValueError("Los mapas de las fechas no tienen la misma resolución")
+
+    # Esquina de cada mapa en píxeles respecto al primero
+    corners = {date: (int(round((t.f - transform.f) / transform.e)), int(round((t.c - transform.c) / transform.a)))
+               for date, (t, _, _) in headers.items()}
+    row0 = min(r for r, _ in corners.values())
+    col0 = min(c for _, c in corners.values())
+    height = max(r + headers[d][1] for d, (r, _) in corners.items()) - row0
+    width = max(c + headers[d][2] for d, (_, c) in corners.items()) - col0
+
+    offsets = {date: (r - row0, c - col0) for date, (r, c) in corners.items()}
+    return transform * Affine.translation(col0, row0), height, width, offsets
+
+
+def make_timelapse(dates, depth, map_dir, output_dir, palette, formats=("gif",), duration=500, scale=GIF_SCALE,
+                   loop=0):
+    """
+    Animación de una profundidad con un fotograma por fecha, en cada formato de formats
+    ({output_dir}chl_timelapse_{depth}_{primera}_{última}{ext}). Cada fecha se lee, se dibuja y se escribe
+    en todos los formatos antes de pasar a la siguiente.
+
+    Args:
+        duration: milisegundos por fotograma
+        scale: píxeles de imagen por píxel del ráster
+
+    Returns:
+        dict {formato: ruta}
+    """
+    _, height, width, offsets = common_extent(map_dir, dates, depth)
+    depth_str = depth.replace("_", "-")
+
+    writers = {}
+    paths = {}
+    try:
+        for date in dates:
+            data, _ = read_chl_maps(map_dir, date, [depth])[depth]
+            canvas = np.full((height, width), np.nan, dtype=np.float32)
+            row, col = offsets[date]
+            canvas[row:row + data.shape[0], col:col + data.shape[1]] = data
+            indices = compose_frame(canvas, palette, scale=scale, legend=True, label=f"{date}  Depth {depth_str}")
+
+            if not writers:
+                # El tamaño de los fotogramas es fijo (extensión común + leyenda) y se conoce con el primero
+                for fmt in formats:
+                    paths[fmt] = f"{output_dir}chl_timelapse_{depth}_{dates[0]}_{dates[-1]}{TIMELAPSE_FORMATS[fmt]}"
+                    writers[fmt] = WRITERS[fmt](paths[fmt], indices.shape[1], indices.shape[0], palette, duration,
+                                                loop=loop)
+            for writer in writers.values():
+                writer.append(indices)
+    except BaseException:
+        # Sin ficheros a medias: se borran los temporales
+        for writer in writers.values():
+            writer.abort()
+        raise
+
+    for writer in writers.values():
+        writer.close()
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dates", nargs="+", default=None, help="Fechas a incluir (YYYY-MM-DD)")
+    parser.add_argument("--start", default=None, help="Primera fecha (YYYY-MM-DD) con mapas en --input")
+    parser.add_argument("--end", default=None, help="Última fecha (YYYY-MM-DD) con mapas en --input")
+    parser.add_argument("--depths", nargs="+", default=depths, choices=depths, help="Profundidades (una animación por profundidad)")
+    parser.add_argument("--input", required=True, help="Directorio donde están los mapas (COG o TIFFs por profundidad)")
+    parser.add_argument("--output", required=True, help="Directorio donde se guardan las animaciones")
+    parser.add_argument("--colormap", required=True, help="Fichero con el colormap a utilizar")
+    parser.add_argument("--formats", nargs="+", default=["gif"], choices=list(TIMELAPSE_FORMATS), help="Formatos de salida (mp4 requiere imageio-ffmpeg)")
+    parser.add_argument("--duration", default=500, type=int, help="Milisegundos por fotograma")
+    parser.add_argument("--scale", default=GIF_SCALE, type=int, help="Píxeles de imagen por píxel del mapa")
+    args = parser.parse_args()
+
+    dates = args.dates or available_map_dates(args.input, args.start, args.end)
+    if not dates:
+        raise SystemExit("No hay mapas para las fechas indicadas")
+
+    palette = load_palette(args.colormap)
+    for depth in args.depths:
+        paths = make_timelapse(dates, depth, args.input, args.output, palette, formats=args.formats,
+                               duration=args.duration, scale=args.scale)
+        for fmt, path in paths.items():
+            print(f"{depth} ({len(dates)} fechas): {path}")
@@ -4,16 +4,310 @@ import os
 from itertools import permutations, combinations
 import re
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import math
+import hashlib
+import shutil
 import rasterio
 from rasterio import features
+from rasterio.windows import Window, from_bounds
+from affine import Affine
 import numpy as np
 import geopandas as gpd
 import json
+import warnings
+from functools import lru_cache
 from typing import Optional
 from joblib import load as joblib_load
 
 
-def extract_pixels_in_marmenor(folder_path, target_dates, grouping, net_set, polygon_path):
+# Desplazamiento (semiancho de ventana) para cada agrupamiento; cualquier otro valor es 1x1
+GROUPING_OFFSETS = {
+    "3x3": 1,
+    "5x5": 2,
+    "9x9": 4,
+    "15x15": 7,
+}
+
+# Bandas del TIFF de SNAP que usan los modelos (Band_1..Band_21 -> rtoa_B1..rtoa_B12, rhow_B1..rhow_B8A)
+EXTRACTION_BANDS = list(range(1, 22))
+
+
+def windowed_median(bands, rows, cols, offset, chunk_size=4096):
+    """
+    Calcula de una vez la mediana por ventana de todas las bandas para un conjunto de píxeles.
+
+    La ventana es de (2*offset+1)x(2*offset+1) centrada en cada píxel y se recorta en los bordes
+    del raster igual que el slicing con max/min del bucle original, por lo que los valores son
+    idénticos a aplicar np.median píxel a píxel (incluida la propagación de NaN).
+
+    Args:
+        bands: array (n_bands, height, width)
+        rows, cols: índices de fila y columna de los píxeles a calcular
+        offset: semiancho de la ventana (0 devuelve los valores del propio píxel)
+        chunk_size: número de píxeles procesados por bloque, para acotar memoria
+
+    Returns:
+        np.ndarray (n_pixeles, n_bands)
+    """
+    rows = np.asarray(rows, dtype=np.intp)
+    cols = np.asarray(cols, dtype=np.intp)
+
+    if offset <= 0:
+        return bands[:, rows, cols].T
+
+    # np.median devuelve float64 para enteros; el relleno con NaN necesita un tipo flotante
+    if not np.issubdtype(bands.dtype, np.floating):
+        bands = bands.astype(np.float64)
+
+    n_bands, height, width = bands.shape
+    k = 2 * offset + 1
+
+    # Relleno con NaN fuera del raster y vista (sin copia) de todas las ventanas kxk
+    padded = np.pad(bands, ((0, 0), (offset, offset), (offset, offset)),
+                    mode="constant", constant_values=np.nan)
+    windows = sliding_window_view(padded, (k, k), axis=(1, 2))
+
+    # Celdas reales de cada ventana tras el recorte en bordes
+    n_valid = ((np.minimum(rows + offset + 1, height) - np.maximum(rows - offset, 0))
+               * (np.minimum(cols + offset + 1, width) - np.maximum(cols - offset, 0)))
+
+    out = np.empty((len(rows), n_bands), dtype=bands.dtype)
+    for start in range(0, len(rows), chunk_size):
+        sl = slice(start, start + chunk_size)
+        m = n_valid[sl]
+
+        block = windows[:, rows[sl], cols[sl]].reshape(n_bands, -1, k * k)
+        # Un NaN más de los de relleno significa que la ventana original tenía NaN
+        has_nan = np.isnan(block).sum(axis=-1) > (k * k - m)
+
+        # sort deja los NaN al final, así que los m primeros son los valores de la ventana recortada
+        block.sort(axis=-1)
+        lo = np.take_along_axis(block, ((m - 1) // 2)[None, :, None], axis=-1)[..., 0]
+        hi = np.take_along_axis(block, (m // 2)[None, :, None], axis=-1)[..., 0]
+
+        # Mismo cálculo que np.median: elemento central o media de los dos centrales
+        med = np.where(m % 2 == 1, lo, np.mean(np.stack((lo, hi)), axis=0))
+        med[has_nan] = np.nan
+        out[sl] = med.T
+
+    return out
+
+
+# Máscaras del polígono ya calculadas en este proceso, por clave de rejilla
+_MASK_CACHE = {}
+
+
+def load_polygon(polygon_path):
+    """
+    Lee el polígono del Mar Menor como GeoDataFrame (EPSG:32630 si el fichero no trae CRS).
+    """
+    #gdf = gpd.read_file(polygon_path)
+    with open(polygon_path, "r") as f:
+        data = json.load(f)
+
+    gdf = gpd.GeoDataFrame.from_features(data["features"])
+    if gdf.crs is None:
+        gdf.set_crs("EPSG:32630", inplace=True)
+    return gdf
+
+
+def _mask_cache_key(polygon_path, dataset):
+    """
+    Clave de la máscara: hash del fichero del polígono + transform, tamaño y CRS del raster.
+    """
+    with open(polygon_path, "rb") as f:
+        polygon_hash = hashlib.sha256(f.read()).hexdigest()
+
+    crs = dataset.crs.to_wkt() if dataset.crs else ""
+    grid = f"{tuple(dataset.transform)[:6]}|{dataset.height}x{dataset.width}|{crs}"
+    return hashlib.sha256(f"{polygon_hash}|{grid}".encode("utf-8")).hexdigest()[:24]
+
+
+def _rasterize_polygon(gdf, dataset):
+    """
+    Rasteriza el polígono sobre su bounding box en la rejilla del raster.
+
+    Returns:
+        dict con 'bbox' (row_start, col_start, row_stop, col_stop), 'mask' (booleana, tamaño del bbox)
+        y 'rows'/'cols' (índices globales de los píxeles dentro del polígono)
+    """
+    win = from_bounds(*gdf.total_bounds, transform=dataset.transform)
+    row_start = max(math.floor(win.row_off), 0)
+    col_start = max(math.floor(win.col_off), 0)
+    row_stop = max(min(math.ceil(win.row_off + win.height), dataset.height), row_start)
+    col_stop = max(min(math.ceil(win.col_off + win.width), dataset.width), col_start)
+
+    if row_stop > row_start and col_stop > col_start:
+        bbox_window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+        mask = features.geometry_mask(
+            geometries=gdf.geometry,
+            transform=dataset.window_transform(bbox_window),
+            invert=True,
+            out_shape=(bbox_window.height, bbox_window.width)
+        )
+    else:
+        mask = np.zeros((0, 0), dtype=bool)
+
+    rows, cols = np.nonzero(mask)
+    return {
+        "bbox": np.array([row_start, col_start, row_stop, col_stop], dtype=np.int64),
+        "mask": mask,
+        "rows": (rows + row_start).astype(np.int32),
+        "cols": (cols + col_start).astype(np.int32),
+    }
+
+
+def polygon_mask(polygon_path, dataset, cache_dir=None):
+    """
+    Máscara del polígono sobre la rejilla de 'dataset', con caché en memoria y, si se indica
+    cache_dir, en disco (un .npz por polígono y rejilla). La rejilla de SNAP es la misma en todas las
+    fechas de un tile, así que a partir de la primera fecha no se vuelve a leer ni rasterizar el polígono.
+
+    Returns:
+        dict con 'bbox', 'mask', 'rows' y 'cols' (ver _rasterize_polygon)
+    """
+    key = _mask_cache_key(polygon_path, dataset)
+    if key in _MASK_CACHE:
+        return _MASK_CACHE[key]
+
+    cache_file = os.path.join(cache_dir, f"mask_{key}.npz") if cache_dir else None
+    if cache_file and os.path.exists(cache_file):
+        with np.load(cache_file) as data:
+            entry = {k: data[k] for k in data.files}
+    else:
+        entry = _rasterize_polygon(load_polygon(polygon_path), dataset)
+        if cache_file:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Escritura atómica para no dejar cachés a medias si se interrumpe el proceso
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp.npz"
+            np.savez_compressed(tmp_file, **entry)
+            os.replace(tmp_file, cache_file)
+
+    _MASK_CACHE[key] = entry
+    return entry
+
+
+def polygon_window(bbox, dataset, pad=0):
+    """
+    Ventana del raster que cubre el bounding box del polígono, ampliada en 'pad' píxeles por cada lado
+    (semiancho de la mayor ventana de agrupamiento) y recortada a los límites del raster.
+
+    Returns:
+        rasterio.windows.Window, o None si el polígono no solapa con el raster
+    """
+    row_start, col_start, row_stop, col_stop = (int(v) for v in bbox)
+    if row_stop <= row_start or col_stop <= col_start:
+        return None
+
+    row_start = max(row_start - pad, 0)
+    col_start = max(col_start - pad, 0)
+    row_stop = min(row_stop + pad, dataset.height)
+    col_stop = min(col_stop + pad, dataset.width)
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def list_net_tiffs(folder_path, net_set):
+    """
+    TIFFs de SNAP de la carpeta correspondientes al conjunto de redes (C2X-Complex, C2X, C2RCC).
+    """
+    # Selección de ficheros TIFF
+    if net_set == "C2X-Complex":
+        return [f for f in os.listdir(folder_path) if f.endswith('.tif') and 'C2XComplexNets' in f]
+    elif net_set == "C2X":
+        return [f for f in os.listdir(folder_path) if f.endswith('.tif') and 'C2XNets' in f]
+    elif net_set == "C2RCC":
+        return [f for f in os.listdir(folder_path) if f.endswith('.tif') and 'C2RCC' in f]
+    else:
+        raise ValueError("Net Set no reconocido")
+
+
+def find_date_tiff(folder_path, tif_files, date):
+    """
+    Ruta del TIFF de una fecha (YYYY-MM-DD) dentro de tif_files, o None si no hay.
+    """
+    date_str = date.replace('-', '')
+    matching = [f for f in tif_files if date_str in f]
+    if not matching:
+        return None
+    return os.path.join(folder_path, matching[0])
+
+
+def available_tiff_dates(folder_path, net_set, start=None, end=None):
+    """
+    Fechas (YYYY-MM-DD, ordenadas) con TIFF de SNAP en la carpeta, opcionalmente entre start y end (incluidas).
+    La fecha se toma del nombre del producto: S2A_MSIL1C_20220714T105631_..._C2XComplexNets_10m.tif
+    """
+    dates = set()
+    for f in list_net_tiffs(folder_path, net_set):
+        match = re.search(r"_(\d{8})T\d{6}_", f)
+        if match:
+            d = match.group(1)
+            dates.add(f"{d[:4]}-{d[4:6]}-{d[6:]}")
+    return [d for d in sorted(dates) if (start is None or d >= start) and (end is None or d <= end)]
+
+
+# Columnas de identificación del píxel: fecha, centro en coordenadas del TIFF y fila/columna en la rejilla de SNAP
+PIXEL_COLUMNS = ["Date", "Latitude", "Longitude", "row", "col"]
+
+
+def _pixels_frame(date, lats, lons, values, band_columns, band_dtype=None, index=None, rows=None, cols=None):
+    """
+    DataFrame de píxeles construido directamente por columnas de NumPy: Date, Latitude, Longitude,
+    row y col (si se pasan) y bandas.
+    """
+    if band_dtype is not None:
+        values = values.astype(band_dtype, copy=False)
+
+    df = pd.DataFrame(values, columns=band_columns, index=index)
+    df.insert(0, "Date", date)
+    df.insert(1, "Latitude", lats)
+    df.insert(2, "Longitude", lons)
+    if rows is not None:
+        df.insert(3, "row", np.asarray(rows, dtype=np.int32))
+        df.insert(4, "col", np.asarray(cols, dtype=np.int32))
+    return df
+
+
+def snap_grid(folder_path, date, net_set):
+    """
+    Rejilla del TIFF de SNAP de una fecha: {"crs" (WKT), "transform" (a, b, c, d, e, f), "width", "height"},
+    o None si no hay TIFF. Con ella y las columnas row/col se escriben los mapas sin volver a crear la rejilla.
+    """
+    tiff_file = find_date_tiff(folder_path, list_net_tiffs(folder_path, net_set), date)
+    if tiff_file is None:
+        return None
+    with rasterio.open(tiff_file) as dataset:
+        return {
+            "crs": dataset.crs.to_wkt() if dataset.crs else None,
+            "transform": list(dataset.transform)[:6],
+            "width": dataset.width,
+            "height": dataset.height,
+        }
+
+
+def write_grid_info(base: str, grid: dict) -> str:
+    """
+    Guarda la rejilla de SNAP junto a una tabla intermedia ('base' sin extensión) como {base}_grid.json.
+    """
+    grid_path = f"{base}_grid.json"
+    with open(grid_path, "w", encoding="utf-8") as f:
+        json.dump(grid, f)
+    return grid_path
+
+
+def read_grid_info(base: str):
+    """
+    Rejilla de SNAP guardada con write_grid_info, o None si no existe.
+    """
+    grid_path = f"{base}_grid.json"
+    if not os.path.exists(grid_path):
+        return None
+    with open(grid_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def extract_pixels_in_marmenor(folder_path, target_dates, grouping, net_set, polygon_path, mask_cache_dir=None):
     """
     Extrae valores de píxeles dentro del área del Mar Menor a partir de GeoTIFFs y un polígono de máscara.
 
@@ -23,98 +317,154 @@ def extract_pixels_in_marmenor(folder_path, target_dates, grouping, net_set, pol
         grouping: tamaño de agrupamiento ("1x1", "3x3", "5x5", etc.)
         net_set: prefijo del conjunto (C2X-Complex, C2X, C2RCC)
         polygon_path: ruta al archivo GeoJSON o Shapefile del Mar Menor
+        mask_cache_dir: carpeta para la caché en disco de máscaras del polígono (opcional)
 
     Returns:
         pd.DataFrame con bandas y coordenadas por píxel
     """
-    results = []
-    target_dates = sorted(set(target_dates))
+    return extract_pixels_in_marmenor_groupings(folder_path, target_dates, [grouping], net_set, polygon_path,
+                                                mask_cache_dir=mask_cache_dir)[grouping]
 
-    # Selección de ficheros TIFF
-    if net_set == "C2X-Complex":
-        tif_files = [f for f in os.listdir(folder_path) if f.endswith('.tif') and 'C2XComplexNets' in f]
-    elif net_set == "C2X":
-        tif_files = [f for f in os.listdir(folder_path) if f.endswith('.tif') and 'C2XNets' in f]
-    elif net_set == "C2RCC":
-        tif_files = [f for f in os.listdir(folder_path) if f.endswith('.tif') and 'C2RCC' in f]
-    else:
-        raise ValueError("Net Set no reconocido")
 
-    # Leer el polígono del Mar Menor
-    #gdf = gpd.read_file(polygon_path)
-    with open(polygon_path, "r") as f:
-        data = json.load(f)
+def extract_pixels_in_marmenor_groupings(folder_path, target_dates, groupings, net_set, polygon_path,
+                                         band_indexes=None, mask_cache_dir=None, band_dtype=None):
+    """
+    Igual que extract_pixels_in_marmenor pero para varios agrupamientos a la vez: cada TIFF se lee
+    una sola vez y la máscara del polígono se construye una sola vez por fecha.
 
-    gdf = gpd.GeoDataFrame.from_features(data["features"])
-    if gdf.crs is None:
-        gdf.set_crs("EPSG:32630", inplace=True)
+    Solo se lee el bounding box del polígono (ampliado con el semiancho de la mayor ventana) y las
+    bandas indicadas, así que memoria y tiempo de lectura dependen de la laguna y no de la salida de SNAP.
 
+    Args:
+        folder_path: carpeta con los TIFFs
+        target_dates: lista de fechas (formato YYYY-MM-DD)
+        groupings: lista de agrupamientos (["5x5", "9x9"], etc.)
+        net_set: prefijo del conjunto (C2X-Complex, C2X, C2RCC)
+        polygon_path: ruta al archivo GeoJSON o Shapefile del Mar Menor
+        band_indexes: bandas a leer (1-based); por defecto EXTRACTION_BANDS
+        mask_cache_dir: carpeta para la caché en disco de máscaras del polígono (opcional)
+        band_dtype: tipo de las columnas de bandas (p. ej. np.float32); por defecto el del TIFF
+
+    Returns:
+        dict {grouping: pd.DataFrame} con bandas, coordenadas y fila/columna (row, col) en la rejilla del TIFF
+    """
+    results = {grouping: [] for grouping in groupings}
+    target_dates = sorted(set(target_dates))
+    band_indexes = list(band_indexes or EXTRACTION_BANDS)
+    band_columns = [f"Band_{i}" for i in band_indexes]
+    max_offset = max([GROUPING_OFFSETS.get(grouping, 0) for grouping in groupings] + [0])
+
+    tif_files = list_net_tiffs(folder_path, net_set)
 
     for date in target_dates:
-        date_str = date.replace('-', '')
-        matching = [f for f in tif_files if date_str in f]
-        if not matching:
+        tiff_file = find_date_tiff(folder_path, tif_files, date)
+        if tiff_file is None:
             continue
 
-        tiff_file = os.path.join(folder_path, matching[0])
         with rasterio.open(tiff_file) as dataset:
             print(f"Procesando {tiff_file}")
-            bands = dataset.read()  # shape: (n_bands, height, width)
-
-            # Crear máscara booleana de los píxeles dentro del polígono
-            mask = features.geometry_mask(
-                geometries=gdf.geometry,
-                transform=dataset.transform,
-                invert=True,
-                out_shape=(dataset.height, dataset.width)
-            )
-
-            if grouping == "3x3":
-                offset = 1
-            elif grouping == "5x5":
-                offset = 2
-            elif grouping == "9x9":
-                offset = 4
-            elif grouping == "15x15":
-                offset = 7
-            else:
-                offset = 0
+            # Máscara del polígono (cacheada por rejilla) y recorte a leer
+            polygon = polygon_mask(polygon_path, dataset, cache_dir=mask_cache_dir)
+            window = polygon_window(polygon["bbox"], dataset, pad=max_offset)
+            if window is None:
+                print(f"El polígono no solapa con {tiff_file}")
+                continue
 
-            # Iterar sobre todos los píxeles dentro del polígono
-            idxs = np.argwhere(mask)
+            # Solo el recorte del polígono y las bandas necesarias: shape (n_bands, h, w)
+            bands = dataset.read(indexes=band_indexes, window=window)
 
-            for row_idx, col_idx in idxs:
-                try:
-                    if offset > 0:
-                        row_start = max(row_idx - offset, 0)
-                        row_end = min(row_idx + offset + 1, dataset.height)
-                        col_start = max(col_idx - offset, 0)
-                        col_end = min(col_idx + offset + 1, dataset.width)
-
-                        window = (
-                            slice(row_start, row_end),
-                            slice(col_start, col_end)
-                        )
-
-                        reflectances = bands[:, window[0], window[1]]
-                        values = np.median(reflectances, axis=(1, 2))
-                    else:
-                        values = bands[:, row_idx, col_idx]
-
-                    # Convertir coordenadas a UTM (o lat/lon si prefieres)
-                    lon, lat = dataset.xy(row_idx, col_idx)
-
-                    results.append({
-                        "Date": date,
-                        "Latitude": lat,
-                        "Longitude": lon,
-                        **{f"Band_{i+1}": val for i, val in enumerate(values)}
-                    })
-                except Exception as e:
-                    print(f"Error en píxel ({row_idx},{col_idx}): {e}")
-                    continue
-
-    return pd.DataFrame(results)
+            # Píxeles dentro del polígono (globales y en el recorte), comunes a todos los agrupamientos
+            rows = polygon["rows"].astype(np.intp)
+            cols = polygon["cols"].astype(np.intp)
+            local_rows = rows - window.row_off
+            local_cols = cols - window.col_off
+
+            # Coordenadas del centro de cada píxel (mismo cálculo que dataset.xy) en una sola operación afín
+            lons, lats = (dataset.transform * Affine.translation(0.5, 0.5)) * (cols, rows)
+
+            for grouping in groupings:
+                offset = GROUPING_OFFSETS.get(grouping, 0)
+
+                # Mediana por ventana de todos los píxeles dentro del polígono en un solo cálculo
+                values_all = windowed_median(bands, local_rows, local_cols, offset)
+
+                results[grouping].append(_pixels_frame(date, lats, lons, values_all, band_columns, band_dtype,
+                                                       rows=rows, cols=cols))
+
+    empty = pd.DataFrame(columns=PIXEL_COLUMNS + band_columns)
+    return {grouping: pd.concat(dfs, ignore_index=True) if dfs else empty.copy()
+            for grouping, dfs in results.items()}
+
+
+def estimate_chunk_size(max_memory_mb, groupings, n_bands=len(EXTRACTION_BANDS), n_features=64):
+    """
+    Número de píxeles por bloque para que el procesado en streaming no pase de max_memory_mb.
+
+    Estimación por píxel: las ventanas kxk de todas las bandas (copia y ordenación en windowed_median)
+    para cada agrupamiento, más varias copias de las variables en float64 (DataFrames de bandas, índices,
+    estación y matriz de predicción).
+    """
+    per_pixel = 0
+    for grouping in groupings:
+        k = 2 * GROUPING_OFFSETS.get(grouping, 0) + 1
+        per_pixel += 2 * k * k * n_bands * 8 + 4 * (n_bands + n_features) * 8
+    return max(1024, int(max_memory_mb * 1024 ** 2 // per_pixel))
+
+
+def iter_pixel_chunks(folder_path, date, groupings, net_set, polygon_path, chunk_size=20000,
+                      band_indexes=None, mask_cache_dir=None, band_dtype=None):
+    """
+    Versión en streaming de extract_pixels_in_marmenor_groupings para una fecha: recorre los píxeles del
+    polígono en bloques de chunk_size y, para cada bloque, lee del TIFF solo la franja de filas que necesita
+    (más el semiancho de la mayor ventana). La memoria usada depende de chunk_size y no del tamaño del AOI.
+
+    Yields:
+        dict {grouping: pd.DataFrame} por bloque; el índice es la posición del píxel en el polígono, igual
+        para todos los agrupamientos, y las filas salen en el mismo orden que en la extracción completa
+    """
+    band_indexes = list(band_indexes or EXTRACTION_BANDS)
+    band_columns = [f"Band_{i}" for i in band_indexes]
+    max_offset = max([GROUPING_OFFSETS.get(grouping, 0) for grouping in groupings] + [0])
+
+    tiff_file = find_date_tiff(folder_path, list_net_tiffs(folder_path, net_set), date)
+    if tiff_file is None:
+        return
+
+    with rasterio.open(tiff_file) as dataset:
+        print(f"Procesando {tiff_file} en bloques de {chunk_size} píxeles")
+        polygon = polygon_mask(polygon_path, dataset, cache_dir=mask_cache_dir)
+        window = polygon_window(polygon["bbox"], dataset, pad=max_offset)
+        if window is None:
+            print(f"El polígono no solapa con {tiff_file}")
+            return
+
+        transform = dataset.transform * Affine.translation(0.5, 0.5)
+        rows_all = polygon["rows"].astype(np.intp)
+        cols_all = polygon["cols"].astype(np.intp)
+
+        # Los píxeles están ordenados por filas, así que cada bloque ocupa una franja de filas contigua
+        for start in range(0, len(rows_all), chunk_size):
+            rows = rows_all[start:start + chunk_size]
+            cols = cols_all[start:start + chunk_size]
+
+            row_start = max(int(rows[0]) - max_offset, 0)
+            row_stop = min(int(rows[-1]) + max_offset + 1, dataset.height)
+            strip = Window(window.col_off, row_start, window.width, row_stop - row_start)
+            bands = dataset.read(indexes=band_indexes, window=strip)
+
+            local_rows = rows - row_start
+            local_cols = cols - window.col_off
+            lons, lats = transform * (cols, rows)
+            index = pd.RangeIndex(start, start + len(rows))
+
+            yield {
+                grouping: _pixels_frame(
+                    date, lats, lons,
+                    windowed_median(bands, local_rows, local_cols, GROUPING_OFFSETS.get(grouping, 0)),
+                    band_columns, band_dtype, index=index, rows=rows, cols=cols
+                )
+                for grouping in groupings
+            }
 
 
 def create_processed_dfs(dfs_tifs):
@@ -145,20 +495,25 @@ def create_processed_dfs(dfs_tifs):
 
     dfs_tifs_all = {} 
 
+    # Columnas por nombre: identificación del píxel (con row/col si vienen de la extracción) y bandas
+    toa_bands = [name for name in band_names.values() if name.startswith("rtoa_")]
+    rhow_bands = [name for name in band_names.values() if name.startswith("rhow_")]
+
     for nombre_df, df in list(dfs_tifs.items()):
         # Rename de todas la columnas
         df = df.rename(columns=band_names)
+        pixel_columns = [c for c in PIXEL_COLUMNS if c in df.columns]
 
         # Para coger de solamente de C2RCC las bandas TOA, puesto que son iguales en C2X y Complex
         if "9x9" in nombre_df:
         #     #print(nombre_df)
             ventana = nombre_df.split("_")[3]
-            dfs_tifs_all[f"df_tifs_TOA_{ventana}"] = df.iloc[:,np.r_[0:16]]
+            dfs_tifs_all[f"df_tifs_TOA_{ventana}"] = df.loc[:, pixel_columns + [b for b in toa_bands if b in df.columns]]
 
 
         name_chunks = nombre_df.split("_")
         # El resto de columnas igual
-        dfs_tifs_all[f"{name_chunks[0]}_{name_chunks[1]}_{name_chunks[2]}_rhow_{name_chunks[3]}"] = df.iloc[:,np.r_[0:3, 16:24]]
+        dfs_tifs_all[f"{name_chunks[0]}_{name_chunks[1]}_{name_chunks[2]}_rhow_{name_chunks[3]}"] = df.loc[:, pixel_columns + [b for b in rhow_bands if b in df.columns]]
     
     return dfs_tifs_all
 
@@ -187,115 +542,237 @@ def suma_normalizada_3bandas(band1, band2, band3):
     value = (band1 + band3)/(band1 + band2)
     return value.round(3)
 
-def add_two_band_difs(data, bands):
+# Índices por tipo: (número de bandas, función, orden de las bandas del nombre como argumentos).
+# En sum_norm_3bands el nombre es {band1}_{band3}_{band2} para suma_normalizada_3bandas(band1, band2, band3)
+FEATURE_INDICES = {
+    "dif_norm_4_bands": (4, diferencia_normalizada_4bandas, (0, 1, 2, 3)),
+    "dif_rel_4bands": (4, diferencia_relacion_4bandas, (0, 1, 2, 3)),
+    "sum_norm_3bands": (3, suma_normalizada_3bandas, (0, 2, 1)),
+    "dall_gitelson": (3, dall_gitelson, (0, 1, 2)),
+    "dif_norm": (2, diferencia_normalizada, (0, 1)),
+    "dif_inv": (2, diferencia_inversas, (0, 1)),
+}
+
+# Conjuntos de bandas con los que se generan los índices
+BAND_SETS = [
+    ['rtoa_B2', 'rtoa_B3', 'rtoa_B4', 'rtoa_B5'],
+    ['rhow_B2', 'rhow_B3', 'rhow_B4', 'rhow_B5']
+]
+
+_FEATURE_NAME_RE = re.compile(
+    r"^(?P<index>" + "|".join(FEATURE_INDICES) + r")_(?P<prefix>rhow|rtoa)(?P<bands>(?:_B\d+A?)+)$"
+)
+
+
+def _index_name(index, bands):
+    """
+    Nombre compactado de un índice: 'dif_norm' + ['rhow_B2', 'rhow_B3'] -> 'dif_norm_rhow_B2_B3'.
+    """
+    prefix = bands[0].split("_")[0]
+    return f"{index}_{prefix}_{'_'.join(band.split('_')[1] for band in bands)}"
+
+
+@lru_cache(maxsize=None)
+def band_index_names(bands):
+    """
+    Nombres compactados de todos los índices que se generan para un conjunto (tupla) de 4 bandas,
+    en el mismo orden que el cálculo completo original.
+    """
+    names = []
+
+    # Diferencias normalizadas e inversas de dos bandas
     for i, band1 in enumerate(bands):
         for band2 in bands[i+1:]:
-            colname_dif_norm = f"dif_norm_{band1}_{band2}"
-            data[colname_dif_norm] = diferencia_normalizada(data[band1], data[band2])
-            #index_list.append(colname_dif_norm)
-            colname_dif_inv = f"dif_inv_{band1}_{band2}"
-            data[colname_dif_inv] = diferencia_inversas(data[band1], data[band2])
-            #index_list.append(colname_dif_inv)
-    return data
-
-def add_dall_gitelson(data, bands):
-    for band1, band2 in combinations(bands, 2):  # evita repeticiones de pares
+            names.append(_index_name("dif_norm", [band1, band2]))
+            names.append(_index_name("dif_inv", [band1, band2]))
+
+    # Dall-Gitelson: pares sin repetición y una tercera banda distinta
+    for band1, band2 in combinations(bands, 2):
         for band3 in bands:
-            if band3 not in (band1, band2):  # evitar que band3 sea igual a los anteriores
-                colname = f"dall_gitelson_{band1}_{band2}_{band3}"
-                data[colname] = dall_gitelson(data[band1], data[band2], data[band3])
-                #index_dall_gitelson_list.append(colname)
-    return data
-
-def add_norm_dif_4bands(data, bands):
-    for band1, band2 in combinations(bands, 2):  # evita invertir band1 y band2
-        for band3, band4 in combinations(bands, 2):  # evita invertir band3 y band4
-            # Asegurar que todas las bandas son distintas
+            if band3 not in (band1, band2):
+                names.append(_index_name("dall_gitelson", [band1, band2, band3]))
+
+    # Diferencia normalizada de 4 bandas, todas distintas y sin invertir los pares
+    for band1, band2 in combinations(bands, 2):
+        for band3, band4 in combinations(bands, 2):
             if len({band1, band2, band3, band4}) == 4:
-                colname = f"dif_norm_4_bands_{band1}_{band2}_{band3}_{band4}"
-                data[colname] = diferencia_normalizada_4bandas(
-                    data[band1], data[band2], data[band3], data[band4]
-                )
-                #index_dif_norm_4bands_list.append(colname)
-    return data
+                names.append(_index_name("dif_norm_4_bands", [band1, band2, band3, band4]))
 
-def add_index_dif_rel_4bands(data, bands):
+    # Diferencia de relaciones de 4 bandas, evitando la versión espejo con signo opuesto
     for band1, band2, band3, band4 in permutations(bands, 4):
-        # Evitar redundancias por simetría de términos
-        # Criterio: solo aceptamos combinaciones donde el primer término es "menor" que el segundo
-        if (band1, band2) < (band3, band4):  # evita generar la versión espejo con signo opuesto
-            colname = f"dif_rel_4bands_{band1}_{band2}_{band3}_{band4}"
-            data[colname] = diferencia_relacion_4bandas(
-                data[band1], data[band2], data[band3], data[band4]
-            )
-            #index_dif_rel_4bands_list.append(colname)
-    return data
-
-def add_index_sum_norm_3bands(data, bands):
+        if (band1, band2) < (band3, band4):
+            names.append(_index_name("dif_rel_4bands", [band1, band2, band3, band4]))
+
+    # Suma normalizada de 3 bandas
     band1, band2, band3, band4 = bands
+    names.append(_index_name("sum_norm_3bands", [band1, band3, band2]))
+    names.append(_index_name("sum_norm_3bands", [band2, band4, band3]))
 
-    colname = f"sum_norm_3bands_{band1}_{band3}_{band2}"
-    data[colname] = suma_normalizada_3bandas(data[band1], data[band2], data[band3])
+    return tuple(names)
 
-    colname = f"sum_norm_3bands_{band2}_{band4}_{band3}"
-    data[colname] = suma_normalizada_3bandas(data[band2], data[band3], data[band4])
-       
-    return data
 
+def parse_feature_name(colname):
+    """
+    Interpreta un nombre de columna compactado (p. ej. 'dall_gitelson_rhow_B2_B3_B4').
 
-def add_band_combinations(dfs_tifs_all):
-    band_sets = [
-        ['rtoa_B2', 'rtoa_B3', 'rtoa_B4', 'rtoa_B5'],
-        ['rhow_B2', 'rhow_B3', 'rhow_B4', 'rhow_B5']
-    ]
+    Returns:
+        (tipo de índice, [columnas de bandas]) p. ej. ('dall_gitelson', ['rhow_B2', 'rhow_B3', 'rhow_B4']),
+        o None si no es un índice de bandas
+    """
+    match = _FEATURE_NAME_RE.match(colname)
+    if not match:
+        return None
+
+    index = match.group("index")
+    bands = [f"{match.group('prefix')}_{band}" for band in match.group("bands").lstrip("_").split("_")]
+    if len(bands) != FEATURE_INDICES[index][0]:
+        return None
+    return index, bands
 
+
+def compute_band_indices(df, feature_names, dtype=np.float32):
+    """
+    Calcula los índices de bandas de 'feature_names' como un único bloque 2-D.
+
+    Las bandas se pasan a una matriz (n_pixeles, n_bandas) y cada tipo de índice se evalúa de una vez
+    para todas sus combinaciones indexando con arrays de posiciones de bandas. Los nombres que no son
+    índices, que ya están en df o cuyas bandas no están en df se ignoran.
+
+    Returns:
+        pd.DataFrame (mismo índice que df) con una columna por índice, de tipo 'dtype'
+    """
+    parsed = {}
+    for colname in feature_names:
+        if colname in df.columns or colname in parsed:
+            continue
+        index_bands = parse_feature_name(colname)
+        if index_bands is not None and set(index_bands[1]).issubset(df.columns):
+            parsed[colname] = index_bands
+
+    names = list(parsed)
+    if not names:
+        return pd.DataFrame(index=df.index)
+
+    band_cols = sorted({band for _, bands in parsed.values() for band in bands})
+    band_pos = {band: i for i, band in enumerate(band_cols)}
+    values = df[band_cols].to_numpy(dtype=np.float64)
+
+    # Posiciones de columna y de bandas agrupadas por tipo de índice
+    by_index = {}
+    for j, name in enumerate(names):
+        index, bands = parsed[name]
+        by_index.setdefault(index, ([], []))
+        by_index[index][0].append(j)
+        by_index[index][1].append([band_pos[band] for band in bands])
+
+    out = np.empty((len(df), len(names)), dtype=dtype)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for index, (cols, band_idx) in by_index.items():
+            _, func, order = FEATURE_INDICES[index]
+            band_idx = np.asarray(band_idx)
+            # Cada argumento es un bloque (n_pixeles, n_combinaciones)
+            out[:, cols] = func(*[values[:, band_idx[:, i]] for i in order])
+
+    return pd.DataFrame(out, columns=names, index=df.index)
+
+
+def add_selected_features(df, feature_names, dtype=np.float32):
+    """
+    Añade a df solo los índices de bandas de 'feature_names' que se pueden obtener con sus columnas.
+    Las columnas se crean ya con el nombre compactado y se unen al DataFrame de una vez.
+    """
+    indices = compute_band_indices(df, feature_names, dtype=dtype)
+    if not len(indices.columns):
+        return df
+    return pd.concat([df, indices], axis=1)
+
+
+def add_band_combinations(dfs_tifs_all, features=None):
+    """
+    Añade los índices de bandas a cada DataFrame.
+
+    Args:
+        dfs_tifs_all: dict {nombre: DataFrame}
+        features: nombres (compactados) de las variables que van a usar los modelos, p. ej. de
+            required_features(). Si se indica, solo se calculan esos índices; si no, todos.
+    """
     dfs = dfs_tifs_all.copy()
     for nombre_df, df in dfs.items():
-        for bands_to_use in band_sets:
-            if set(bands_to_use).issubset(df.columns):
-                df = add_two_band_difs(df, bands_to_use)
-                df = add_dall_gitelson(df, bands_to_use)
-                df = add_norm_dif_4bands(df, bands_to_use)
-                df = add_index_dif_rel_4bands(df, bands_to_use)
-                df = add_index_sum_norm_3bands(df, bands_to_use)
-                
-        dfs[nombre_df] = df 
-    
+        if features is not None:
+            names = features
+        else:
+            names = [name for bands_to_use in BAND_SETS if set(bands_to_use).issubset(df.columns)
+                     for name in band_index_names(tuple(bands_to_use))]
+        dfs[nombre_df] = add_selected_features(df, names)
+
     return dfs
 
 
+@lru_cache(maxsize=None)
+def _compactar_nombre(col):
+    """
+    Nombre compactado de una columna (index_algo_rhow_B1_rhow_B2 -> index_algo_rhow_B1_B2),
+    o la propia columna si no sigue ese patrón.
+    """
+    # Detectar columnas con patrones tipo index_algo_rhow_B1_rhow_B2_...
+    if not re.search(r'(rhow|rhown|rtoa)(_B\d+)+', col):
+        return col
+
+    partes = col.split('_')
+    base = []
+    bandas = []
+    prefijo = None
+
+    for parte in partes:
+        if parte in ['rhow','rtoa']:
+            if not prefijo:
+                prefijo = parte
+        elif parte.startswith('B'):
+            bandas.append(parte)
+        else:
+            base.append(parte)
+
+    if not (prefijo and bandas):
+        return col
+
+    if base:
+        return f"{'_'.join(base)}_{prefijo}_{'_'.join(bandas)}"
+    return f"{prefijo}_{'_'.join(bandas)}"
+
+
+@lru_cache(maxsize=None)
+def tabla_nombres_compactados():
+    """
+    Tabla {nombre largo: nombre compactado} de todos los índices de BAND_SETS, generada una sola vez
+    a partir de las definiciones de los conjuntos de bandas.
+    """
+    tabla = {}
+    for bands in BAND_SETS:
+        for name in band_index_names(tuple(bands)):
+            index, index_bands = parse_feature_name(name)
+            tabla[f"{index}_{'_'.join(index_bands)}"] = name
+    return tabla
+
+
 def compactar_prefijos_columnas(df):
-    nuevo_nombre_columnas = {}
+    """
+    Compacta los nombres de columna tipo index_algo_rhow_B1_rhow_B2 -> index_algo_rhow_B1_B2.
 
+    add_band_combinations ya genera los índices con el nombre compactado, así que solo hace falta para
+    DataFrames con nombres largos; si no hay nada que renombrar, se devuelve df sin copiarlo.
+    """
+    tabla = tabla_nombres_compactados()
+    nuevo_nombre_columnas = {}
     for col in df.columns:
-        # Detectar columnas con patrones tipo index_algo_rhow_B1_rhow_B2_...
-        if re.search(r'(rhow|rhown|rtoa)(_B\d+)+', col):
-            partes = col.split('_')
-            base = []
-            bandas = []
-            prefijo = None
-
-            for parte in partes:
-                if parte in ['rhow','rtoa']:
-                    if not prefijo:
-                        prefijo = parte
-                elif parte.startswith('B'):
-                    bandas.append(parte)
-                else:
-                    base.append(parte)
-
-            if prefijo and bandas:
-                #nuevo_nombre = f"{'_'.join(base)}_{prefijo}_{'_'.join(bandas)}"
-                if base:
-                    nuevo_nombre = f"{'_'.join(base)}_{prefijo}_{'_'.join(bandas)}"
-                else:
-                    nuevo_nombre = f"{prefijo}_{'_'.join(bandas)}"
-
-                nuevo_nombre_columnas[col] = nuevo_nombre
+        nuevo_nombre = tabla.get(col) or _compactar_nombre(col)
+        if nuevo_nombre != col:
+            nuevo_nombre_columnas[col] = nuevo_nombre
+
+    if not nuevo_nombre_columnas:
+        return df
 
     # Renombrar columnas
-    df = df.rename(columns=nuevo_nombre_columnas)
-    return df
+    return df.rename(columns=nuevo_nombre_columnas)
 
 def add_season(dfs):
 
@@ -333,16 +810,278 @@ def add_season(dfs):
     return dfs
 
 
-# Cargadores específicos 
-try:
-    from xgboost import XGBRegressor
-except Exception:
-    XGBRegressor = None
+# Ficheros intermedios entre etapas (df_tifs_* y {date}_pred): Parquet, un .npy por columna o csv
+INTERMEDIATE_FORMATS = {"parquet": ".parquet", "npy": "_npy", "csv": ".csv"}
+
+# Columnas que se guardan en float64 (coordenadas UTM); el resto de columnas float64 pasa a float32
+COORD_COLUMNS = ("Latitude", "Longitude")
+
+
+def table_path(base: str, fmt: str) -> str:
+    """
+    Ruta de una tabla intermedia sin extensión ('.../2022-07-14_pred') en el formato indicado.
+    El formato npy es un directorio con un <columna>.npy por columna y columns.json con el orden.
+    """
+    if fmt not in INTERMEDIATE_FORMATS:
+        raise ValueError(f"Formato intermedio no reconocido: {fmt} (opciones: {', '.join(INTERMEDIATE_FORMATS)})")
+    return f"{base}{INTERMEDIATE_FORMATS[fmt]}"
+
+
+def find_table(base: str, fmt: Optional[str] = None):
+    """
+    (ruta, formato) de la tabla 'base' que exista en disco, probando parquet, npy y csv si no se indica
+    el formato; None si no hay ninguna.
+    """
+    for candidate in ([fmt] if fmt else list(INTERMEDIATE_FORMATS)):
+        path = table_path(base, candidate)
+        if os.path.exists(path):
+            return path, candidate
+    return None
+
+
+def _typed_frame(df: pd.DataFrame) -> pd.DataFrame:
+    float64_columns = [c for c in df.columns if df[c].dtype == np.float64 and c not in COORD_COLUMNS]
+    if float64_columns:
+        df = df.astype({c: np.float32 for c in float64_columns})
+    return df
+
+
+def _replace_path(tmp_path: str, path: str):
+    # os.replace no sustituye un directorio que ya existe (formato npy)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+class TableWriter:
+    """
+    Escribe una tabla intermedia por bloques (append) y la publica al cerrar con un os.replace, de modo
+    que nunca queda a medias con el nombre final. En parquet y npy las columnas float64 se guardan en
+    float32 salvo las coordenadas; el csv se escribe tal cual, como antes.
+    """
+
+    def __init__(self, base: str, fmt: str = "parquet"):
+        self.fmt = fmt
+        self.path = table_path(base, fmt)
+        self.tmp_path = f"{self.path}.part"
+        self.n_rows = 0
+        self._columns = None
+        self._parquet_writer = None
+        self._raw_files = {}
+
+    def append(self, df: pd.DataFrame):
+        if self.fmt == "csv":
+            df.to_csv(self.tmp_path, mode="a" if self._columns is not None else "w",
+                      header=self._columns is None, index=False)
+        elif self.fmt == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(_typed_frame(df), preserve_index=False)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.tmp_path, table.schema)
+            self._parquet_writer.write_table(table.cast(self._parquet_writer.schema))
+        else:
+            # npy: cada columna se va añadiendo en binario y al cerrar se convierte en .npy
+            df = _typed_frame(df)
+            if self._columns is None:
+                os.makedirs(self.tmp_path, exist_ok=True)
+                self._dtypes = {c: self._npy_dtype(df[c]) for c in df.columns}
+            for column in df.columns:
+                values = np.ascontiguousarray(df[column].to_numpy(dtype=self._dtypes[column]))
+                if column not in self._raw_files:
+                    self._raw_files[column] = open(os.path.join(self.tmp_path, f"{column}.raw"), "wb")
+                values.tofile(self._raw_files[column])
+
+        if self._columns is None:
+            self._columns = list(df.columns)
+        self.n_rows += len(df)
+
+    @staticmethod
+    def _npy_dtype(series: pd.Series):
+        if pd.api.types.is_datetime64_any_dtype(series):
+            return np.dtype("datetime64[ns]")
+        if series.dtype == object:
+            width = int(series.astype(str).str.len().max()) if len(series) else 1
+            return np.dtype(f"U{max(1, width)}")
+        return series.dtype
+
+    def close(self, columns=None) -> str:
+        """
+        Publica la tabla. Si no se ha escrito ningún bloque se guarda una tabla vacía con 'columns'.
+        """
+        if self._columns is None:
+            self.append(pd.DataFrame(columns=list(columns or [])))
+
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+        if self.fmt == "npy":
+            for column, raw in self._raw_files.items():
+                raw.close()
+                raw_path = raw.name
+                data = np.fromfile(raw_path, dtype=self._dtypes[column])
+                np.save(os.path.join(self.tmp_path, f"{column}.npy"), data)
+                os.remove(raw_path)
+            with open(os.path.join(self.tmp_path, "columns.json"), "w", encoding="utf-8") as f:
+                json.dump(self._columns, f)
+
+        _replace_path(self.tmp_path, self.path)
+        return self.path
+
+
+def write_table(df: pd.DataFrame, base: str, fmt: str = "parquet") -> str:
+    """
+    Guarda df como tabla intermedia 'base' en el formato indicado. Returns: ruta escrita.
+    """
+    writer = TableWriter(base, fmt)
+    writer.append(df)
+    return writer.close(columns=df.columns)
+
+
+def load_columns(base: str, fmt: Optional[str] = None, columns=None, mmap: bool = False) -> dict:
+    """
+    Columnas de una tabla intermedia como arrays de NumPy, sin pasar por un DataFrame. En formato npy
+    con mmap=True los arrays se mapean en memoria y no se leen hasta usarlos.
+    """
+    found = find_table(base, fmt)
+    if found is None:
+        raise FileNotFoundError(f"No existe la tabla {base} ({fmt or ', '.join(INTERMEDIATE_FORMATS)})")
+    path, fmt = found
+
+    if fmt == "npy":
+        with open(os.path.join(path, "columns.json"), "r", encoding="utf-8") as f:
+            all_columns = json.load(f)
+        return {c: np.load(os.path.join(path, f"{c}.npy"), mmap_mode="r" if mmap else None)
+                for c in (columns or all_columns)}
+
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        table = pq.read_table(path, columns=columns, memory_map=mmap)
+        return {c: table.column(c).to_numpy() for c in table.column_names}
+
+    df = pd.read_csv(path, usecols=columns)
+    return {c: df[c].to_numpy() for c in df.columns}
+
+
+def read_table(base: str, fmt: Optional[str] = None, columns=None, mmap: bool = False) -> pd.DataFrame:
+    """
+    Tabla intermedia como DataFrame (ver load_columns).
+    """
+    found = find_table(base, fmt)
+    if found is not None and found[1] == "parquet":
+        return pd.read_parquet(found[0], columns=columns, memory_map=mmap)
+    return pd.DataFrame(load_columns(base, fmt, columns=columns, mmap=mmap), copy=False)
+
+
+# Etiquetas de la leyenda de Chl (mg/m³) de los mapas
+CHL_LABELS = ["0.3", "0.4", "0.5", "0.6", "0.7", "0.8", "0.9", "1.0", "1.2", "1.4", "1.6", "1.8", "2.0", "2.4", "2.8", "3.2", "3.6", "4.0", "4.5", "5.0", "6.0", "8.0", "10.0", "12.0", "15.0", "18.0", "24.0", "30.0"]
+
+
+def read_qgis_colormap(colormap_path):
+    """
+    Lee el colormap discreto exportado por QGIS (valor,r,g,b,a,etiqueta por línea), sin matplotlib.
+
+    Returns:
+        (boundaries, colors) con colors = lista de (r, g, b, a) en 0-255
+    """
+    colors = []
+    boundaries = []
+
+    with open(colormap_path, "r") as f:
+        for line in f:
+            if line.startswith("#") or "INTERPOLATION" in line:
+                continue
+            parts = line.strip().split(",")
+            if len(parts) < 6:
+                continue
+            boundaries.append(float(parts[0]))
+            colors.append(tuple(int(p) for p in parts[1:5]))
+    return boundaries, colors
+
+
+def load_qgis_colormap(colormap_path):
+    """
+    Colormap discreto de QGIS para matplotlib (ver read_qgis_colormap).
+
+    Returns:
+        (ListedColormap, BoundaryNorm, boundaries)
+    """
+    from matplotlib.colors import ListedColormap, BoundaryNorm
+
+    boundaries, rgba = read_qgis_colormap(colormap_path)
+    colors = [(r / 255, g / 255, b / 255, a / 255) for r, g, b, a in rgba]
+
+    cmap = ListedColormap(colors)
+    norm = BoundaryNorm(boundaries, ncolors=len(colors))
+    return cmap, norm, boundaries
+
+
+# Mapas de Chl por fecha: un TIFF por profundidad ({date}_chl_map_{depth}.tif) y/o un COG con las
+# profundidades como bandas ({date}_chl_map.tif), ver Aplicacion_TIFFfromCSV.py --map-format
+MAP_FORMATS = ("tiff", "cog", "both")
+
+# Renderizado de los png y el GIF: "lut" (Aplicacion_Render.py, paleta + np.digitize, sin matplotlib) o
+# "matplotlib" (una figura por mapa)
+MAP_RENDERERS = ("lut", "matplotlib")
+
+
+def chl_map_paths(map_dir: str, date: str, depths):
+    """
+    Returns:
+        (ruta del COG, dict {depth: ruta del TIFF de esa profundidad})
+    """
+    return f"{map_dir}{date}_chl_map.tif", {depth: f"{map_dir}{date}_chl_map_{depth}.tif" for depth in depths}
+
+
+def available_map_dates(map_dir: str, start: Optional[str] = None, end: Optional[str] = None):
+    """
+    Fechas (YYYY-MM-DD, ordenadas) con mapas de Chl (COG o TIFFs por profundidad) en map_dir, opcionalmente
+    entre start y end (incluidas).
+    """
+    dates = set()
+    for f in os.listdir(map_dir):
+        match = re.match(r"(\d{4}-\d{2}-\d{2})_chl_map(_\d+_\d+)?\.tif$", f)
+        if match:
+            dates.add(match.group(1))
+    return [d for d in sorted(dates) if (start is None or d >= start) and (end is None or d <= end)]
+
+
+def cog_map_path(map_dir: str, date: str, depths):
+    """
+    Ruta del COG de la fecha si es el que hay que leer (existe y no es más antiguo que los TIFFs por
+    profundidad); None si hay que leer los TIFFs.
+    """
+    cog_path, tiff_paths = chl_map_paths(map_dir, date, depths)
+    tiffs_mtime = [os.path.getmtime(p) for p in tiff_paths.values() if os.path.exists(p)]
+    if os.path.exists(cog_path) and (not tiffs_mtime or os.path.getmtime(cog_path) >= max(tiffs_mtime)):
+        return cog_path
+    return None
+
+
+def read_chl_maps(map_dir: str, date: str, depths, overview_level: Optional[int] = None) -> dict:
+    """
+    Lee los mapas de Chl de una fecha. Si existe el COG y no es más antiguo que los TIFFs por profundidad
+    se lee una banda por profundidad (por su descripción Chl_pred_{depth}); si no, los TIFFs sueltos.
+
+    Args:
+        overview_level: nivel de overview interno del COG a leer (None: resolución completa; los TIFFs
+            por profundidad no tienen overviews)
+
+    Returns:
+        dict {depth: (np.ndarray (filas, columnas), transform)}
+    """
+    cog_path = cog_map_path(map_dir, date, depths)
+    if cog_path is not None:
+        with rasterio.open(cog_path, overview_level=overview_level) as src:
+            band_of = {desc: i + 1 for i, desc in enumerate(src.descriptions) if desc}
+            indexes = [band_of.get(f"Chl_pred_{depth}", k + 1) for k, depth in enumerate(depths)]
+            data = src.read(indexes)
+            return {depth: (data[k], src.transform) for k, depth in enumerate(depths)}
 
-try:
-    from catboost import CatBoostRegressor
-except Exception:
-    CatBoostRegressor = None
+    maps = {}
+    for depth, path in chl_map_paths(map_dir, date, depths)[1].items():
+        with rasterio.open(path) as src:
+            maps[depth] = (src.read(1), src.transform)
+    return maps
 
 
 def _stem_and_keys(fname: str):
@@ -355,6 +1094,7 @@ def _stem_and_keys(fname: str):
             .replace("_model.joblib", "")
             .replace("_model.json", "")
             .replace("_model.cbm", "")
+            .replace("_forest.npz", "")
             .replace("_features.json", "")
             .replace("_metadata.json", ""))
     # dataset = todo menos el último bloque; model = último bloque
@@ -368,10 +1108,11 @@ def discover_artifacts(models_dir: str):
     """
     Explora la carpeta y devuelve un dict:
     artifacts[dataset][model] = {'model_path': ..., 'features_path': ..., 'metadata_path': ..., 'format': ...}
+    (más 'forest_path' si existe el bosque compilado *_forest.npz, ver Aplicacion_Forest.py)
     """
     artifacts = {}
     for fname in os.listdir(models_dir):
-        if not any(fname.endswith(suf) for suf in ["_model.joblib", "_model.json", "_model.cbm",
+        if not any(fname.endswith(suf) for suf in ["_model.joblib", "_model.json", "_model.cbm", "_forest.npz",
                                                    "_features.json", "_metadata.json"]):
             continue
 
@@ -389,6 +1130,8 @@ def discover_artifacts(models_dir: str):
         elif fname.endswith("_model.cbm"):
             entry["model_path_cbm"] = fpath
             entry["format"] = "cbm"
+        elif fname.endswith("_forest.npz"):
+            entry["forest_path"] = fpath
         elif fname.endswith("_features.json"):
             entry["features_path"] = fpath
         elif fname.endswith("_metadata.json"):
@@ -416,12 +1159,29 @@ def load_features_list(features_path: str):
         raise ValueError(f"Formato de features no soportado en {features_path}")
 
 
+def required_features(models_dir: str, selection: dict):
+    """
+    Unión de las variables que necesitan los modelos de 'selection' ({dataset: modelo}),
+    leída de sus *_features.json.
+    """
+    registry = get_registry(models_dir)
+    features = []
+    for dataset, model_name in selection.items():
+        for feature in registry.get_features(dataset, model_name):
+            if feature not in features:
+                features.append(feature)
+    return features
+
+
 def load_model_for_entry(dataset: str, model_name: str, entry: dict):
     """
     Carga el modelo según el formato disponible en 'entry'.
     - Preferencia: joblib (suele incluir Pipeline)
     - XGBoost JSON: crea un XGBRegressor y load_model(json_path)
     - CatBoost CBM: CatBoostRegressor().load_model(cbm_path)
+
+    xgboost y catboost se importan solo al cargar un modelo de esa librería, para que la inferencia con
+    bosques compilados (*_forest.npz) no tenga que importarlas.
     """
     # 1) Joblib (scikit-learn / pipeline)
     if "model_path" in entry and entry.get("format") == "joblib":
@@ -429,7 +1189,9 @@ def load_model_for_entry(dataset: str, model_name: str, entry: dict):
 
     # 2) XGBoost JSON
     if entry.get("format") == "json" and "model_path_json" in entry:
-        if XGBRegressor is None:
+        try:
+            from xgboost import XGBRegressor
+        except Exception:
             raise ImportError("xgboost no está disponible en el entorno.")
         model = XGBRegressor()
         model.load_model(entry["model_path_json"])
@@ -437,7 +1199,9 @@ def load_model_for_entry(dataset: str, model_name: str, entry: dict):
 
     # 3) CatBoost CBM
     if entry.get("format") == "cbm" and "model_path_cbm" in entry:
-        if CatBoostRegressor is None:
+        try:
+            from catboost import CatBoostRegressor
+        except Exception:
             raise ImportError("catboost no está disponible en el entorno.")
         model = CatBoostRegressor(verbose=False)
         model.load_model(entry["model_path_cbm"])
@@ -447,13 +1211,288 @@ def load_model_for_entry(dataset: str, model_name: str, entry: dict):
 
 
 
+class CompiledForest:
+    """
+    Ensemble de árboles (XGBoost, CatBoost o scikit-learn) exportado a arrays de nodos por
+    Aplicacion_Forest.py y evaluado solo con NumPy.
+
+    Todos los árboles comparten los arrays de nodos: feature, threshold, left, right, value y default_left
+    (rama de los NaN); roots es el nodo raíz de cada árbol. Las hojas apuntan a sí mismas, así que basta
+    con avanzar max_depth niveles. La predicción es base_score + scale * suma de las hojas.
+    strict_less indica la comparación que va a la izquierda: x < threshold (XGBoost) o x <= threshold.
+    """
+
+    FIELDS = ("feature", "threshold", "left", "right", "value", "default_left", "roots")
+
+    def __init__(self, feature, threshold, left, right, value, default_left, roots, base_score=0.0, scale=1.0,
+                 strict_less=False, max_depth=None, n_features=None, source=""):
+        self.feature = np.asarray(feature, dtype=np.int32)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.left = np.asarray(left, dtype=np.int32)
+        self.right = np.asarray(right, dtype=np.int32)
+        self.value = np.asarray(value, dtype=np.float64)
+        self.default_left = np.asarray(default_left, dtype=bool)
+        self.roots = np.asarray(roots, dtype=np.int32)
+        self.base_score = float(base_score)
+        self.scale = float(scale)
+        self.strict_less = bool(strict_less)
+        self.max_depth = int(max_depth) if max_depth is not None else self._depth()
+        self.n_features = int(n_features) if n_features is not None else int(self.feature.max()) + 1
+        self.source = str(source)
+
+    def _depth(self):
+        node = self.roots.copy()
+        for depth in range(len(self.feature)):
+            child = self.left[node]
+            if np.array_equal(child, node):
+                return depth
+            node = child
+        return len(self.feature)
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    def predict(self, X, chunk_size: Optional[int] = None):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(f"Se esperaban {self.n_features} columnas y la matriz tiene forma {X.shape}")
+
+        # Cada bloque recorre (filas x árboles) nodos a la vez; se limita a unos 4M nodos por bloque
+        chunk_size = chunk_size or max(1, (1 << 22) // max(self.n_trees, 1))
+        # hijo del nodo n: children[2 * n + va_a_la_izquierda]
+        children = np.stack([self.right, self.left], axis=1).ravel().astype(np.intp)
+        y_hat = np.empty(len(X), dtype=np.float64)
+        for start in range(0, len(X), chunk_size):
+            Xc = X[start:start + chunk_size]
+            flat = Xc.ravel()
+            row_offset = (np.arange(len(Xc), dtype=np.intp) * self.n_features)[:, None]
+            node = np.tile(self.roots.astype(np.intp), (len(Xc), 1))
+            for _ in range(self.max_depth):
+                x = flat[row_offset + self.feature[node]]
+                threshold = self.threshold[node]
+                go_left = x < threshold if self.strict_less else x <= threshold
+                missing = np.isnan(x)
+                if missing.any():
+                    go_left = np.where(missing, self.default_left[node], go_left)
+                node = children[2 * node + go_left]
+            y_hat[start:start + len(Xc)] = self.value[node].sum(axis=1)
+        return self.base_score + self.scale * y_hat
+
+    def to_arrays(self) -> dict:
+        arrays = {name: getattr(self, name) for name in self.FIELDS}
+        arrays.update(base_score=self.base_score, scale=self.scale, strict_less=self.strict_less,
+                      max_depth=self.max_depth, n_features=self.n_features, source=self.source)
+        return arrays
+
+
+def load_forest(forest_path: str) -> CompiledForest:
+    """
+    Carga un *_forest.npz generado por Aplicacion_Forest.py.
+    """
+    with np.load(forest_path) as data:
+        kwargs = {name: data[name] for name in CompiledForest.FIELDS}
+        for name in ("base_score", "scale", "strict_less", "max_depth", "n_features", "source"):
+            if name in data:
+                kwargs[name] = data[name].item()
+    return CompiledForest(**kwargs)
+
+
+_MODEL_FILE_KEYS = ("model_path", "model_path_json", "model_path_cbm")
+
+
+def _file_signature(path):
+    """
+    Firma barata de un fichero para detectar cambios: (mtime en ns, tamaño).
+    """
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+class ModelRegistry:
+    """
+    Registro en memoria de los modelos de un directorio de artefactos.
+
+    El directorio se explora una sola vez; cada modelo y su lista de features se cargan la primera vez
+    que se piden y se mantienen en memoria durante la vida del proceso. Si el fichero cambia
+    (mtime o tamaño distintos) la entrada se invalida y se vuelve a cargar.
+
+    Con use_forest=True se usa el bosque compilado (*_forest.npz) de los modelos que lo tengan, siempre
+    que no sea más antiguo que el modelo original; así no hace falta importar xgboost, catboost ni sklearn.
+    """
+
+    def __init__(self, models_dir: str, use_forest: bool = False):
+        self.models_dir = models_dir
+        self.use_forest = use_forest
+        self.artifacts = discover_artifacts(models_dir)
+        self._models = {}
+        self._features = {}
+        # Bosques compilados más antiguos que su modelo de los que ya se ha avisado
+        self._stale_forests = set()
+
+    def refresh(self):
+        """Vuelve a explorar el directorio (p. ej. si se han añadido o borrado artefactos)."""
+        self.artifacts = discover_artifacts(self.models_dir)
+
+    def entry(self, dataset_name: str, model_name: str) -> dict:
+        if model_name not in self.artifacts.get(dataset_name, {}):
+            self.refresh()
+        if model_name not in self.artifacts.get(dataset_name, {}):
+            raise ValueError(f"No se encontró {dataset_name}/{model_name} en {self.models_dir}")
+        return self.artifacts[dataset_name][model_name]
+
+    def _model_signature(self, entry: dict):
+        """
+        (firma, usar el bosque compilado): la firma incluye el bosque solo si se usa, es decir, con
+        use_forest y si no es más antiguo que el modelo. Del bosque desactualizado se avisa una vez.
+        """
+        signature = [_file_signature(entry[k]) for k in _MODEL_FILE_KEYS if k in entry]
+        if not self.use_forest or "forest_path" not in entry:
+            return tuple(signature), False
+
+        forest_path = entry["forest_path"]
+        forest_signature = _file_signature(forest_path)
+        if any(model_signature[0] > forest_signature[0] for model_signature in signature):
+            if forest_path not in self._stale_forests:
+                self._stale_forests.add(forest_path)
+                print(f"[AVISO] {forest_path} es anterior al modelo; se usa el modelo original")
+            return tuple(signature), False
+        self._stale_forests.discard(forest_path)
+        return tuple(signature + [forest_signature]), True
+
+    def get_model(self, dataset_name: str, model_name: str):
+        key = (dataset_name, model_name)
+        entry = self.entry(dataset_name, model_name)
+        try:
+            signature, use_forest = self._model_signature(entry)
+        except FileNotFoundError:
+            # El fichero ha desaparecido o cambiado de nombre: se vuelve a explorar el directorio
+            self.refresh()
+            entry = self.entry(dataset_name, model_name)
+            signature, use_forest = self._model_signature(entry)
+
+        cached = self._models.get(key)
+        if cached is None or cached[0] != signature:
+            if use_forest:
+                print(f"Cargando bosque compilado {model_name} para {dataset_name}")
+                model = load_forest(entry["forest_path"])
+            else:
+                print(f"Cargando modelo {model_name} para {dataset_name}")
+                model = load_model_for_entry(dataset_name, model_name, entry)
+            self._models[key] = (signature, model)
+        return self._models[key][1]
+
+    def get_features(self, dataset_name: str, model_name: str):
+        key = (dataset_name, model_name)
+        entry = self.entry(dataset_name, model_name)
+
+        if "features_path" not in entry:
+            model = self.get_model(dataset_name, model_name)
+            if hasattr(model, "feature_names_in_"):
+                return list(model.feature_names_in_)
+            raise ValueError(f"No se pueden determinar las columnas requeridas para {dataset_name}/{model_name}")
+
+        signature = _file_signature(entry["features_path"])
+        cached = self._features.get(key)
+        if cached is None or cached[0] != signature:
+            self._features[key] = (signature, load_features_list(entry["features_path"]))
+        return self._features[key][1]
+
+
+# Un registro por directorio de modelos, compartido por todo el proceso
+_REGISTRIES = {}
+
+
+def get_registry(models_dir: str, use_forest: Optional[bool] = None) -> ModelRegistry:
+    """
+    Devuelve el ModelRegistry del proceso para models_dir, creándolo la primera vez.
+    Si se indica use_forest se fija en el registro (ver ModelRegistry).
+    """
+    key = os.path.abspath(models_dir)
+    if key not in _REGISTRIES:
+        _REGISTRIES[key] = ModelRegistry(models_dir)
+    if use_forest is not None:
+        _REGISTRIES[key].use_forest = use_forest
+    return _REGISTRIES[key]
+
+
+def set_model_threads(model, n_threads: int):
+    """
+    Limita los hilos que usa el modelo al predecir (n_jobs en XGBoost y scikit-learn, incluidos los pasos
+    de un Pipeline). CatBoost recibe thread_count directamente en predict (ver predict_with_model).
+    """
+    if not hasattr(model, "get_params") or type(model).__name__.startswith("CatBoost"):
+        return
+    params = {k: n_threads for k in model.get_params() if k == "n_jobs" or k.endswith("__n_jobs")}
+    if params:
+        model.set_params(**params)
+
+
+def build_feature_matrix(df: pd.DataFrame, features, cache: Optional[dict] = None):
+    """
+    Matriz float32 contigua con las columnas de 'features' en ese orden.
+
+    Si se pasa 'cache', la matriz se guarda por (DataFrame, lista de features) y se reutiliza cuando otro
+    modelo usa el mismo DataFrame con la misma lista.
+
+    Returns:
+        np.ndarray (n_filas, n_features), o None si falta alguna columna o no es numérica
+    """
+    key = (id(df), tuple(features))
+    if cache is not None and key in cache:
+        return cache[key]
+
+    try:
+        X = np.ascontiguousarray(df[list(features)].to_numpy(dtype=np.float32))
+    except (TypeError, ValueError, KeyError):
+        X = None
+
+    if cache is not None:
+        cache[key] = X
+    return X
+
+
+def predict_array(model, X, n_threads: Optional[int] = None):
+    """
+    Predicción sobre una matriz NumPy usando la vía nativa de cada librería:
+    inplace_predict del booster en XGBoost, Pool sobre el array en CatBoost y ndarray en scikit-learn.
+    """
+    name = type(model).__name__
+
+    if name.startswith("XGB"):
+        if n_threads is not None:
+            set_model_threads(model, n_threads)
+        iteration_range = (0, 0)
+        try:
+            iteration_range = (0, model.best_iteration + 1)
+        except AttributeError:
+            pass
+        return model.get_booster().inplace_predict(X, iteration_range=iteration_range)
+
+    if name.startswith("CatBoost"):
+        from catboost import Pool
+        kwargs = {"thread_count": n_threads} if n_threads is not None else {}
+        return model.predict(Pool(X), **kwargs)
+
+    if n_threads is not None:
+        set_model_threads(model, n_threads)
+    # Los modelos de scikit-learn entrenados con DataFrame avisan al predecir sobre arrays; aquí el orden de
+    # columnas ya está garantizado por la lista de features
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="X does not have valid feature names", category=UserWarning)
+        return model.predict(X)
+
+
 def predict_with_model(
     df: pd.DataFrame,
     models_dir: str,
     dataset_name: str,
     model_name: str,
     clip_min: Optional[float] = None,
-    strict: bool = False
+    strict: bool = False,
+    registry: Optional[ModelRegistry] = None,
+    n_threads: Optional[int] = None,
+    matrix_cache: Optional[dict] = None
     ) -> pd.Series:
     """
     Aplica el modelo indicado a un DataFrame, usando los artefactos guardados en models_dir.
@@ -465,29 +1504,23 @@ def predict_with_model(
         model_name: Nombre del modelo ('XGB', 'CAT', etc.).
         clip_min: Valor mínimo a aplicar con np.clip() (p. ej. 0.3).
         strict: Si True, lanza error si faltan columnas. Si False, las ignora con aviso.
+        registry: ModelRegistry a usar; por defecto el del proceso para models_dir.
+        n_threads: Hilos que puede usar el modelo al predecir (por defecto los de la librería).
+        matrix_cache: dict compartido entre modelos para reutilizar la matriz de features (ver build_feature_matrix).
 
     Returns:
         pd.Series con las predicciones (misma longitud que df).
     """
-    artifacts = discover_artifacts(models_dir)
-
-    if dataset_name not in artifacts or model_name not in artifacts[dataset_name]:
-        raise ValueError(f"No se encontró {dataset_name}/{model_name} en {models_dir}")
-
-    entry = artifacts[dataset_name][model_name]
+    registry = registry or get_registry(models_dir)
 
     print(f"Inference with {model_name} for {dataset_name}")
 
-    # cargar modelo
-    model = load_model_for_entry(dataset_name, model_name, entry)
+    # modelo y features desde el registro (se cargan una vez por proceso)
+    model = registry.get_model(dataset_name, model_name)
+    features = registry.get_features(dataset_name, model_name)
 
-    # cargar features
-    if "features_path" in entry:
-        features = load_features_list(entry["features_path"])
-    elif hasattr(model, "feature_names_in_"):
-        features = list(model.feature_names_in_)
-    else:
-        raise ValueError(f"No se pueden determinar las columnas requeridas para {dataset_name}/{model_name}")
+    if len(df) == 0:
+        return pd.Series(np.empty(0), index=df.index, name=f"{dataset_name}__{model_name}")
 
     # verificar columnas
     missing = [c for c in features if c not in df.columns]
@@ -497,22 +1530,40 @@ def predict_with_model(
             raise KeyError(msg)
         print(f"[AVISO] {msg}")
 
-    # seleccionar features
-    X = df[features].copy()
-
-    # convertir objetos a numérico si aplica
-    for col in X.columns:
-        if pd.api.types.is_object_dtype(X[col]):
-            try:
-                X[col] = pd.to_numeric(X[col])
-            except Exception:
-                pass
+    # camino rápido: matriz float32 en el orden de features y predicción nativa sobre el array
+    y_hat = None
+    X = build_feature_matrix(df, features, cache=matrix_cache)
+    if X is not None:
+        try:
+            y_hat = predict_array(model, X, n_threads=n_threads)
+        except (TypeError, ValueError, KeyError) as e:
+            # p. ej. Pipelines que seleccionan columnas por nombre
+            print(f"[AVISO] {dataset_name}/{model_name}: no se puede predecir sobre array ({e}); se usa el DataFrame")
+
+    if y_hat is None:
+        # seleccionar features
+        X = df[features].copy()
+
+        # convertir objetos a numérico si aplica
+        for col in X.columns:
+            if pd.api.types.is_object_dtype(X[col]):
+                try:
+                    X[col] = pd.to_numeric(X[col])
+                except Exception:
+                    pass
+
+        # predecir
+        predict_kwargs = {}
+        if n_threads is not None:
+            if type(model).__name__.startswith("CatBoost"):
+                predict_kwargs["thread_count"] = n_threads
+            else:
+                set_model_threads(model, n_threads)
 
-    # predecir
-    try:
-        y_hat = model.predict(X)
-    except TypeError:
-        y_hat = model.predict(X.values)
+        try:
+            y_hat = model.predict(X, **predict_kwargs)
+        except TypeError:
+            y_hat = model.predict(X.values, **predict_kwargs)
 
     y_hat = np.asarray(y_hat).ravel()
     if clip_min is not None:
@@ -6,6 +6,11 @@ import subprocess
 import time
 from datetime import datetime, timedelta
 import sys
+import json
+import importlib
+import urllib.request
+import urllib.error
+import socket
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--date")
@@ -14,6 +19,7 @@ parser.add_argument("-sd", "--startdate")
 parser.add_argument("-ed", "--enddate")
 parser.add_argument("--cloudcover", default='100.00')
 parser.add_argument('-cd', '--configdates', action='store_true')
+parser.add_argument("--subprocess", action="store_true", help="Ejecutar cada etapa en un proceso python3 aparte (stage_runner: subprocess)")
 args = parser.parse_args()
 
 with open(args.config, "r") as f:
@@ -33,6 +39,180 @@ geojson_file = cfg.get("geojson_file")
 colormap_file = cfg.get("colormap_file")
 available_dates_dir = cfg.get("available_dates_dir")
 config_dates = cfg.get("config_dates")
+inference_server = cfg.get("inference_server")
+inference_timeout = cfg.get("inference_timeout", 1800)
+inference_workers = cfg.get("inference_workers")
+threads_per_model = cfg.get("threads_per_model")
+max_memory_mb = cfg.get("max_memory_mb")
+use_compiled_forest = cfg.get("use_compiled_forest", False)
+intermediate_format = cfg.get("intermediate_format", "parquet")
+export_csv = cfg.get("export_csv", False)
+export_tables = cfg.get("export_tables", False)
+map_format = cfg.get("map_format", "tiff")
+map_renderer = cfg.get("map_renderer", "lut")
+tiles_dir = cfg.get("tiles_dir")
+tile_min_zoom = cfg.get("tile_min_zoom", 8)
+tile_max_zoom = cfg.get("tile_max_zoom")
+tile_workers = cfg.get("tile_workers")
+stage_runner = "subprocess" if args.subprocess else cfg.get("stage_runner", "inprocess")
+
+def run_models(d):
+    """
+    Etapa [3]: si hay un servidor de inferencia configurado (inference_server en config.yaml) se le
+    pide la predicción de la fecha; si no, o si no responde en inference_timeout segundos, se lanza
+    Aplicacion_Modelos.py. El servidor rechaza la petición (409) si sus modelos no son los de model_dir y
+    use_compiled_forest.
+    """
+    if inference_server:
+        payload = {"date": d, "input": snap_dir, "pred": pred_dir, "geojson": geojson_file, "max_memory_mb": max_memory_mb,
+                   "format": intermediate_format, "export_csv": export_csv, "export_tables": export_tables, "models": model_dir,
+                   "forest": bool(use_compiled_forest)}
+        request = urllib.request.Request(
+            f"{inference_server.rstrip('/')}/predict",
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=inference_timeout) as response:
+                result = json.loads(response.read())
+            print(f"Predicciones del servidor de inferencia: {result['pred_file']} ({result['rows']} píxeles)")
+            return
+        except urllib.error.HTTPError as e:
+            print(f"ERROR: el servidor de inferencia respondió {e.code}: {e.read().decode('utf-8')}", file=sys.stderr)
+            sys.exit(1)
+        except urllib.error.URLError as e:
+            print(f"AVISO: no se pudo contactar con el servidor de inferencia ({e.reason}); se lanza Aplicacion_Modelos.py")
+        except (socket.timeout, TimeoutError):
+            print(f"AVISO: el servidor de inferencia no ha respondido en {inference_timeout} s; se lanza Aplicacion_Modelos.py")
+
+    cmd = ["python3", "models/Aplicacion_Modelos.py", "--date", d, "--input", snap_dir, "--models", model_dir, "--pred", pred_dir, "--geojson", geojson_file,
+           "--format", intermediate_format]
+    if export_csv:
+        cmd += ["--export-csv"]
+    if export_tables:
+        cmd += ["--export-tables"]
+    if inference_workers:
+        cmd += ["--workers", str(inference_workers)]
+    if threads_per_model:
+        cmd += ["--threads", str(threads_per_model)]
+    if max_memory_mb:
+        cmd += ["--stream", "--max-memory", str(max_memory_mb)]
+    if use_compiled_forest:
+        cmd += ["--forest"]
+    subprocess.run(cmd, check=True)
+
+
+# Módulos de las etapas y objetos que se reutilizan en todas las fechas (registro de modelos, colormap y
+# paleta). Cada uno se carga la primera vez que lo necesita una etapa, así que la etapa [2] no importa los
+# modelos ni el renderizado
+_stages = {}
+
+
+def stage_module(name):
+    """Importa (una sola vez) el módulo de una etapa de fetch/ o models/."""
+    if name not in _stages:
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        for folder in ("fetch", "models"):
+            folder_path = os.path.join(base_dir, folder)
+            if folder_path not in sys.path:
+                sys.path.insert(0, folder_path)
+        _stages[name] = importlib.import_module(name)
+    return _stages[name]
+
+
+def model_registry():
+    """Registro de modelos de la etapa [3], compartido por todas las fechas."""
+    if "registry" not in _stages:
+        _stages["registry"] = stage_module("Aplicacion_utils").get_registry(model_dir, use_forest=use_compiled_forest)
+    return _stages["registry"]
+
+
+def map_colors():
+    """
+    (colormap, palette) de las etapas [5] y [6] según map_renderer: el colormap de matplotlib solo con
+    "matplotlib" y la paleta solo con "lut"; el otro queda a None.
+    """
+    if "colors" not in _stages:
+        if map_renderer == "matplotlib":
+            _stages["colors"] = (stage_module("Aplicacion_utils").load_qgis_colormap(colormap_file), None)
+        else:
+            _stages["colors"] = (None, stage_module("Aplicacion_Render").load_palette(colormap_file))
+    return _stages["colors"]
+
+
+def stage_snap(d):
+    """Etapa [2]: corrección atmosférica con SNAP."""
+    if stage_runner == "subprocess":
+        subprocess.run(["python3", "fetch/snap_batch_application.py", d, safe_dir, snap_dir], check=True)
+        return
+    stage_module("snap_batch_application").run_snap(d, safe_dir, snap_dir, cfg=cfg)
+
+
+def stage_models(d):
+    """
+    Etapa [3]. En este proceso devuelve el DataFrame de predicciones para pasarlo a la etapa [4] sin
+    releerlo; con subprocess, servidor de inferencia o por bloques (max_memory_mb) devuelve None y las
+    predicciones se leen de disco.
+    """
+    if stage_runner == "subprocess" or inference_server:
+        run_models(d)
+        return None
+
+    modelos = stage_module("Aplicacion_Modelos")
+    kwargs = dict(registry=model_registry(), workers=inference_workers or modelos.default_workers(),
+                  threads_per_model=threads_per_model, fmt=intermediate_format, export_csv=export_csv)
+    if max_memory_mb:
+        modelos.run_inference_streaming(d, snap_dir, model_dir, pred_dir, geojson_file, max_memory_mb=max_memory_mb,
+                                        **kwargs)
+        return None
+    return modelos.run_inference(d, snap_dir, model_dir, pred_dir, geojson_file, export_tables=export_tables, **kwargs)
+
+
+def stage_tiffs(d, df_pred=None):
+    """
+    Etapa [4]: mapas de Chl (TIFF por profundidad y/o COG, según map_format). En este proceso devuelve las
+    rejillas para las etapas [5] y [6].
+    """
+    if stage_runner == "subprocess":
+        subprocess.run(["python3", "models/Aplicacion_TIFFfromCSV.py", "--date", d, "--input", pred_dir, "--output", map_dir, "--format", intermediate_format, "--map-format", map_format], check=True)
+        return None
+    return stage_module("Aplicacion_TIFFfromCSV").tiffs_from_predictions(d, pred_dir, map_dir, fmt=intermediate_format,
+                                                                         df=df_pred, map_format=map_format)
+
+
+def stage_plots(d, grids=None):
+    """Etapa [5]: png por profundidad."""
+    if stage_runner == "subprocess":
+        subprocess.run(["python3", "models/Aplicacion_PlotTIFF.py", "--date", d, "--input", map_dir, "--output", map_dir, "--colormap", colormap_file, "--renderer", map_renderer], check=True)
+        return
+    colormap, palette = map_colors()
+    stage_module("Aplicacion_PlotTIFF").plot_depth_maps(d, map_dir, map_dir, colormap=colormap, grids=grids,
+                                                        renderer=map_renderer, palette=palette)
+
+
+def stage_gif(d, grids=None):
+    """Etapa [6]: GIF con las cuatro profundidades."""
+    if stage_runner == "subprocess":
+        subprocess.run(["python3", "models/Aplicacion_GenerateGif.py", "--date", d, "--input", map_dir, "--output", map_dir, "--colormap", colormap_file, "--renderer", map_renderer], check=True)
+        return
+    colormap, palette = map_colors()
+    stage_module("Aplicacion_GenerateGif").generate_gif(d, map_dir, map_dir, colormap=colormap, grids=grids,
+                                                        renderer=map_renderer, palette=palette)
+
+
+def stage_tiles(d):
+    """Etapa [7]: pirámide de teselas XYZ de cada profundidad a partir de los mapas de map_dir."""
+    if stage_runner == "subprocess":
+        cmd = ["python3", "models/Aplicacion_Tiles.py", "--dates", d, "--input", map_dir, "--output", tiles_dir, "--colormap", colormap_file, "--min-zoom", str(tile_min_zoom)]
+        if tile_max_zoom is not None:
+            cmd += ["--max-zoom", str(tile_max_zoom)]
+        if tile_workers:
+            cmd += ["--workers", str(tile_workers)]
+        subprocess.run(cmd, check=True)
+        return
+    stage_module("Aplicacion_Tiles").make_tiles([d], map_dir, tiles_dir, colormap_file, min_zoom=tile_min_zoom,
+                                                max_zoom=tile_max_zoom, workers=tile_workers)
+
 
 def get_filtered_dates(unfiltered_dates, min_cloud_cover):
     number_of_available_dates = len(unfiltered_dates)
@@ -213,39 +393,43 @@ for d in dates:
     """
     print(f"\n=== [2] Aplicando corrección atmosférica con SNAP ===")
     t3 = time.time()
-    subprocess.run(["python3", "fetch/snap_batch_application.py", d, safe_dir, snap_dir], check=True)
+    stage_snap(d)
     t4 = time.time()
     print(f"Tiempo transcurrido [2]: {t4 - t3:.2f} s")
-"""    
-
 
     print(f"\n=== [3] Ejecutando modelos de predicción ===")
     t5 = time.time()
-    subprocess.run(["python3", "models/Aplicacion_Modelos.py", "--date", d, "--input", snap_dir, "--models", model_dir, "--pred", pred_dir, "--geojson", geojson_file], check=True)
+    df_pred = stage_models(d)
     t6 = time.time()
     print(f"Tiempo transcurrido [3]: {t6 - t5:.2f} s")
 
     print(f"\n=== [4] Generando TIFFs ===")
     t7 = time.time()
-    subprocess.run(["python3", "models/Aplicacion_TIFFfromCSV.py", "--date", d, "--input", pred_dir, "--output", map_dir], check=True)
+    grids = stage_tiffs(d, df_pred)
     t8 = time.time()
     print(f"Tiempo transcurrido [4]: {t8 - t7:.2f} s")
 
     if cfg.get("plot_individuales", False):
         print(f"\n=== [5] Generando plots individuales ===")
         t9 = time.time()
-        subprocess.run(["python3", "models/Aplicacion_PlotTIFF.py", "--date", d, "--input", map_dir, "--output", map_dir, "--colormap", colormap_file], check=True)
+        stage_plots(d, grids)
         t10 = time.time()
         print(f"Tiempo transcurrido [5]: {t10 - t9:.2f} s")
 
     if cfg.get("generate_gif", False):
         print(f"\n=== [6] Generando GIF ===")
         t11 = time.time()
-        subprocess.run(["python3", "models/Aplicacion_GenerateGif.py", "--date", d, "--input", map_dir, "--output", map_dir, "--colormap", colormap_file], check=True)
+        stage_gif(d, grids)
         t12 = time.time()
         print(f"Tiempo transcurrido [6]: {t12 - t11:.2f} s")
 
+    if cfg.get("generate_tiles", False):
+        print(f"\n=== [7] Generando teselas ===")
+        t13 = time.time()
+        stage_tiles(d)
+        t14 = time.time()
+        print(f"Tiempo transcurrido [7]: {t14 - t13:.2f} s")
+
     t_end = time.time()
     print("\n Pipeline completado correctamente.")
     print(f"Tiempo total del pipeline: {(t_end - t_start)/60:.2f} min")
-"""
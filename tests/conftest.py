@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Los módulos de models/ se importan entre sí por nombre (from Aplicacion_utils import ...)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models"))
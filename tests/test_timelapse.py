@@ -0,0 +1,60 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image, ImageSequence
+from Aplicacion_Render import load_palette
+from Aplicacion_Timelapse import GifWriter, ApngWriter, WebpWriter
+
+# Ida y vuelta de los escritores de animaciones: se codifican unos fotogramas de índices de la paleta y se
+# comprueba con Pillow el número de fotogramas, los píxeles, la duración y el bucle
+
+COLORMAP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fetch", "colormap_custom.txt")
+
+WIDTH, HEIGHT = 37, 23
+DURATION = 500
+LOOP = 3
+
+
+@pytest.fixture(scope="module")
+def palette():
+    return load_palette(COLORMAP)
+
+
+def make_frames(palette, n_frames=3):
+    """Fotogramas distintos con todos los índices de la paleta."""
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, len(palette["rgba"]), size=(HEIGHT, WIDTH), dtype=np.uint8) for _ in range(n_frames)]
+
+
+@pytest.mark.parametrize("writer_class, ext", [(GifWriter, ".gif"), (ApngWriter, ".png"), (WebpWriter, ".webp")])
+def test_round_trip(tmp_path, palette, writer_class, ext):
+    frames = make_frames(palette)
+    path = str(tmp_path / f"timelapse{ext}")
+
+    writer = writer_class(path, WIDTH, HEIGHT, palette, DURATION, loop=LOOP)
+    for indices in frames:
+        writer.append(indices)
+    writer.close()
+    assert not os.path.exists(path.replace(ext, f".part{ext}"))
+
+    rgb = palette["rgba"][:, :3]
+    with Image.open(path) as image:
+        assert image.size == (WIDTH, HEIGHT)
+        assert getattr(image, "n_frames", 1) == len(frames)
+        assert image.info["loop"] == LOOP
+        decoded = 0
+        for frame, indices in zip(ImageSequence.Iterator(image), frames):
+            # Se decodifica antes de leer la duración: en WebP Pillow la rellena al cargar el fotograma
+            np.testing.assert_array_equal(np.asarray(frame.convert("RGB")), rgb[indices])
+            assert frame.info["duration"] == DURATION
+            decoded += 1
+        assert decoded == len(frames)
+
+
+@pytest.mark.parametrize("writer_class, ext", [(GifWriter, ".gif"), (ApngWriter, ".png"), (WebpWriter, ".webp")])
+def test_abort_removes_partial_file(tmp_path, palette, writer_class, ext):
+    path = str(tmp_path / f"timelapse{ext}")
+    writer = writer_class(path, WIDTH, HEIGHT, palette, DURATION)
+    writer.append(make_frames(palette, 1)[0])
+    writer.abort()
+    assert os.listdir(str(tmp_path)) == []